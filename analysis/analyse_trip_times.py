@@ -10,11 +10,17 @@ from datetime import datetime, timedelta
 from routing.Map import Map
 from traffic_estimation.Trip import Trip
 
+# The same hours are analysed many times, so their trips are cached here (see db_trip_cache)
+TRIP_CACHE_DIRECTORY = 'trip_cache'
+
 def analyse_trip_times():
     db_main.connect('db_functions/database.conf')
+    db_trip.set_trip_cache(TRIP_CACHE_DIRECTORY)
     
     
     datelist = [datetime(year=2012, month=7, day=8, hour=0) + timedelta(hours=1)*x for x in range(168*3)]
+    # Cache all of the hours with one query, instead of one per hour
+    db_trip.trip_cache.fill(datelist)
     
     for date in datelist:
         trips = db_trip.find_pickup_dt(date, date+timedelta(hours=1))
@@ -31,9 +37,12 @@ def jfk(lat, lon):
 
 def analyse_trip_locations():
     db_main.connect('db_functions/database.conf')
+    db_trip.set_trip_cache(TRIP_CACHE_DIRECTORY)
     
     
     datelist = [datetime(year=2012, month=7, day=8, hour=0) + timedelta(hours=1)*x for x in range(168*3)]
+    # Cache all of the hours with one query, instead of one per hour
+    db_trip.trip_cache.fill(datelist)
     
     #nyc_map = Map('nyc_map4/nodes.csv', 'nyc_map4/links.csv', limit_bbox=Map.reasonable_nyc_bbox)
     nyc_map = Map('nyc_map4/nodes.csv', 'nyc_map4/links.csv')
@@ -2,47 +2,200 @@
 A small wrapper for the psycopg2 library
 A database connection can be created via settings from a .conf file
 And queries can be executed
+
+Connections are pooled: close() gives the connection back to an idle pool of the
+process instead of closing it, and the next connect() with the same settings
+reuses it (after checking that it still works).  So jobs can connect and close
+around each unit of work without setting up a new connection every time.  Each
+thread has its own current connection.
 """
 
 import psycopg2
-from time import sleep
+from time import sleep, time
+from itertools import count
+from contextlib import contextmanager
+import atexit
+import os
+import random
+import threading
+from datetime import datetime
+from cStringIO import StringIO
+import struct
+import numpy as np
+
+# The current connection of each thread, set by connect()
+_local = threading.local()
+
+# The idle connections of each process, by (process id, connection string).  Each
+# one is stored with the time when it became idle
+_idle_connections = {}
+_pool_lock = threading.Lock()
+
+# Connections which have been idle for longer than this (in seconds) are tested
+# before they are reused
+HEALTH_CHECK_INTERVAL = 60
+# The longest wait between attempts to connect, in seconds
+MAX_RETRY_INTERVAL = 300
+
+# Used to give each server-side cursor a unique name
+_cursor_numbers = count()
 
-db_con = None
+# The column types which can be written by copy_columns(), with the numpy type of
+# their binary COPY format (big-endian).  Timestamps are sent as microseconds since
+# 2000-01-01
+COPY_TYPES = {"BIGINT": ">i8",
+              "INTEGER": ">i4",
+              "REAL": ">f4",
+              "FLOAT": ">f8",
+              "TIMESTAMP": ">i8"}
+# The text format of each column type
+COPY_TEXT_FORMATS = {"BIGINT": "%d",
+                     "INTEGER": "%d",
+                     "REAL": "%.9g",
+                     "FLOAT": "%.17g",
+                     "TIMESTAMP": "%s"}
+PG_EPOCH = np.datetime64(datetime(2000, 1, 1), 'us')
+
+COPY_BINARY_HEADER = "PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+COPY_BINARY_TRAILER = struct.pack(">h", -1)
 
 # Connects to a postgres database.  This must be called before execute()
+# An idle connection with the same settings is reused if there is one
 # Params:
     # db_conf_file - contains the connection string
     # (which should include databse name, host, user, password)
+    # retry_interval - if >= 0, keep trying until the connection is successful.
+        # The first wait is about retry_interval seconds, and it doubles after
+        # each failure (up to MAX_RETRY_INTERVAL)
 def connect(db_conf_file, retry_interval=-1):
     #Read the connection string from the configuration file
     with open(db_conf_file, 'r') as f:
         conn_string = f.read()
-    global db_con
-    
-    # If retry_interval >= 0, keep trying until the connection is successful
-    try_again = True
-    while(try_again):
-        try_again = False
+
+    # A thread only has one current connection
+    close()
+    con = _take_idle_connection(conn_string)
+    if(con is None):
+        con = _new_connection(conn_string, retry_interval)
+    _local.con = con
+    _local.conn_string = conn_string
+
+# Opens a new connection, and retries with backoff if retry_interval >= 0
+def _new_connection(conn_string, retry_interval):
+    wait = retry_interval
+    while(True):
         try:
-            # Try to connect to the database - this sets the global db_con object
-            db_con = psycopg2.connect(conn_string)
-            return
+            return psycopg2.connect(conn_string)
         except psycopg2.OperationalError as e:
-            if(retry_interval >=0):
-                # If the connection fails and retry_interval >=0, try again
-                sleep(retry_interval)
-                try_again = True
-            else:
+            if(retry_interval < 0):
                 # If the connection fails and retry_interval < 0, raise the error
                 raise e
-                
+            # The wait is randomized, so that processes which failed at the same
+            # time don't all try again at the same time
+            sleep(wait * random.uniform(0.5, 1.5))
+            wait = min(wait * 2, MAX_RETRY_INTERVAL)
 
-# Closes the connection to the database.  No more execute() queries can be run
-# after the connection has been closed
+# Takes a working idle connection of this process out of the pool
+# Returns:
+    # a connection, or None if there are no idle ones
+def _take_idle_connection(conn_string):
+    key = (os.getpid(), conn_string)
+    while(True):
+        with _pool_lock:
+            idle = _idle_connections.get(key)
+            if(not idle):
+                return None
+            (con, idle_since) = idle.pop()
+        if(_is_healthy(con, idle_since)):
+            return con
+        try:
+            con.close()
+        except psycopg2.Error:
+            pass
+
+# Tells whether an idle connection can still be used.  Connections which have
+# been idle for a while are tested with a query, since the server may have
+# dropped them
+def _is_healthy(con, idle_since):
+    if(con.closed):
+        return False
+    if(time() - idle_since < HEALTH_CHECK_INTERVAL):
+        return True
+    try:
+        cur = con.cursor()
+        cur.execute("SELECT 1;")
+        cur.close()
+        con.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+# Returns the current connection of this thread
+def _get_connection(action):
+    con = getattr(_local, 'con', None)
+    if(con is None):
+        raise Exception("Database is not connected.  Cannot " + action)
+    return con
+
+# Releases the connection of this thread.  Uncommitted changes are rolled back and
+# the connection goes back to the pool, to be reused by the next connect().  No
+# more execute() queries can be run until then
 def close():
-    global db_con
-    db_con.close()
-    db_con = None
+    con = getattr(_local, 'con', None)
+    if(con is None):
+        return
+    _local.con = None
+    if(con.closed):
+        return
+    try:
+        con.rollback()
+    except psycopg2.Error:
+        con.close()
+        return
+    with _pool_lock:
+        key = (os.getpid(), _local.conn_string)
+        _idle_connections.setdefault(key, []).append((con, time()))
+
+# Really closes the idle connections of this process.  This is done at exit
+def close_all():
+    with _pool_lock:
+        for key in _idle_connections.keys():
+            if(key[0] == os.getpid()):
+                for (con, _) in _idle_connections.pop(key):
+                    con.close()
+
+atexit.register(close_all)
+
+# Connects for the duration of a with block (see connect()), e.g.
+#   with db_main.connected("db_functions/database.conf"):
+#       trips = db_trip.find_pickup_dt(d1, d2)
+@contextmanager
+def connected(db_conf_file, retry_interval=-1):
+    connect(db_conf_file, retry_interval)
+    try:
+        yield
+    finally:
+        close()
+
+# A cursor of the current connection, for the duration of a with block.  The
+# transaction is committed at the end of the block, or rolled back if the block
+# raises an exception.  The cursor is closed either way, e.g.
+#   with db_main.cursor() as cur:
+#       cur.execute(sql, args)
+# Params:
+    # name - if given, a named (server-side) cursor is created
+@contextmanager
+def cursor(name=None):
+    con = _get_connection("create a cursor")
+    cur = con.cursor(name) if name else con.cursor()
+    try:
+        yield cur
+        con.commit()
+    except:
+        con.rollback()
+        raise
+    finally:
+        cur.close()
 
 # Executes queries to an open databse connection
 # Params:
@@ -51,15 +204,149 @@ def close():
 # Returns:
     # a new Cursor object
 def execute(sql, args=None):
-    global db_con
-    if(db_con==None):
-        raise Exception("Database is not connected.  Cannot execute query " + sql)
-    cur = db_con.cursor()
+    cur = _get_connection("execute query " + sql).cursor()
     cur.execute(sql, args)
     return cur
 
+# Executes a query with a named (server-side) cursor, and yields the results in
+# batches.  Unlike execute(), the whole result set is never held in memory - the
+# server only sends the next batch when it is asked for it.
+# Params:
+    # sql - A string containing an SQL query
+    # args - optional arguments for prepared statements
+    # batch_size - the number of rows fetched at a time
+# Returns:
+    # a generator of lists of rows
+def execute_batches(sql, args=None, batch_size=10000):
+    con = _get_connection("execute query " + sql)
+    cur = con.cursor(name="stream_%d" % next(_cursor_numbers))
+    try:
+        cur.execute(sql, args)
+        while(True):
+            rows = cur.fetchmany(batch_size)
+            if(len(rows) == 0):
+                break
+            yield rows
+    finally:
+        cur.close()
+
+# Builds the data of a COPY FROM STDIN command.  See copy_columns()
+# Returns:
+    # a string with the rows in PostgreSQL's text or binary COPY format
+def format_copy_data(columns, binary=False):
+    # Single values are repeated for every row
+    lengths = [len(values) for (_, _, values) in columns if np.ndim(values) > 0]
+    num_rows = lengths[0] if lengths else 1
+    arrays = []
+    for (_, column_type, values) in columns:
+        if(column_type == "TIMESTAMP"):
+            values = np.asarray(values, dtype="datetime64[us]")
+        elif(column_type in ["BIGINT", "INTEGER"]):
+            # Round floats (e.g. distance weighted trip counts) like PostgreSQL does
+            # when they are inserted into an integer column, instead of truncating
+            values = np.asarray(values)
+            if(values.dtype.kind == "f"):
+                values = np.rint(values)
+        values = np.broadcast_to(values, (num_rows,))
+        if(column_type == "TIMESTAMP" and binary):
+            values = (values - PG_EPOCH).astype(np.int64)
+        elif(column_type == "TIMESTAMP"):
+            values = np.datetime_as_string(values, unit="us")
+        arrays.append(values)
+
+    if(binary):
+        # Each row is the number of fields, followed by the length and value of each
+        dtype = [("num_fields", ">i2")]
+        for i, (_, column_type, _) in enumerate(columns):
+            dtype += [("length%d" % i, ">i4"), ("value%d" % i, COPY_TYPES[column_type])]
+        rows = np.empty(num_rows, dtype=dtype)
+        rows["num_fields"] = len(columns)
+        for i, values in enumerate(arrays):
+            field = "value%d" % i
+            rows["length%d" % i] = rows.dtype[field].itemsize
+            rows[field] = values
+        return COPY_BINARY_HEADER + rows.tostring() + COPY_BINARY_TRAILER
+    else:
+        row_format = "\t".join([COPY_TEXT_FORMATS[column_type]
+                                 for (_, column_type, _) in columns])
+        lines = [row_format % row for row in zip(*[values.tolist() for values in arrays])]
+        lines.append("")
+        return "\n".join(lines)
+
+# Writes rows into a table with COPY FROM STDIN, which is much faster than running
+# INSERT statements.  Nothing is committed, so this can be in the same transaction
+# as other statements (e.g. a DELETE of the rows it replaces).
+# Params:
+    # table - the name of the table
+    # columns - a list of (name, type, values) for each column to write.  The type
+        # is one of the keys of COPY_TYPES, and values is an array-like with a value
+        # for each row, or a single value for all of the rows.  Floats written to
+        # BIGINT and INTEGER columns are rounded to the nearest integer
+    # binary - if True, the rows are sent in the binary COPY format, which the server
+        # can parse faster.  Otherwise the text format is used
+def copy_columns(table, columns, binary=False):
+    con = _get_connection("copy into " + table)
+    sql = "COPY %s (%s) FROM STDIN" % (table, ", ".join([name for (name, _, _) in columns]))
+    if(binary):
+        sql += " WITH (FORMAT binary)"
+    cur = con.cursor()
+    try:
+        cur.copy_expert(sql, StringIO(format_copy_data(columns, binary)))
+    finally:
+        cur.close()
+
+# Parses the data of a binary COPY TO STDOUT command - the inverse of
+# format_copy_data(binary=True)
+# Params:
+    # data - the string sent by the server
+    # column_types - the type of each column (keys of COPY_TYPES).  The columns can't
+        # contain NULLs
+# Returns:
+    # a list with an array of each column.  Timestamps are datetime64[us] arrays
+def parse_copy_data(data, column_types):
+    # Skip the signature, flags and header extension
+    (header_length,) = struct.unpack_from(">i", data, 15)
+    start = 19 + header_length
+    end = len(data) - len(COPY_BINARY_TRAILER)
+
+    dtype = [("num_fields", ">i2")]
+    for i, column_type in enumerate(column_types):
+        dtype += [("length%d" % i, ">i4"), ("value%d" % i, COPY_TYPES[column_type])]
+    dtype = np.dtype(dtype)
+    if((end - start) % dtype.itemsize != 0):
+        raise ValueError("COPY data does not match the column types (or contains NULLs)")
+    rows = np.frombuffer(data[start:end], dtype=dtype)
+
+    columns = []
+    for i, column_type in enumerate(column_types):
+        field = "value%d" % i
+        if(np.any(rows["length%d" % i] != dtype[field].itemsize)):
+            raise ValueError("COPY data does not match the column types (or contains NULLs)")
+        values = rows[field].astype(dtype[field].newbyteorder("="))
+        if(column_type == "TIMESTAMP"):
+            values = PG_EPOCH + values.astype("timedelta64[us]")
+        columns.append(values)
+    return columns
+
+# Runs a query with COPY TO STDOUT, and returns the result as numpy arrays.  The
+# rows are sent in the binary format, so no values are parsed from text
+# Params:
+    # sql - A string containing an SQL query
+    # column_types - the type of each column of the result (keys of COPY_TYPES)
+    # args - optional arguments for the query
+# Returns:
+    # a list with an array of each column (see parse_copy_data())
+def copy_query(sql, column_types, args=None):
+    cur = _get_connection("execute query " + sql).cursor()
+    try:
+        f = StringIO()
+        cur.copy_expert("COPY (%s) TO STDOUT WITH (FORMAT binary)" % cur.mogrify(sql, args), f)
+    finally:
+        cur.close()
+    return parse_copy_data(f.getvalue(), column_types)
+
 def commit():
-    db_con.commit()
+    _get_connection("commit").commit()
 
 def rollback():
-    db_con.rollback()
+    _get_connection("roll back").rollback()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+A compact way of storing travel times in the database: one row per datetime,
+instead of one row per link and datetime.
+
+Each row holds the travel times and trip counts of every link as float32 byte
+arrays, in link_id order (the counts of distance weighted estimates aren't whole
+numbers).  The order is given by a link dictionary - the begin and end node_ids
+of each link_id - which is stored once in the link_dictionaries table and
+referenced by its version number.  A new version is only added when a Map with
+different links is saved.  When loading, the entries of the dictionary are matched
+to the links of the Map, so a Map does not need to have exactly the same links as
+the one that was saved.
+
+Links with no trips are stored as NaN, and get the default speed of the hour
+when they are loaded (like the default row of the travel_times table).
+
+See db_travel_times for the functions which use this storage.
+
+@author: brian
+"""
+import hashlib
+import numpy as np
+
+import db_main
+
+# Maps the checksum of a link dictionary to its version number
+_versions = {}
+# Maps the version number of a link dictionary to its begin and end node_id arrays
+_dictionaries = {}
+
+
+# Creates the tables which store the link dictionaries and the travel time arrays
+def create_tables():
+    sql = """CREATE TABLE link_dictionaries (
+        version SERIAL PRIMARY KEY,
+        checksum TEXT UNIQUE,
+        begin_node_ids BYTEA,
+        end_node_ids BYTEA);"""
+    try:
+        db_main.execute(sql)
+        db_main.commit()
+    except:
+        db_main.rollback()
+
+    sql = """CREATE TABLE travel_time_arrays (
+        datetime TIMESTAMP PRIMARY KEY,
+        link_version INTEGER REFERENCES link_dictionaries (version),
+        default_speed REAL,
+        travel_times BYTEA,
+        num_trips BYTEA);"""
+    try:
+        db_main.execute(sql)
+        db_main.commit()
+    except:
+        db_main.rollback()
+
+
+# Drops the tables of this storage
+def drop_tables():
+    for table in ["travel_time_arrays", "link_dictionaries"]:
+        try:
+            db_main.execute("DROP TABLE %s;" % table)
+            db_main.commit()
+        except:
+            db_main.rollback()
+    _versions.clear()
+    _dictionaries.clear()
+
+
+# Finds the version of the link dictionary of a Map, adding it to the
+# link_dictionaries table if it is new
+# Params:
+    # road_map - a Map object
+# Returns:
+    # the version number
+def get_link_version(road_map):
+    begin_node_ids = np.array([link.origin_node_id for link in road_map.links], dtype="<i8")
+    end_node_ids = np.array([link.connecting_node_id for link in road_map.links], dtype="<i8")
+    checksum = hashlib.md5(begin_node_ids.tostring() + end_node_ids.tostring()).hexdigest()
+    if(checksum in _versions):
+        return _versions[checksum]
+
+    sql = "SELECT version FROM link_dictionaries WHERE checksum=%s;"
+    row = db_main.execute(sql, (checksum,)).fetchone()
+    if(row is None):
+        sql = """INSERT INTO link_dictionaries (checksum, begin_node_ids, end_node_ids)
+            VALUES (%s, %s, %s) RETURNING version;"""
+        try:
+            row = db_main.execute(sql, (checksum, buffer(begin_node_ids),
+                                        buffer(end_node_ids))).fetchone()
+            db_main.commit()
+        except:
+            # Another process may have added the same dictionary first
+            db_main.rollback()
+            sql = "SELECT version FROM link_dictionaries WHERE checksum=%s;"
+            row = db_main.execute(sql, (checksum,)).fetchone()
+            if(row is None):
+                raise
+
+    (version,) = row
+    _versions[checksum] = version
+    _dictionaries[version] = (begin_node_ids, end_node_ids)
+    return version
+
+
+# Finds the link_id in a Map of each entry of a link dictionary
+# Params:
+    # road_map - a Map object
+    # version - the version of the link dictionary
+# Returns:
+    # an array with a link_id (or -1) for each entry of the dictionary
+def get_dictionary_link_ids(road_map, version):
+    if(version not in _dictionaries):
+        sql = "SELECT begin_node_ids, end_node_ids FROM link_dictionaries WHERE version=%s;"
+        (begin_node_ids, end_node_ids) = db_main.execute(sql, (version,)).fetchone()
+        _dictionaries[version] = (np.frombuffer(begin_node_ids, dtype="<i8"),
+                                  np.frombuffer(end_node_ids, dtype="<i8"))
+    (begin_node_ids, end_node_ids) = _dictionaries[version]
+    return road_map.get_array_graph().get_link_ids(begin_node_ids, end_node_ids)
+
+
+# Saves the travel times of a Map for one datetime, replacing any that are
+# already saved.  See db_travel_times.save_travel_times()
+def save_travel_times(road_map, datetime):
+    version = get_link_version(road_map)
+    num_trips = np.array([link.num_trips for link in road_map.links], dtype="<f4")
+    times = np.array([link.time for link in road_map.links], dtype="<f4")
+    times[num_trips <= 0] = np.nan
+
+    sql = "INSERT INTO travel_time_arrays VALUES (%s, %s, %s, %s, %s);"
+    try:
+        db_main.execute("DELETE FROM travel_time_arrays WHERE datetime=%s;", (datetime,))
+        db_main.execute(sql, (datetime, version, road_map.get_default_speed(),
+                              buffer(times), buffer(num_trips)))
+        db_main.commit()
+    except:
+        db_main.rollback()
+        raise
+
+
+# Loads the travel times of several hours into arrays.  See
+# db_travel_times.load_travel_time_matrix()
+def load_travel_time_matrix(road_map, datetimes):
+    graph = road_map.get_array_graph()
+    (unique_datetimes, inverse) = np.unique(np.asarray(datetimes, dtype="datetime64[us]"),
+                                            return_inverse=True)
+    times = np.full((len(unique_datetimes), graph.num_links), np.nan)
+    num_trips = np.zeros((len(unique_datetimes), graph.num_links), dtype=np.int64)
+
+    sql = """SELECT datetime, link_version, default_speed, travel_times, num_trips
+        FROM travel_time_arrays WHERE datetime = ANY(%s);"""
+    cur = db_main.execute(sql, (list(datetimes),))
+    for (datetime, version, default_speed, saved_times, saved_num_trips) in cur:
+        hour = np.searchsorted(unique_datetimes, np.datetime64(datetime, "us"))
+        if(default_speed is not None):
+            times[hour] = graph.link_lengths / default_speed
+
+        link_ids = get_dictionary_link_ids(road_map, version)
+        saved_times = np.frombuffer(saved_times, dtype="<f4")
+        saved_num_trips = np.frombuffer(saved_num_trips, dtype="<f4")
+        found = (link_ids >= 0) & (saved_num_trips > 0)
+        times[hour, link_ids[found]] = saved_times[found]
+        # Rounded like the INTEGER counts of the travel_times table
+        num_trips[hour, link_ids[found]] = np.rint(saved_num_trips[found])
+    cur.close()
+    return times[inverse], num_trips[inverse]
+
+
+# Removes the travel times of a datetime
+def delete_travel_times(datetime):
+    db_main.execute("DELETE FROM travel_time_arrays WHERE datetime=%s;", (datetime,))
+    db_main.commit()
+
+
+# Returns a sorted list of datetimes where travel time information is available
+def get_available_dates():
+    cur = db_main.execute("SELECT datetime FROM travel_time_arrays ORDER BY datetime;")
+    return [date for (date,) in cur]
+
+
+# Returns the size of the tables of this storage, as text
+def get_table_size():
+    sql = """SELECT pg_size_pretty(pg_total_relation_size('travel_time_arrays') +
+        pg_total_relation_size('link_dictionaries'));"""
+    (size,) = db_main.execute(sql).fetchone()
+    return size
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+Stores travel times in local files instead of the database, so that they can be
+read without a database server (e.g. for plotting or offline analysis).
+
+Each hour is one record of two fixed-width float32 columns, indexed by link_id:
+the travel time of every link (already filled in with the default speed for
+links without trips), and the number of trips on every link.  Records are
+appended to segment files, which are read through memory maps.  A segment holds
+the records of one link dictionary (the begin and end node_ids of each link_id,
+stored next to it), and a new segment is started when the dictionary changes or
+the segment is full.  When loading, the dictionary is matched to the links of
+the Map, like in db_travel_time_arrays.
+
+The time index is also append-only: each save or delete adds an entry
+(datetime, segment, record, default speed), and the last entry of a datetime
+wins.  The default speed is used for links of the Map which aren't in the
+dictionary.  Writers
+hold a lock on the directory, so several processes can save into the same store.
+
+    directory/index.dat                - the time index
+    directory/segment_000000.dat       - records of 2 x num_links float32 values
+    directory/segment_000000.links.npy - the link dictionary of the segment
+
+@author: brian
+"""
+from os import path, makedirs, listdir
+from shutil import rmtree
+import fcntl
+import re
+import numpy as np
+
+# An entry of the time index.  A segment of -1 means the datetime was deleted
+INDEX_DTYPE = np.dtype([("datetime", "<i8"), ("segment", "<i4"), ("record", "<i4"),
+                        ("default_speed", "<f8")])
+
+# The number of hours in a segment file, before a new one is started
+SEGMENT_HOURS = 24 * 7
+
+
+class TravelTimeFiles:
+    # Params:
+        # directory - where the files are kept
+    def __init__(self, directory):
+        self.directory = directory
+        # Memory maps and link dictionaries of the segments, opened on demand
+        self.segment_maps = {}
+        self.dictionaries = {}
+
+    def _path(self, filename):
+        return path.join(self.directory, filename)
+
+    def _segment_path(self, segment):
+        return self._path("segment_%06d.dat" % segment)
+
+    def _dictionary_path(self, segment):
+        return self._path("segment_%06d.links.npy" % segment)
+
+    # Creates the directory of the store
+    def create(self):
+        if(not path.isdir(self.directory)):
+            makedirs(self.directory)
+
+    # Deletes the whole store
+    def drop(self):
+        rmtree(self.directory, ignore_errors=True)
+        self.segment_maps = {}
+        self.dictionaries = {}
+
+    # Reads the time index
+    # Returns:
+        # a sorted datetime64[us] array of the datetimes which have travel times
+        # arrays with the segment, record number and default speed (NaN if there
+        # is none) of each datetime
+    def _read_index(self):
+        index_path = self._path("index.dat")
+        if(not path.exists(index_path)):
+            entries = np.zeros(0, dtype=INDEX_DTYPE)
+        else:
+            entries = np.fromfile(index_path, dtype=INDEX_DTYPE)
+        # Keep the last entry of each datetime
+        order = np.argsort(entries["datetime"], kind="mergesort")[::-1]
+        (_, last) = np.unique(entries["datetime"][order], return_index=True)
+        entries = entries[order[last]]
+        entries = entries[entries["segment"] >= 0]
+        return (entries["datetime"].astype("datetime64[us]"), entries["segment"],
+                entries["record"], entries["default_speed"])
+
+    # Appends an entry to the time index
+    def _append_index(self, datetime, segment, record, default_speed):
+        entry = np.zeros(1, dtype=INDEX_DTYPE)
+        entry["datetime"] = np.datetime64(datetime, "us").astype(np.int64)
+        entry["segment"] = segment
+        entry["record"] = record
+        entry["default_speed"] = np.nan if default_speed is None else default_speed
+        with open(self._path("index.dat"), "ab") as f:
+            f.write(entry.tostring())
+
+    # Holds an exclusive lock on the store while writing
+    def _lock(self):
+        lock_file = open(self._path("lock"), "a")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    # Returns the begin and end node_ids of each link_id of a segment
+    def _get_dictionary(self, segment):
+        if(segment not in self.dictionaries):
+            self.dictionaries[segment] = np.load(self._dictionary_path(segment))
+        return self.dictionaries[segment]
+
+    # Returns the records of a segment as a (num_records x 2 x num_links) array,
+    # which is memory mapped.  It is reopened if it doesn't include the given record
+    def _get_records(self, segment, record):
+        records = self.segment_maps.get(segment)
+        if(records is None or record >= len(records)):
+            num_links = self._get_dictionary(segment).shape[1]
+            records = np.memmap(self._segment_path(segment), dtype="<f4", mode="r")
+            records = records.reshape(-1, 2, num_links)
+            self.segment_maps[segment] = records
+        return records
+
+    # Saves the travel times of a Map for one datetime, replacing any that are
+    # already saved.  See db_travel_times.save_travel_times()
+    def save_travel_times(self, road_map, datetime):
+        dictionary = np.array([[link.origin_node_id for link in road_map.links],
+                               [link.connecting_node_id for link in road_map.links]],
+                              dtype=np.int64)
+        num_trips = np.array([link.num_trips for link in road_map.links], dtype=np.float64)
+        times = np.array([link.time for link in road_map.links], dtype=np.float64)
+        # Links without trips get the default speed, like when the rows are loaded
+        default_speed = road_map.get_default_speed()
+        lengths = np.array([link.length for link in road_map.links])
+        if(default_speed is None):
+            times[num_trips <= 0] = np.nan
+        else:
+            times = np.where(num_trips > 0, times, lengths / default_speed)
+        data = np.array([times, num_trips], dtype="<f4")
+
+        self.create()
+        lock_file = self._lock()
+        try:
+            segments = [int(name[8:14]) for name in listdir(self.directory)
+                        if re.match(r"segment_\d{6}\.dat$", name)]
+            segment = max(segments) if segments else -1
+            # Start a new segment if the links have changed or the last one is full
+            num_records = 0
+            if(segment >= 0):
+                num_records = path.getsize(self._segment_path(segment)) // data.nbytes
+            if(segment < 0 or num_records >= SEGMENT_HOURS or
+               not np.array_equal(self._get_dictionary(segment), dictionary)):
+                segment += 1
+                num_records = 0
+                np.save(self._dictionary_path(segment), dictionary)
+                self.dictionaries[segment] = dictionary
+                self.segment_maps.pop(segment, None)
+
+            # Overwrite anything after the last whole record (e.g. from a failed save)
+            mode = "r+b" if path.exists(self._segment_path(segment)) else "wb"
+            with open(self._segment_path(segment), mode) as f:
+                f.seek(num_records * data.nbytes)
+                f.write(data.tostring())
+                f.truncate()
+            self._append_index(datetime, segment, num_records, default_speed)
+        finally:
+            lock_file.close()
+
+    # Loads the travel times of several hours into arrays.  See
+    # db_travel_times.load_travel_time_matrix()
+    def load_travel_time_matrix(self, road_map, datetimes):
+        graph = road_map.get_array_graph()
+        (unique_datetimes, inverse) = np.unique(np.asarray(datetimes, dtype="datetime64[us]"),
+                                                return_inverse=True)
+        times = np.full((len(unique_datetimes), graph.num_links), np.nan)
+        num_trips = np.zeros((len(unique_datetimes), graph.num_links), dtype=np.int64)
+
+        (index_datetimes, index_segments, index_records,
+         index_default_speeds) = self._read_index()
+        positions = np.minimum(np.searchsorted(index_datetimes, unique_datetimes),
+                               max(len(index_datetimes) - 1, 0))
+        if(len(index_datetimes) > 0):
+            found = index_datetimes[positions] == unique_datetimes
+        else:
+            found = np.zeros(len(unique_datetimes), dtype=bool)
+
+        for segment in np.unique(index_segments[positions[found]]).tolist():
+            hours = np.nonzero(found & (index_segments[positions] == segment))[0]
+            record_numbers = index_records[positions[hours]]
+            records = self._get_records(segment, record_numbers.max())[record_numbers]
+
+            # Links which aren't in the dictionary get the default speed
+            default_speeds = index_default_speeds[positions[hours]]
+            times[hours] = graph.link_lengths[np.newaxis, :] / default_speeds[:, np.newaxis]
+
+            (begin_node_ids, end_node_ids) = self._get_dictionary(segment)
+            link_ids = graph.get_link_ids(begin_node_ids, end_node_ids)
+            in_map = np.nonzero(link_ids >= 0)[0]
+            times[hours[:, np.newaxis], link_ids[in_map]] = records[:, 0, in_map]
+            # Rounded like the INTEGER counts of the travel_times table
+            num_trips[hours[:, np.newaxis], link_ids[in_map]] = np.rint(records[:, 1, in_map])
+        return times[inverse], num_trips[inverse]
+
+    # Removes the travel times of a datetime
+    def delete_travel_times(self, datetime):
+        self.create()
+        lock_file = self._lock()
+        try:
+            self._append_index(datetime, -1, -1, None)
+        finally:
+            lock_file.close()
+
+    # Returns a sorted list of datetimes where travel time information is available
+    def get_available_dates(self):
+        (index_datetimes, _, _, _) = self._read_index()
+        return index_datetimes.tolist()
+
+    # Returns the total size of the files, as text
+    def get_size(self):
+        if(not path.isdir(self.directory)):
+            return "0 MB"
+        size = sum([path.getsize(self._path(name)) for name in listdir(self.directory)])
+        return "%d MB" % (size // 1000000)
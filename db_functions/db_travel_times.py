@@ -1,7 +1,10 @@
 # -*- coding: utf-8 -*-
 """
 Contains functions for loading and saving the travel times of Links
-into the database
+into the database.  The travel times can be stored one row per link and datetime
+(the travel_times table), one row of arrays per datetime (see
+db_travel_time_arrays), or in local files without a database (see
+db_travel_time_files) - set_storage() or load_storage_config() chooses between them
 Created on Fri Jan  9 15:08:51 2015
 
 @author: Brian Donovan (briandonovan100@gmail.com)
@@ -9,9 +12,57 @@ Created on Fri Jan  9 15:08:51 2015
 
 
 import db_main
+import db_travel_time_arrays
+from db_travel_time_files import TravelTimeFiles
+from math import isnan
+import numpy as np
+
+# The ways travel times can be stored, see set_storage()
+STORAGE_TYPES = ["rows", "arrays", "files"]
+storage = "rows"
+# The TravelTimeFiles of the "files" storage
+file_store = None
+
+
+# Chooses how travel times are stored.  All of the functions in this module
+# (except the link_counts ones) use the chosen storage
+# Params:
+    # storage_type - "rows" for the travel_times table, "arrays" for the tables
+        # of db_travel_time_arrays, or "files" for db_travel_time_files
+    # directory - the directory of the "files" storage
+def set_storage(storage_type, directory=None):
+    global storage, file_store
+    if(storage_type not in STORAGE_TYPES):
+        raise ValueError("Unknown travel time storage: " + str(storage_type))
+    if(storage_type == "files"):
+        if(directory is None):
+            raise ValueError("The files storage needs a directory")
+        file_store = TravelTimeFiles(directory)
+    storage = storage_type
+
+# Chooses the storage from a configuration file, with lines like
+#   storage='files'
+#   directory='travel_times'
+# (see samp_travel_times.conf)
+def load_storage_config(config_file):
+    settings = {}
+    with open(config_file, 'r') as f:
+        for line in f:
+            if('=' in line):
+                (key, value) = line.split('=', 1)
+                settings[key.strip()] = value.strip().strip("'\"")
+    set_storage(settings.get('storage', 'rows'), settings.get('directory'))
+
+# Tells whether the chosen storage needs a database connection (db_main.connect())
+def uses_database():
+    return storage != "files"
 
 # Creates the table which stores travel time data
 def create_travel_time_table():
+    if(storage == "arrays"):
+        return db_travel_time_arrays.create_tables()
+    if(storage == "files"):
+        return file_store.create()
     
     sql = """CREATE TABLE travel_times (
         begin_node_id BIGINT, 
@@ -30,6 +81,10 @@ def create_travel_time_table():
 
 # Drops the table that stores travel time data
 def drop_travel_time_table():
+    if(storage == "arrays"):
+        return db_travel_time_arrays.drop_tables()
+    if(storage == "files"):
+        return file_store.drop()
     try:
         db_main.execute("DROP TABLE travel_times;")
     except:
@@ -42,12 +97,20 @@ def drop_travel_time_table():
 # Params:
     # datetime - all travel time estimates with this time will be deleted
 def delete_travel_times(datetime):
+    if(storage == "arrays"):
+        return db_travel_time_arrays.delete_travel_times(datetime)
+    if(storage == "files"):
+        return file_store.delete_travel_times(datetime)
     sql = "DELETE FROM travel_times where datetime=%s;"
     db_main.execute(sql, (datetime,))
     db_main.commit()
 
 
 def get_travel_time_table_size():
+    if(storage == "arrays"):
+        return db_travel_time_arrays.get_table_size()
+    if(storage == "files"):
+        return file_store.get_size()
     sql = "SELECT pg_size_pretty(pg_total_relation_size('travel_times'));"
     cur = db_main.execute(sql)
     [size] = cur
@@ -55,6 +118,10 @@ def get_travel_time_table_size():
 
 # Returns a sorted list of datetimes where travel time information is available
 def get_available_dates():
+    if(storage == "arrays"):
+        return db_travel_time_arrays.get_available_dates()
+    if(storage == "files"):
+        return file_store.get_available_dates()
     sql = "SELECT DISTINCT datetime FROM travel_times ORDER BY datetime;"
     cur = db_main.execute(sql)
     dates = [date for (date,) in cur]
@@ -63,53 +130,47 @@ def get_available_dates():
 
 # Saves traffic conditions (link-by-link travel times) from a Map object into the
 # database.  If there are already travel times saved for the given time, they will
-# be overwritten.
+# be overwritten.  The old rows are deleted and the new ones are written with COPY,
+# in a single transaction.
 # Params:
     # road_map - a Map object, which contains the travel times on its Links
     # datetime - the time at which these traffic conditions occur
-def save_travel_times(road_map, datetime):
-    date_str = "'" + str(datetime) + "'"
-    
-    # First remove any existing travel times for the given datetime
-    delete_travel_times(datetime)  
-    
-    # Next, add one row with the default speed.  This will have nodes 0, 0
+    # binary - send the rows in the binary COPY format (see db_main.copy_columns()).
+        # Only used by the "rows" storage
+def save_travel_times(road_map, datetime, binary=False):
+    if(storage == "arrays"):
+        return db_travel_time_arrays.save_travel_times(road_map, datetime)
+    if(storage == "files"):
+        return file_store.save_travel_times(road_map, datetime)
+
+    links = [link for link in road_map.links if link.num_trips > 0]
+    begin_node_ids = [link.origin_node_id for link in links]
+    end_node_ids = [link.connecting_node_id for link in links]
+    travel_times = [link.time for link in links]
+    num_trips = [link.num_trips for link in links]
+
+    # First, add one row with the default speed.  This will have nodes 0, 0
     # The default speed will be saved in the travel time field
     default_speed = road_map.get_default_speed()
     if(default_speed!=None):
-        sql = "INSERT INTO travel_times VALUES(0, 0, %s, %f, 0);" % (date_str, default_speed)
-        db_main.execute(sql)
-    
-    
-    BULK_SIZE=5000
-    # Create a prepared statement
-    db_main.execute("PREPARE tt_plan (BIGINT, BIGINT, TIMESTAMP, REAL, INTEGER) AS "
-    "INSERT INTO travel_times VALUES($1, $2, $3, $4, $5);")
-    
-    sqls = []
-    
-    # Loop through the Links and create a bunch of EXECUTE statements
-    for link in road_map.links:
-        if(link.num_trips > 0):
-            sql = "EXECUTE tt_plan(%d, %d, %s, %f, %d);" % (
-                link.origin_node_id, link.connecting_node_id, date_str, link.time, link.num_trips)
-            sqls.append(sql)
-        if(len(sqls) >= BULK_SIZE):
-            # Concatenate EXECUTE statements and run them
-            final_sql = "\n".join(sqls)
-            sqls = []
-            db_main.execute(final_sql)
-            db_main.commit()
-    
-    # Run the last few EXECUTE statements if necessary
-    if(len(sqls) > 1):
-        final_sql = "\n".join(sqls)
-        db_main.execute(final_sql)
+        begin_node_ids.insert(0, 0)
+        end_node_ids.insert(0, 0)
+        travel_times.insert(0, default_speed)
+        num_trips.insert(0, 0)
+
+    columns = [("begin_node_id", "BIGINT", begin_node_ids),
+               ("end_node_id", "BIGINT", end_node_ids),
+               ("datetime", "TIMESTAMP", datetime),
+               ("travel_time", "REAL", travel_times),
+               ("num_trips", "INTEGER", num_trips)]
+    try:
+        # Remove any existing travel times for the given datetime, then add the new ones
+        db_main.execute("DELETE FROM travel_times where datetime=%s;", (datetime,))
+        db_main.copy_columns("travel_times", columns, binary)
         db_main.commit()
-    
-    # Clean up the prepared statement
-    db_main.execute("DEALLOCATE tt_plan;")
-    db_main.commit()
+    except:
+        db_main.rollback()
+        raise
 
 
 
@@ -122,6 +183,69 @@ def get_travel_times_cursor(datetime):
 
 
 
+# Loads the travel times of several hours at once into arrays, without touching the
+# Links of a Map.  The rows are read with a binary COPY, and matched to link_ids with
+# the sorted keys of ArrayGraph.get_link_ids()
+# Params:
+    # road_map - a Map object, whose link_ids index the columns of the result
+    # datetimes - a list of datetimes
+# Returns:
+    # times - a (len(datetimes) x number of links) array of travel times.  Links
+        # without a travel time in an hour get the default speed of that hour (see
+        # save_travel_times()), or NaN if there is none
+    # num_trips - a matching array with the number of trips on each link
+def load_travel_time_matrix(road_map, datetimes):
+    if(storage == "arrays"):
+        return db_travel_time_arrays.load_travel_time_matrix(road_map, datetimes)
+    if(storage == "files"):
+        return file_store.load_travel_time_matrix(road_map, datetimes)
+
+    graph = road_map.get_array_graph()
+    (unique_datetimes, inverse) = np.unique(np.asarray(datetimes, dtype="datetime64[us]"),
+                                            return_inverse=True)
+
+    sql = """SELECT begin_node_id, end_node_id, datetime, travel_time, num_trips
+        FROM travel_times WHERE datetime = ANY(%s)"""
+    (begin_node_ids, end_node_ids, row_datetimes, travel_times,
+     row_num_trips) = db_main.copy_query(sql, ["BIGINT", "BIGINT", "TIMESTAMP", "REAL", "INTEGER"],
+                                         (list(datetimes),))
+    hours = np.searchsorted(unique_datetimes, row_datetimes)
+
+    times = np.full((len(unique_datetimes), graph.num_links), np.nan)
+    num_trips = np.zeros((len(unique_datetimes), graph.num_links), dtype=np.int64)
+
+    # The row with nodes 0, 0 holds the default speed of its hour
+    is_default = (begin_node_ids == 0) & (end_node_ids == 0)
+    times[hours[is_default]] = (graph.link_lengths[np.newaxis, :] /
+                                travel_times[is_default, np.newaxis])
+
+    link_ids = graph.get_link_ids(begin_node_ids, end_node_ids)
+    found = (link_ids >= 0) & ~is_default
+    times[hours[found], link_ids[found]] = travel_times[found]
+    num_trips[hours[found], link_ids[found]] = row_num_trips[found]
+    return times[inverse], num_trips[inverse]
+
+
+# Loads the travel times of one hour into arrays.  See load_travel_time_matrix()
+# Returns:
+    # times - an array with the travel time of each link_id (NaN if unknown)
+    # num_trips - an array with the number of trips on each link_id
+def load_link_times(road_map, datetime):
+    (times, num_trips) = load_travel_time_matrix(road_map, [datetime])
+    return times[0], num_trips[0]
+
+
+# Sets Link.time, Link.speed and Link.num_trips from the arrays of load_link_times()
+# Links with a NaN time keep their old time
+def apply_link_times(road_map, times, num_trips):
+    for link, time, count in zip(road_map.links, times.tolist(), num_trips.tolist()):
+        link.num_trips = count
+        if(not isnan(time)):
+            link.time = time
+            if(count > 0):
+                link.speed = link.length / time
+
+
 # Loads traffic conditions (link-by-link travel times) from the database and applies them onto
 # of a Map object.  After this is called, Link.time, Link.speed, and Link.num_trips
 # will be set for every Link in the Map.
@@ -129,36 +253,8 @@ def get_travel_times_cursor(datetime):
     # road_map - a Map object, to be modified
     # datetime - Traffic conditions for this date/time will be loaded
 def load_travel_times(road_map, datetime):
-    
-      
-    
-    # Execute the query
-    cur = get_travel_times_cursor(datetime)
-    
-    for link in road_map.links:
-        link.num_trips = 0
-    
-    i = 0
-    # Iterate through the cursor returned by the query
-    for (begin_node_id, end_node_id, datetime, travel_time, num_trips) in cur:
-        
-        # If there is a default entry, it will be the first one
-        # Set all of the links using this entry
-        if(begin_node_id==0 and end_node_id==0):
-            # In this case, the travel_time field holds the speed
-            road_map.set_all_link_speeds(travel_time)
-                
-            
-        i += 1
-        # Find the appropriate Link in the road_map and set the relevant attributes
-        if((begin_node_id, end_node_id) in road_map.links_by_node_id):
-            link = road_map.links_by_node_id[begin_node_id, end_node_id]
-            link.time = travel_time
-            link.speed = link.length / travel_time
-            link.num_trips = num_trips
-    cur.close()
-    
-    #print("Loaded " + str(i) + " records.")
+    (times, num_trips) = load_link_times(road_map, datetime)
+    apply_link_times(road_map, times, num_trips)
 
 
 
@@ -177,18 +273,23 @@ def create_link_counts_table():
     
 
 
-def save_link_counts(count_dict):
-    sqls = []
-    for (begin_node_id, end_node_id) in count_dict:
-        count = count_dict[(begin_node_id, end_node_id)]
-        
-        sql = "INSERT INTO link_counts VALUES(%d,%d,%f);" % (
-            begin_node_id,end_node_id,count)
-        sqls.append(sql)
-    
-    db_main.execute("DELETE FROM link_counts;")
-    db_main.execute("\n".join(sqls))
-    db_main.commit()
+# Replaces the contents of the link_counts table.  Like save_travel_times(), the
+# rows are written with COPY, in the same transaction as the DELETE
+# Params:
+    # count_dict - maps (begin_node_id, end_node_id) to the average number of trips
+    # binary - send the rows in the binary COPY format (see db_main.copy_columns())
+def save_link_counts(count_dict, binary=False):
+    keys = list(count_dict)
+    columns = [("begin_node_id", "BIGINT", [begin_node_id for (begin_node_id, _) in keys]),
+               ("end_node_id", "BIGINT", [end_node_id for (_, end_node_id) in keys]),
+               ("avg_num_trips", "FLOAT", [count_dict[key] for key in keys])]
+    try:
+        db_main.execute("DELETE FROM link_counts;")
+        db_main.copy_columns("link_counts", columns, binary)
+        db_main.commit()
+    except:
+        db_main.rollback()
+        raise
 
 # Helper method, which 
 def get_link_counts_cursor():
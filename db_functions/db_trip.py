@@ -10,36 +10,173 @@ Created on Tuesday Jan 13 12:56:56 2015
 """
 
 import db_main
+import numpy as np
+from datetime import datetime, timedelta
 from traffic_estimation.Trip import Trip
 
 
+# The columns read by the columnar queries (see iter_trips()).  The times are read
+# as seconds since the epoch, so that every column is a float
+COLUMNAR_FIELDS = [("pickup_time", "EXTRACT(EPOCH FROM pickup_datetime)"),
+	("dropoff_time", "EXTRACT(EPOCH FROM dropoff_datetime)"),
+	("dist", "trip_distance"),
+	("fromLon", "pickup_longitude"),
+	("fromLat", "pickup_latitude"),
+	("toLon", "dropoff_longitude"),
+	("toLat", "dropoff_latitude")]
+
+# The conditions of each kind of query
+PICKUP_DT_CONDITION = "%s <= pickup_datetime AND pickup_datetime <= %s"
+DROPOFF_DT_CONDITION = "%s <= dropoff_datetime AND dropoff_datetime <= %s"
+DOW_HOD_CONDITION = "day_of_week = %s AND hours_of_day = %s"
+
+# The TripCache used by find_pickup_dt(), see set_trip_cache()
+trip_cache = None
+
+
+#Makes find_pickup_dt() read the trips of whole hours from a TripCache (see
+#db_trip_cache), which only queries the database for hours that aren't cached yet
+#Params:
+	#directory - the directory of the cache, or None to stop using it
+def set_trip_cache(directory):
+	global trip_cache
+	if(directory is None):
+		trip_cache = None
+	else:
+		from db_trip_cache import TripCache
+		trip_cache = TripCache(directory)
+
+
+#Streams trips from the database with a server-side cursor, so that memory use does
+#not depend on the number of trips
+#Params:
+	#condition - the WHERE clause of the query
+	#args - the arguments of the condition
+	#batch_size - the number of rows fetched from the server at a time
+	#columnar - if False, Trip objects are yielded one at a time.  If True, each batch
+		#is yielded as a dictionary which maps the names in COLUMNAR_FIELDS to numpy
+		#arrays of floats (NULL values become NaN)
+def iter_trips(condition, args, batch_size=10000, columnar=False):
+	for rows in iter_rows(condition, args, batch_size, columnar):
+		if(columnar):
+			yield make_columns(rows)
+		else:
+			for record in rows:
+				yield Trip(record)
+
+#Streams the rows of a trip query in batches, ordered by pickup_datetime.  See iter_trips()
+#Returns:
+	#a generator of lists of rows.  The rows are whole records, or the COLUMNAR_FIELDS
+	#if columnar is True
+def iter_rows(condition, args, batch_size=10000, columnar=False):
+	if(columnar):
+		fields = ", ".join(["%s::float8" % expression for (_, expression) in COLUMNAR_FIELDS])
+	else:
+		fields = "*"
+	SQL = "SELECT " + fields + " FROM trip WHERE " + condition + \
+		" ORDER BY pickup_datetime, dropoff_datetime"
+	return db_main.execute_batches(SQL, args, batch_size)
+
+#Turns rows of the COLUMNAR_FIELDS into a dictionary of float arrays (see iter_trips())
+def make_columns(rows):
+	values = np.array(rows, dtype=np.float64).reshape(len(rows), len(COLUMNAR_FIELDS))
+	return dict((name, values[:, i]) for i, (name, _) in enumerate(COLUMNAR_FIELDS))
+
+#Streams trips with pickup_datetime between two datetimes.  See iter_trips()
+def iter_pickup_dt(dt1, dt2, batch_size=10000, columnar=False):
+	return iter_trips(PICKUP_DT_CONDITION, (str(dt1), str(dt2)), batch_size, columnar)
+
+#Streams the trips of many hours, split by hour.  There is one query for each run of
+#consecutive hours, so a contiguous span of hours costs one round trip and one scan
+#of the pickup_datetime index, instead of one per hour.  The rows are split by hour
+#as they arrive.  Like find_pickup_dt(hour, hour + 1 hour), a trip which starts
+#exactly at the end of an hour is in that hour and in the next one
+#Params:
+	#hours - a list of datetimes at the start of hours, in increasing order.  They
+		#don't have to be consecutive
+	#batch_size - the number of rows fetched from the server at a time
+	#columnar - if False, the trips of an hour are a list of Trips.  If True, they are
+		#a dictionary of arrays, like the batches of iter_trips(columnar=True)
+#Returns:
+	#a generator of (hour, trips) for each of the hours, in order (also for hours
+	#without any trips)
+def iter_pickup_hours(hours, batch_size=10000, columnar=False):
+	for run in split_hour_runs(hours):
+		starts = epoch_seconds(run)
+		ends = starts + 3600
+		# The rows of each hour which is still open, from all of the batches so far
+		hour_rows = [[] for _ in run]
+		first_open = 0
+		for rows in iter_rows(PICKUP_DT_CONDITION, (str(run[0]), str(run[-1] + timedelta(hours=1))),
+				batch_size, columnar):
+			if(columnar):
+				pickup_times = np.array([row[0] for row in rows], dtype=np.float64)
+			else:
+				pickup_times = epoch_seconds([row[5] for row in rows])
+			lefts = np.searchsorted(pickup_times, starts, side='left')
+			rights = np.searchsorted(pickup_times, ends, side='right')
+			for i in xrange(first_open, len(run)):
+				if(starts[i] > pickup_times[-1]):
+					break
+				hour_rows[i].extend(rows[lefts[i]:rights[i]])
+
+			# The rows are in order, so an hour which ends before the last row is complete
+			while(first_open < len(run) and ends[first_open] < pickup_times[-1]):
+				yield run[first_open], _make_trips(hour_rows[first_open], columnar)
+				hour_rows[first_open] = None
+				first_open += 1
+
+		for i in xrange(first_open, len(run)):
+			yield run[i], _make_trips(hour_rows[i], columnar)
+			hour_rows[i] = None
+
+#Splits a list of hours into runs of consecutive hours (see iter_pickup_hours())
+def split_hour_runs(hours):
+	runs = []
+	for hour in hours:
+		if(hour.replace(minute=0, second=0, microsecond=0) != hour):
+			raise ValueError("Not the start of an hour: " + str(hour))
+		if(len(runs) > 0 and hour <= runs[-1][-1]):
+			raise ValueError("The hours must be in increasing order")
+		if(len(runs) > 0 and hour == runs[-1][-1] + timedelta(hours=1)):
+			runs[-1].append(hour)
+		else:
+			runs.append([hour])
+	return runs
+
+#Converts datetimes to seconds since the epoch, like the times of COLUMNAR_FIELDS
+def epoch_seconds(datetimes):
+	return np.array(datetimes, dtype='datetime64[us]').astype(np.int64) / 1e6
+
+#Turns the rows of an hour into Trips, or columns (see iter_pickup_hours())
+def _make_trips(rows, columnar):
+	if(columnar):
+		return make_columns(rows)
+	return [Trip(record) for record in rows]
+
+#Streams trips with dropoff_datetime between two datetimes.  See iter_trips()
+def iter_dropoff_dt(dt1, dt2, batch_size=10000, columnar=False):
+	return iter_trips(DROPOFF_DT_CONDITION, (str(dt1), str(dt2)), batch_size, columnar)
+
+#Streams trips with day_of_week and hours_of_day of interest.  See iter_trips()
+def iter_dow_hod(dow, hod, batch_size=10000, columnar=False):
+	return iter_trips(DOW_HOD_CONDITION, (dow, hod), batch_size, columnar)
+
+
 #Fetch trips from database with pickup_datetime between two datetimes
+#If a trip cache is set and the datetimes are the start and end of an hour, the
+#trips are read from the cache instead
 def find_pickup_dt(dt1, dt2):
-	SQL = """SELECT * FROM trip
-	WHERE %s <= pickup_datetime 
-	AND pickup_datetime <= %s
-	ORDER BY pickup_datetime, dropoff_datetime"""
-	cur = db_main.execute(SQL, (str(dt1), str(dt2)))
-	return [Trip(record) for record in cur]
+	if(trip_cache is not None and isinstance(dt1, datetime) and
+			dt1.replace(minute=0, second=0, microsecond=0) == dt1 and
+			dt2 == dt1 + timedelta(hours=1)):
+		return trip_cache.get_trips(dt1)
+	return list(iter_pickup_dt(dt1, dt2))
 	
 #Fetch trips from database with dropoff_datetime between two datetimes
 def find_dropoff_dt(dt1, dt2):
-	SQL = """SELECT * FROM trip
-	WHERE %s <= dropoff_datetime 
-	AND dropoff_datetime <= %s
-	ORDER BY pickup_datetime, dropoff_datetime"""
-	cur = db_main.execute(SQL, (str(dt1), str(dt2)))
-	return [Trip(record) for record in cur]
+	return list(iter_dropoff_dt(dt1, dt2))
 
 #Fetch trips from database with day_of_week and hours_of_day of interest
 def find_dow_hod(dow, hod):
-	SQL = """SELECT * FROM trip
-	WHERE day_of_week = %s
-	AND hours_of_day = %s
-	ORDER BY pickup_datetime, dropoff_datetime"""
-	cur = db_main.execute(SQL, (dow, hod))
-	return [Trip(record) for record in cur]
-			
-
-
-
+	return list(iter_dow_hod(dow, hod))
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Caches the trips of each pickup hour in local files, so that experiments which
+load the same hours again and again only query the trip table once.
+
+The trips of an hour are the ones of db_trip.iter_pickup_dt(hour, hour + 1 hour),
+so like find_pickup_dt(), a trip which starts exactly on the next hour is in both
+hours.  They are stored as a (len(COLUMNAR_FIELDS) x num_trips) float64 array,
+with one row per column of db_trip.COLUMNAR_FIELDS.  The files are loaded with
+mmap_mode='r', so reading many hours only touches the pages that are used, and
+processes on the same host share them through the OS page cache.
+
+The Nodes that the trips are snapped to can be cached as well, for each Map: the
+node_ids of the nearest Nodes to the pickup and dropoff of the trips which pass
+TripBatch.validate(), or -1 for the other trips and the trips outside of the Map.
+
+The files are kept in a subdirectory named after a fingerprint of the rules that
+produced them (the query and TripBatch.validate()).  When the rules change, a new
+subdirectory is used, so outdated files are never read.
+
+    directory/<fingerprint>/20120601_09.npy             - the trips of an hour
+    directory/<fingerprint>/20120601_09.<map key>.npy   - their (2 x num_trips) node_ids
+
+@author: brian
+"""
+from os import path, makedirs, rename, getpid, walk
+from shutil import rmtree
+import hashlib
+import inspect
+import numpy as np
+
+import db_trip
+from traffic_estimation.Trip import Trip
+from traffic_estimation.TripBatch import TripBatch
+
+# Must be incremented whenever the format of the files changes
+CACHE_VERSION = 1
+
+
+# Describes the rules which produce the cached trips and nodes.  Changing the
+# query or the thresholds of TripBatch.validate() changes the fingerprint
+def get_fingerprint():
+    rules = [str(CACHE_VERSION), repr(db_trip.COLUMNAR_FIELDS), db_trip.PICKUP_DT_CONDITION,
+             inspect.getsource(TripBatch.validate)]
+    return hashlib.md5("\n".join(rules)).hexdigest()[:16]
+
+# Describes the Nodes of a Map, which decide where the trips are snapped to
+def get_map_key(road_map):
+    graph = road_map.get_array_graph()
+    bbox = np.array([road_map.min_lat, road_map.max_lat, road_map.min_lon, road_map.max_lon])
+    data = (graph.node_ids.tostring() + graph.node_x.tostring() + graph.node_y.tostring() +
+            bbox.tostring())
+    return hashlib.md5(data).hexdigest()[:16]
+
+
+class TripCache:
+    # Params:
+        # directory - where the files are kept
+    def __init__(self, directory):
+        self.root = directory
+        self.directory = path.join(directory, get_fingerprint())
+
+    def _hour_path(self, hour, map_key=None):
+        filename = hour.strftime("%Y%m%d_%H")
+        if(map_key is not None):
+            filename += "." + map_key
+        return path.join(self.directory, filename + ".npy")
+
+    # Saves an array under a temporary name and then renames it, so that other
+    # processes never read a partial file
+    def _save(self, filename, array):
+        if(not path.isdir(self.directory)):
+            try:
+                makedirs(self.directory)
+            except OSError:
+                # Another process may have created it first
+                if(not path.isdir(self.directory)):
+                    raise
+        temp_filename = "%s.%d.tmp" % (filename, getpid())
+        with open(temp_filename, "wb") as f:
+            np.save(f, array)
+        rename(temp_filename, filename)
+
+    # Queries the trip table for the hours which aren't cached yet, and caches them.
+    # Consecutive hours are read with one query (see db_trip.iter_pickup_hours()).
+    # This needs a database connection, see db_main.connect()
+    # Params:
+        # hours - a list of datetimes at the start of hours
+    def fill(self, hours):
+        missing = sorted(set([hour for hour in hours if not path.exists(self._hour_path(hour))]))
+        for (hour, columns) in db_trip.iter_pickup_hours(missing, columnar=True):
+            self._save(self._hour_path(hour),
+                       np.array([columns[name] for (name, _) in db_trip.COLUMNAR_FIELDS]))
+
+    # Returns the trips of an hour, querying the trip table if they aren't cached yet
+    # (see fill())
+    # Params:
+        # hour - a datetime at the start of an hour
+    # Returns:
+        # a memory mapped (len(db_trip.COLUMNAR_FIELDS) x num_trips) array
+    def get_columns(self, hour):
+        if(hour.minute != 0 or hour.second != 0 or hour.microsecond != 0):
+            raise ValueError("Trips are cached by hour, not for " + str(hour))
+        filename = self._hour_path(hour)
+        if(not path.exists(filename)):
+            self.fill([hour])
+        return np.load(filename, mmap_mode="r")
+
+    # Returns the trips of an hour as a TripBatch (see get_columns())
+    def get_batch(self, hour):
+        columns = self.get_columns(hour)
+        return TripBatch.from_columns(dict((name, columns[i]) for i, (name, _)
+                                           in enumerate(db_trip.COLUMNAR_FIELDS)))
+
+    # Returns the trips of an hour as Trip objects, like db_trip.find_pickup_dt()
+    def get_trips(self, hour):
+        batch = self.get_batch(hour)
+        return batch.to_trips(np.arange(batch.num_trips))
+
+    # Returns the Nodes of a Map that the trips of an hour are snapped to, snapping
+    # and caching them if necessary
+    # Params:
+        # hour - a datetime at the start of an hour
+        # road_map - a Map object
+        # batch - the TripBatch of the hour, if it has already been loaded
+        # map_key - the result of get_map_key(road_map), if it is already known
+    # Returns:
+        # a memory mapped (2 x num_trips) array with the node_ids of the origins and
+        # destinations.  Both are -1 for invalid trips and trips outside of the Map
+    def get_node_ids(self, hour, road_map, batch=None, map_key=None):
+        if(map_key is None):
+            map_key = get_map_key(road_map)
+        filename = self._hour_path(hour, map_key)
+        if(not path.exists(filename)):
+            if(batch is None):
+                batch = self.get_batch(hour)
+            valid = np.nonzero(batch.validate() == Trip.VALID)[0]
+            origins = road_map.get_nearest_node_ids(batch.fromLat[valid], batch.fromLon[valid])
+            dests = road_map.get_nearest_node_ids(batch.toLat[valid], batch.toLon[valid])
+            found = (origins >= 0) & (dests >= 0)
+            node_ids = np.full((2, batch.num_trips), -1, dtype=np.int64)
+            node_ids[0, valid[found]] = origins[found]
+            node_ids[1, valid[found]] = dests[found]
+            self._save(filename, node_ids)
+        return np.load(filename, mmap_mode="r")
+
+    # Reads the trips of many hours, in order
+    # Params:
+        # hours - a list of datetimes at the start of hours
+        # road_map - if given, the origin_node_ids and dest_node_ids of the batches
+            # are set from get_node_ids(), so that Map.match_trip_batches() doesn't
+            # have to validate and snap the trips again
+    # Returns:
+        # a generator of TripBatches, one per hour
+    def iter_batches(self, hours, road_map=None):
+        self.fill(hours)
+        map_key = None
+        if(road_map is not None):
+            map_key = get_map_key(road_map)
+        for hour in hours:
+            batch = self.get_batch(hour)
+            if(road_map is not None):
+                node_ids = self.get_node_ids(hour, road_map, batch, map_key)
+                (batch.origin_node_ids, batch.dest_node_ids) = node_ids
+            yield batch
+
+    # Removes all of the cached files, including the ones of outdated fingerprints
+    def clear(self):
+        rmtree(self.root, ignore_errors=True)
+
+    # Returns the total size of the files, as text
+    def get_size(self):
+        size = 0
+        for (dirpath, _, filenames) in walk(self.root):
+            size += sum([path.getsize(path.join(dirpath, name)) for name in filenames])
+        return "%d MB" % (size // 1000000)
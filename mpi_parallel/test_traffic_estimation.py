@@ -5,6 +5,8 @@ Created on Sat Jan 17 14:39:21 2015
 @author: brian
 """
 from datetime import datetime, timedelta
+from threading import Thread, Event
+from Queue import Queue
 
 from mpi4py import MPI
 
@@ -18,41 +20,125 @@ from LoadBalancedProcessTree import LoadBalancedProcessTree
 
 approx_job_size = {}
 
-# Runs the traffic estimation for a one hour slice of time, and saves the results
+# The number of consecutive hours in each job of the LoadBalancedProcessTree
+HOURS_PER_JOB = 24
+# The number of hours of trips that are loaded ahead of the estimation, and the
+# number of estimates that can wait to be saved.  Each waiting hour holds its trips
+# or a copy of the link times in memory
+PIPELINE_DEPTH = 2
+
+# Marks the end of the items in a pipeline Queue
+_END = None
+
+# Loads the trips of each hour and puts them into a Queue, in order.  Runs in its
+# own thread, with its own database connection.  The trips of all of the hours are
+# streamed by one query (see db_trip.iter_pickup_hours()), which waits while the
+# Queue is full.  If the query fails, it reconnects and starts again from the
+# first hour which hasn't been put into the Queue.  An hour which fails twice in a
+# row is skipped, and reported so that it can be run again
+# Params:
+    # hours - a list of datetimes
+    # trip_queue - receives (hour, trips, load time) for each hour, then _END
+    # stop - an Event, which is set when run_chunk() doesn't need any more trips
+def fetch_trips(hours, trip_queue, stop):
+    next_hour = 0
+    failed_hour = None
+    try:
+        while(next_hour < len(hours) and not stop.is_set()):
+            try:
+                with db_main.connected("db_functions/database.conf", retry_interval=10):
+                    t1 = datetime.now()
+                    for (time, trips) in db_trip.iter_pickup_hours(hours[next_hour:]):
+                        trip_queue.put((time, trips, datetime.now() - t1))
+                        next_hour += 1
+                        if(stop.is_set()):
+                            return
+                        t1 = datetime.now()
+            except Exception as e:
+                if(next_hour == len(hours)):
+                    # All of the trips were loaded before the error
+                    break
+                print("Failed to load trips for %s : %s" % (str(hours[next_hour]), e))
+                if(failed_hour == next_hour):
+                    print("Skipped %s : its trips could not be loaded" % str(hours[next_hour]))
+                    next_hour += 1
+                    failed_hour = None
+                else:
+                    failed_hour = next_hour
+    finally:
+        trip_queue.put(_END)
+
+# Saves the link times that are put into a Queue.  Runs in its own thread, with its
+# own database connection
+# Params:
+    # save_queue - gives (hour, Map with the link times of that hour), until _END
+def save_estimates(save_queue):
+    try:
+        with db_main.connected("db_functions/database.conf", retry_interval=10):
+            for (time, road_map) in iter(save_queue.get, _END):
+                t1 = datetime.now()
+                try:
+                    db_travel_times.save_travel_times(road_map, time)
+                    print("Saved travel times for %s after %s" % (str(time), str(datetime.now() - t1)))
+                except Exception as e:
+                    print("Failed to save travel times for %s : %s" % (str(time), e))
+    except Exception as e:
+        print("Failed to save travel times : %s" % e)
+        # Keep emptying the Queue, so that run_chunk() doesn't wait forever
+        for _ in iter(save_queue.get, _END):
+            pass
+
+# Runs the traffic estimation for a block of one hour slices of time, and saves the results
 # into the database.  This is the function that will be "mapped" by the LoadBalancedProcessTree.
+# The hours go through a pipeline: while one hour is being estimated, the trips of
+# the next hours are loaded by one thread, and the results of the previous hours are
+# saved by another.  The Queues between them are bounded, so neither thread gets
+# more than PIPELINE_DEPTH hours ahead of the estimation
 # Params:
     # road_map - a Map object which should already be flattened
-    # time - a datetime object representing the starting time of the time slice to be estimated
-def run_chunk(road_map, time):
+    # hours - a list of datetimes, representing the starting times of the time slices to be estimated
+def run_chunk(road_map, hours):
+    print (str(datetime.now()) + " : Analysing " + str(hours[0]) + " - " + str(hours[-1]))
+    road_map.unflatten()
+
+    trip_queue = Queue(maxsize=PIPELINE_DEPTH)
+    save_queue = Queue(maxsize=PIPELINE_DEPTH)
+    stop_fetching = Event()
+    fetcher = Thread(target=fetch_trips, args=(hours, trip_queue, stop_fetching))
+    writer = Thread(target=save_estimates, args=(save_queue,))
+    # Don't keep a failed worker alive
+    fetcher.daemon = writer.daemon = True
+    fetcher.start()
+    writer.start()
+
+    fetched_all = False
     try:
-        print("Connecting to db")
-        db_main.connect("db_functions/database.conf", retry_interval=10)
-        
-        print (str(datetime.now()) + " : Analysing " + str(time))
-        road_map.unflatten()
-    
-        t1 = datetime.now()    
-        trips = db_trip.find_pickup_dt(time, time + timedelta(hours=1))
-        t2 = datetime.now()
-        db_main.close()
-        print ("Loaded " + str(len(trips)) + " trips after " + str(t2 - t1))
-        
-    
-    
-        estimate_travel_times(road_map, trips, max_iter=20, test_set=None,
-                              distance_weighting=None, model_idle_time=False, initial_idle_time=0)
-        t3 = datetime.now()    
-        print (str(t3) + " : Finished estimating traffic for " + str(time) + " after " + str(t3-t2))
-    
-        db_main.connect("db_functions/database.conf", retry_interval=10)
-        t1 = datetime.now()
-        db_travel_times.save_travel_times(road_map, time)
-        t2 = datetime.now()
-        print("Saved travel times after " + str(t2 - t1))
-        db_main.close()
-    except Exception as e:
-        print("Failed to estimate traffic for %s : %s" % (str(time), e.message))
-        
+        for (time, trips, load_time) in iter(trip_queue.get, _END):
+            print ("Loaded " + str(len(trips)) + " trips for " + str(time) + " after " + str(load_time))
+            try:
+                t2 = datetime.now()
+                estimate_travel_times(road_map, trips, max_iter=20, test_set=None,
+                                      distance_weighting=None, model_idle_time=False, initial_idle_time=0)
+                t3 = datetime.now()
+                print (str(t3) + " : Finished estimating traffic for " + str(time) + " after " + str(t3-t2))
+            except Exception as e:
+                print("Failed to estimate traffic for %s : %s" % (str(time), e))
+                continue
+            # The next hour changes the link times of road_map, so a copy is saved
+            save_queue.put((time, road_map.copy_link_times()))
+        fetched_all = True
+    finally:
+        # If the estimation stopped early, the fetcher may be waiting to put trips
+        # into the Queue.  It is stopped and the Queue emptied, so that it closes its
+        # query and connection instead of waiting forever
+        stop_fetching.set()
+        if(not fetched_all):
+            for _ in iter(trip_queue.get, _END):
+                pass
+        fetcher.join()
+        save_queue.put(_END)
+        writer.join()
+
 # An iterator function which returns intermediate dates between two datetimes
 # Params:
         # start_date - the start date
@@ -88,6 +174,10 @@ def job_size(d):
     global approx_job_size
     return approx_job_size[d.weekday(), d.hour]
 
+# Approximates the size of a job with several hours (see run_chunk())
+def block_size(hours):
+    return sum(job_size(d) for d in hours)
+
 
 
 #Uses a LoadBalancedProcessTree to compute a lot of traffic estimates in parallel.
@@ -115,10 +205,13 @@ def run_test():
         approximate_job_sizes()
 
             
-        print("Preparing to run %d dates." % len(datelist))
+        # Each job is a block of consecutive hours, so that run_chunk() can load the
+        # next hours while it estimates the current one
+        blocks = [datelist[i:i + HOURS_PER_JOB] for i in xrange(0, len(datelist), HOURS_PER_JOB)]
+        print("Preparing to run %d dates in %d jobs." % (len(datelist), len(blocks)))
         
         
-        t.map(run_chunk, road_map, datelist, job_size)
+        t.map(run_chunk, road_map, blocks, block_size)
         t.close()
         
         d2 = datetime.now()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Computes arc flags on an ArrayGraph.
+
+The graph is split into regions (see Map.assign_node_regions()).  A link gets its
+forward flag for region R if it lies on a shortest path to some node in R, and its
+backward flag for region R if it lies on a shortest path from some node in R.
+A search towards a destination in region R only needs to follow links whose
+forward flag for R is set (and the backward search from that destination only
+needs links whose backward flag for the origin's region is set).
+
+Shortest paths into R must enter it through one of its entry nodes (nodes in R with
+an incoming link from outside R), so the forward flags of R are the links inside R,
+plus the links on the shortest path trees towards each entry node.  The backward
+flags are computed the same way, using trees away from the exit nodes of R.
+Regions are independent of each other, so they are processed in parallel.
+
+The flags of each link are packed into a Python integer - bit r is the flag for
+region r.
+
+Note that arc flags only hold for the travel times they were computed with.  If
+the times change, the flags must be recomputed.
+
+@author: brian
+"""
+from heapq import heappush, heappop
+from binascii import hexlify
+from multiprocessing import Pool
+import numpy as np
+
+# Two paths whose times differ by less than this are considered equally short.
+# Setting a few extra flags never breaks the search, but missing one would
+TIME_TOLERANCE = 1e-6
+
+
+# Runs a full Dijkstra search from one node
+# Params:
+    # source - the node index where the search starts
+    # offsets, neighbors, link_ids - a CSR adjacency structure (forward or backward)
+    # link_times - the travel time of each link
+# Returns:
+    # a numpy array with the time from the source to every node (inf if unreachable)
+def dijkstra_times(source, offsets, neighbors, link_ids, link_times):
+    times = [float('inf')] * (len(offsets) - 1)
+    times[source] = 0.0
+    pq = [(0.0, source)]
+    while(pq):
+        (node_time, node) = heappop(pq)
+        if(node_time > times[node]):
+            continue
+        for k in xrange(offsets[node], offsets[node + 1]):
+            neighbor = neighbors[k]
+            proposed_time = node_time + link_times[link_ids[k]]
+            if(proposed_time < times[neighbor]):
+                times[neighbor] = proposed_time
+                heappush(pq, (proposed_time, neighbor))
+    return np.array(times)
+
+
+# Holds the graph of a worker process, so it is only sent once per process
+_worker_state = {}
+
+
+# Pool initializer - stores the graph and regions in the worker process
+def _init_worker(graph, node_regions):
+    _worker_state['graph'] = graph
+    _worker_state['node_regions'] = node_regions
+    _worker_state['lists'] = (graph.forward_offsets.tolist(),
+                              graph.forward_targets.tolist(),
+                              graph.forward_link_ids.tolist(),
+                              graph.backward_offsets.tolist(),
+                              graph.backward_sources.tolist(),
+                              graph.backward_link_ids.tolist(),
+                              graph.link_times.tolist())
+
+
+# Pool task - computes the flags of one region in the worker process
+def _region_task(region_id):
+    return (region_id,) + compute_region_flags(_worker_state['graph'],
+                                               _worker_state['node_regions'],
+                                               region_id,
+                                               _worker_state['lists'])
+
+
+# Computes the forward and backward arc flags of one region
+# Params:
+    # graph - the ArrayGraph
+    # node_regions - a numpy array with the region id of each node index
+    # region_id - the region to compute flags for
+    # lists - optional list copies of the CSR arrays and link times, as made by
+        # _init_worker().  Saves converting them for every region
+# Returns:
+    # forward_link_ids - numpy array of the links whose forward flag is set
+    # backward_link_ids - numpy array of the links whose backward flag is set
+def compute_region_flags(graph, node_regions, region_id, lists=None):
+    if(lists is None):
+        _init_worker(graph, node_regions)
+        lists = _worker_state['lists']
+    (forward_offsets, forward_targets, forward_link_ids,
+     backward_offsets, backward_sources, backward_link_ids,
+     link_times) = lists
+
+    # Only consider links which are part of the graph
+    link_ids = np.nonzero(np.logical_and(graph.link_origins >= 0,
+                                         graph.link_destinations >= 0))[0]
+    origins = graph.link_origins[link_ids]
+    destinations = graph.link_destinations[link_ids]
+    times = graph.link_times[link_ids]
+
+    origin_inside = node_regions[origins] == region_id
+    destination_inside = node_regions[destinations] == region_id
+
+    # Links inside the region are always needed
+    forward = np.logical_and(origin_inside, destination_inside)
+    backward = forward.copy()
+
+    # Entry nodes - trees of shortest paths towards them (on the backward graph)
+    entry_nodes = np.unique(destinations[np.logical_and(destination_inside,
+                                                        ~origin_inside)])
+    for entry_node in entry_nodes.tolist():
+        to_entry = dijkstra_times(entry_node, backward_offsets, backward_sources,
+                                  backward_link_ids, link_times)
+        origin_times = to_entry[origins]
+        forward |= np.logical_and(
+            np.isfinite(origin_times),
+            times + to_entry[destinations] <= origin_times + TIME_TOLERANCE)
+
+    # Exit nodes - trees of shortest paths away from them (on the forward graph)
+    exit_nodes = np.unique(origins[np.logical_and(origin_inside,
+                                                  ~destination_inside)])
+    for exit_node in exit_nodes.tolist():
+        from_exit = dijkstra_times(exit_node, forward_offsets, forward_targets,
+                                   forward_link_ids, link_times)
+        destination_times = from_exit[destinations]
+        backward |= np.logical_and(
+            np.isfinite(destination_times),
+            from_exit[origins] + times <= destination_times + TIME_TOLERANCE)
+
+    return (link_ids[forward], link_ids[backward])
+
+
+# Converts rows of a bit matrix (bit r of row i = flag of link i for region r)
+# into one Python integer per row
+def _pack_rows(bits):
+    # The bytes are little-endian, hexlify wants the most significant one first
+    return [int(hexlify(row[::-1].tostring()), 16) if row.any() else 0
+            for row in bits]
+
+
+# Computes the arc flags of all regions
+# Params:
+    # graph - the ArrayGraph, with up-to-date link times
+    # node_regions - an array-like with the region id (0 to num_regions-1) of each node index
+    # num_regions - the total number of regions
+    # num_processes - the number of worker processes to use.  1 means no parallelism
+# Returns:
+    # forward_flags - a list with the packed forward flags of each link id
+    # backward_flags - a list with the packed backward flags of each link id
+def compute_arcflags(graph, node_regions, num_regions, num_processes=1):
+    node_regions = np.asarray(node_regions, dtype=np.int32)
+    num_bytes = (num_regions + 7) // 8
+    forward_bits = np.zeros((graph.num_links, num_bytes), dtype=np.uint8)
+    backward_bits = np.zeros((graph.num_links, num_bytes), dtype=np.uint8)
+
+    def record(region_id, forward_ids, backward_ids):
+        mask = np.uint8(1 << (region_id % 8))
+        forward_bits[forward_ids, region_id // 8] |= mask
+        backward_bits[backward_ids, region_id // 8] |= mask
+
+    if(num_processes <= 1):
+        _init_worker(graph, node_regions)
+        for region_id in xrange(num_regions):
+            record(*_region_task(region_id))
+    else:
+        pool = Pool(num_processes, initializer=_init_worker,
+                    initargs=(graph, node_regions))
+        try:
+            for result in pool.imap_unordered(_region_task, xrange(num_regions)):
+                record(*result)
+        finally:
+            pool.close()
+            pool.join()
+
+    return (_pack_rows(forward_bits), _pack_rows(backward_bits))
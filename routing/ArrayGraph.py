@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+A compact, array-backed form of the road graph stored in a Map object.
+
+Nodes are addressed by dense integer indices (their position in Map.nodes) and
+Links by their link_id (their position in Map.links).  The forward and backward
+adjacency lists are stored in CSR (compressed sparse row) form, so the
+neighbors of node i on the forward graph are
+    forward_targets[forward_offsets[i]:forward_offsets[i+1]]
+reached via the links
+    forward_link_ids[forward_offsets[i]:forward_offsets[i+1]]
+Per-link attributes (length, travel time, endpoints) live in contiguous arrays
+indexed by link_id.  This takes a fraction of the memory of the Node/Link object
+graph, and lets search code work on integers instead of attribute lookups.
+
+@author: brian
+"""
+import hashlib
+import numpy as np
+
+
+class ArrayGraph:
+    # Params:
+        # node_ids - the original (OSM) node_id of each node index
+        # node_x, node_y - coordinates of each node, in meters (see Node.location)
+        # forward_offsets, forward_targets, forward_link_ids - CSR forward graph
+        # backward_offsets, backward_sources, backward_link_ids - CSR backward graph
+        # link_origins, link_destinations - node index at each end of a Link.
+            # -1 if the Link is not part of the graph (e.g. the idle link)
+        # link_lengths - length of each Link, in meters
+        # link_times - travel time of each Link, in seconds
+    def __init__(self, node_ids, node_x, node_y,
+                 forward_offsets, forward_targets, forward_link_ids,
+                 backward_offsets, backward_sources, backward_link_ids,
+                 link_origins, link_destinations, link_lengths, link_times):
+        self.node_ids = node_ids
+        self.node_x = node_x
+        self.node_y = node_y
+
+        self.forward_offsets = forward_offsets
+        self.forward_targets = forward_targets
+        self.forward_link_ids = forward_link_ids
+
+        self.backward_offsets = backward_offsets
+        self.backward_sources = backward_sources
+        self.backward_link_ids = backward_link_ids
+
+        self.link_origins = link_origins
+        self.link_destinations = link_destinations
+        self.link_lengths = link_lengths
+        self.link_times = link_times
+
+        self.num_nodes = len(node_ids)
+        self.num_links = len(link_lengths)
+
+        # Maps OSM node_ids to node indices
+        self.index_by_node_id = dict((node_id, i) for i, node_id
+                                     in enumerate(node_ids.tolist()))
+
+        # Incremented whenever the link times change, so that anything derived
+        # from them (e.g. search heuristics) knows when it is out of date
+        self.time_version = 0
+
+        # Optional arc flags (see ArcFlagsBuilder), set by set_arcflags()
+        self.node_regions = None
+        self.forward_arcflags = None
+        self.backward_arcflags = None
+        # The checksum of the link times the arc flags were computed with, and
+        # whether it matched the link times of arcflags_time_version
+        self.arcflags_checksum = None
+        self.arcflags_time_version = None
+        self.arcflags_current = False
+
+        # Sorted keys for looking up many links at once, built by get_link_ids()
+        self.node_order = None
+        self.sorted_node_ids = None
+        self.sorted_link_ids = None
+        self.sorted_link_keys = None
+
+    # Returns the dense node index of a Node object (or an OSM node_id)
+    def get_node_index(self, node):
+        if(isinstance(node, (int, long))):
+            return self.index_by_node_id[node]
+        return self.index_by_node_id[node.node_id]
+
+    # Finds the dense node index of many OSM node_ids at once
+    # Returns:
+        # an array of node indices, -1 for node_ids that aren't in the graph
+    def get_node_indices(self, node_ids):
+        if(self.sorted_node_ids is None):
+            self.node_order = np.argsort(self.node_ids, kind='mergesort')
+            self.sorted_node_ids = self.node_ids[self.node_order]
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        positions = np.searchsorted(self.sorted_node_ids, node_ids)
+        positions = np.minimum(positions, self.num_nodes - 1)
+        return np.where(self.sorted_node_ids[positions] == node_ids,
+                        self.node_order[positions], -1)
+
+    # Finds the link_ids of many links at once, from the OSM node_ids at their ends.
+    # Each (begin, end) pair is turned into a key, which is looked up in a sorted
+    # array of the keys of all links
+    # Params:
+        # begin_node_ids, end_node_ids - array-likes of node_ids
+    # Returns:
+        # an array of link_ids, -1 for pairs which aren't linked in the graph.  Like
+        # Map.links_by_node_id, if two links have the same ends the last one is found
+    def get_link_ids(self, begin_node_ids, end_node_ids):
+        if(self.sorted_link_keys is None):
+            link_ids = np.nonzero(self.link_origins >= 0)[0]
+            keys = (self.link_origins[link_ids].astype(np.int64) * self.num_nodes +
+                    self.link_destinations[link_ids])
+            order = np.argsort(keys, kind='mergesort')
+            self.sorted_link_keys = keys[order]
+            self.sorted_link_ids = link_ids[order]
+
+        origins = self.get_node_indices(begin_node_ids)
+        destinations = self.get_node_indices(end_node_ids)
+        if(len(self.sorted_link_keys) == 0):
+            return np.full(len(origins), -1, dtype=np.int64)
+        keys = origins * self.num_nodes + destinations
+        positions = np.searchsorted(self.sorted_link_keys, keys, side='right') - 1
+        positions = np.maximum(positions, 0)
+        found = ((origins >= 0) & (destinations >= 0) &
+                 (self.sorted_link_keys[positions] == keys))
+        return np.where(found, self.sorted_link_ids[positions], -1)
+
+    # Copies the current travel times of the Link objects into link_times
+    # Params:
+        # links - a list of Links, in link_id order (i.e. Map.links)
+    def update_link_times(self, links):
+        self.set_link_times([link.time for link in links])
+
+    # Replaces the travel times of all links at once
+    # Params:
+        # times - an array-like of travel times, in link_id order
+    def set_link_times(self, times):
+        self.link_times[:] = times
+        self.time_version += 1
+
+    # Returns a checksum of the current link times, which identifies the times that
+    # arc flags were computed with
+    def get_times_checksum(self):
+        times = np.ascontiguousarray(self.link_times, dtype=np.float64)
+        return hashlib.md5(times.tostring()).hexdigest()
+
+    # Attaches arc flags to the graph, so searches can use them
+    # Params:
+        # node_regions - a list with the region id of each node index
+        # forward_arcflags, backward_arcflags - lists with the packed flags of
+            # each link id (bit r is the flag for region r)
+        # times_checksum - get_times_checksum() of the link times the flags were
+            # computed with.  If None, they were computed with the current times
+    def set_arcflags(self, node_regions, forward_arcflags, backward_arcflags,
+                     times_checksum=None):
+        self.node_regions = list(node_regions)
+        self.forward_arcflags = list(forward_arcflags)
+        self.backward_arcflags = list(backward_arcflags)
+        if(times_checksum is None):
+            times_checksum = self.get_times_checksum()
+        self.arcflags_checksum = times_checksum
+        # Compared with the link times by the next arcflags_match_times()
+        self.arcflags_time_version = None
+
+    # Tells whether the arc flags were computed with the current link times.  Flags
+    # for other times can prune links of the shortest path, so searches must not use
+    # them.  The times are only compared again when time_version changes
+    def arcflags_match_times(self):
+        if(self.forward_arcflags is None):
+            return False
+        if(self.arcflags_time_version != self.time_version):
+            self.arcflags_time_version = self.time_version
+            self.arcflags_current = (self.get_times_checksum() == self.arcflags_checksum)
+            if(not self.arcflags_current):
+                print("Warning: the arc flags were computed with other link times.  "
+                      "Searching without them until they are recomputed")
+        return self.arcflags_current
+
+    # Returns the total number of bytes used by the arrays of this graph
+    def nbytes(self):
+        arrays = [self.node_ids, self.node_x, self.node_y,
+                  self.forward_offsets, self.forward_targets,
+                  self.forward_link_ids, self.backward_offsets,
+                  self.backward_sources, self.backward_link_ids,
+                  self.link_origins, self.link_destinations,
+                  self.link_lengths, self.link_times]
+        return sum(a.nbytes for a in arrays)
+
+
+# Builds CSR offsets and column arrays from a list of (row, col, link_id) triples
+# Params:
+    # num_rows - the number of nodes
+    # rows - node index of the node whose adjacency list contains each entry
+    # cols - node index at the other end of each entry
+    # link_ids - the link_id of each entry
+# Returns:
+    # offsets, cols, link_ids - sorted by row
+def build_csr(num_rows, rows, cols, link_ids):
+    # A stable sort keeps the links in their original adjacency list order
+    order = np.argsort(rows, kind='mergesort')
+    counts = np.bincount(rows, minlength=num_rows)
+    offsets = np.zeros(num_rows + 1, dtype=np.int32)
+    np.cumsum(counts, out=offsets[1:])
+    return (offsets, cols[order].astype(np.int32),
+            link_ids[order].astype(np.int32))
+
+
+# Builds an ArrayGraph from the Nodes and Links of a Map
+# Only Links between two Nodes in the list are included in the adjacency arrays.
+# Params:
+    # nodes - a list of Node objects (i.e. Map.nodes).  Their position in this list
+        # becomes their node index
+    # links - a list of Link objects, in link_id order (i.e. Map.links)
+# Returns:
+    # an ArrayGraph
+def build_array_graph(nodes, links):
+    num_nodes = len(nodes)
+    node_ids = np.array([node.node_id for node in nodes], dtype=np.int64)
+    node_x = np.array([node.location[0] for node in nodes], dtype=np.float64)
+    node_y = np.array([node.location[1] for node in nodes], dtype=np.float64)
+
+    index_by_node_id = dict((node.node_id, i) for i, node in enumerate(nodes))
+
+    num_links = len(links)
+    link_origins = np.empty(num_links, dtype=np.int32)
+    link_destinations = np.empty(num_links, dtype=np.int32)
+    link_lengths = np.empty(num_links, dtype=np.float64)
+    link_times = np.empty(num_links, dtype=np.float64)
+
+    for link in links:
+        i = link.link_id
+        link_origins[i] = index_by_node_id.get(link.origin_node_id, -1)
+        link_destinations[i] = index_by_node_id.get(link.connecting_node_id, -1)
+        link_lengths[i] = link.length
+        link_times[i] = link.time
+
+    # Only links whose endpoints both survived are part of the graph
+    in_graph = np.logical_and(link_origins >= 0, link_destinations >= 0)
+    link_ids = np.nonzero(in_graph)[0]
+    origins = link_origins[link_ids]
+    destinations = link_destinations[link_ids]
+
+    (forward_offsets,
+     forward_targets,
+     forward_link_ids) = build_csr(num_nodes, origins, destinations, link_ids)
+    (backward_offsets,
+     backward_sources,
+     backward_link_ids) = build_csr(num_nodes, destinations, origins, link_ids)
+
+    return ArrayGraph(node_ids, node_x, node_y,
+                      forward_offsets, forward_targets, forward_link_ids,
+                      backward_offsets, backward_sources, backward_link_ids,
+                      link_origins, link_destinations, link_lengths, link_times)
@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+"""
+An array-backed KD-Tree for batch nearest neighbor queries on 2D points.
+
+The points are split at the median of their widest dimension (found with
+np.argpartition, which takes linear time, instead of sorting at every level)
+until at most leaf_size points are left.  The tree is stored as flat arrays
+(children, split values and bounding box of every tree node), and the points of
+each leaf are stored in padded (num_leaves x leaf_size) arrays.
+
+Queries are answered for a whole block of points at once, with numpy operations
+instead of Python code per query point:
+    1) all query points descend the tree together, one level per step, to the
+       leaf they fall in.  Its nearest point gives an upper bound on the distance
+    2) the tree is searched again from the root, level by level, on (query, tree
+       node) pairs.  Pairs whose bounding box is farther than the bound are
+       dropped, and the leaves that remain are checked
+k-nearest and radius queries use the same two steps, with the k-th best distance
+or the radius as the bound.  See SpatialIndex for the interface.
+
+@author: brian
+"""
+import numpy as np
+
+from SpatialIndex import merge_k_best, group_by_query
+
+# The number of query points handled at once
+BLOCK_SIZE = 8192
+
+
+class ArrayKDTree:
+    # Params:
+        # points - an (N x 2) array-like of point coordinates
+        # leaf_size - the maximum number of points in a leaf
+    def __init__(self, points, leaf_size=16):
+        points = np.asarray(points, dtype=np.float64)
+        num_points = len(points)
+        self.leaf_size = leaf_size
+
+        # perm holds the point indices, and each tree node is a contiguous range of it
+        perm = np.arange(num_points)
+        split_dims = []
+        split_vals = []
+        low_children = []
+        hi_children = []
+        leaf_ids = []
+        node_starts = []
+        node_ends = []
+        leaf_starts = []
+        leaf_ends = []
+
+        # Preorder construction.  The hi child's index is filled in when it is reached
+        stack = [(0, num_points, -1)]
+        while(stack):
+            (start, end, parent) = stack.pop()
+            i = len(split_dims)
+            if(parent >= 0):
+                hi_children[parent] = i
+            node_starts.append(start)
+            node_ends.append(end)
+
+            if(end - start <= leaf_size):
+                split_dims.append(0)
+                split_vals.append(0.0)
+                low_children.append(-1)
+                hi_children.append(-1)
+                leaf_ids.append(len(leaf_starts))
+                leaf_starts.append(start)
+                leaf_ends.append(end)
+                continue
+
+            segment = perm[start:end]
+            coords = points[segment]
+            split_dim = np.argmax(coords.max(axis=0) - coords.min(axis=0))
+            mid = (end - start) // 2
+            order = np.argpartition(coords[:, split_dim], mid)
+            perm[start:end] = segment[order]
+
+            split_dims.append(split_dim)
+            split_vals.append(coords[order[mid], split_dim])
+            low_children.append(i + 1)
+            hi_children.append(-1)
+            leaf_ids.append(-1)
+            # The low half is pushed last, so it is visited next
+            stack.append((start + mid, end, i))
+            stack.append((start, start + mid, -1))
+
+        self.split_dims = np.array(split_dims, dtype=np.int64)
+        self.split_vals = np.array(split_vals, dtype=np.float64)
+        self.low_children = np.array(low_children, dtype=np.int64)
+        self.hi_children = np.array(hi_children, dtype=np.int64)
+        self.leaf_ids = np.array(leaf_ids, dtype=np.int64)
+
+        # Bounding box of the points under each tree node
+        node_starts = np.array(node_starts, dtype=np.int64)
+        node_ends = np.array(node_ends, dtype=np.int64)
+        sorted_x = points[perm, 0]
+        sorted_y = points[perm, 1]
+        self.min_x = np.array([sorted_x[s:e].min() for s, e in zip(node_starts, node_ends)])
+        self.max_x = np.array([sorted_x[s:e].max() for s, e in zip(node_starts, node_ends)])
+        self.min_y = np.array([sorted_y[s:e].min() for s, e in zip(node_starts, node_ends)])
+        self.max_y = np.array([sorted_y[s:e].max() for s, e in zip(node_starts, node_ends)])
+
+        # Padded leaf arrays.  Padding has infinite coordinates, so it is never nearest
+        leaf_starts = np.array(leaf_starts, dtype=np.int64)
+        leaf_counts = np.array(leaf_ends, dtype=np.int64) - leaf_starts
+        num_leaves = len(leaf_starts)
+        rows = np.repeat(np.arange(num_leaves), leaf_counts)
+        cols = np.arange(num_points) - np.repeat(leaf_starts, leaf_counts)
+        self.leaf_x = np.full((num_leaves, leaf_size), np.inf)
+        self.leaf_y = np.full((num_leaves, leaf_size), np.inf)
+        self.leaf_index = np.full((num_leaves, leaf_size), -1, dtype=np.int64)
+        self.leaf_x[rows, cols] = sorted_x
+        self.leaf_y[rows, cols] = sorted_y
+        self.leaf_index[rows, cols] = perm
+
+    # Finds the nearest point for each query point
+    # Params:
+        # xs, ys - arrays with the coordinates of the query points
+    # Returns:
+        # indices - an array with the index (in the points given to the constructor)
+            # of the nearest point to each query point
+        # squared_dists - an array of the squared distances to those points
+    def query(self, xs, ys):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        num_queries = len(xs)
+        indices = np.empty(num_queries, dtype=np.int64)
+        squared_dists = np.empty(num_queries, dtype=np.float64)
+
+        for start in xrange(0, num_queries, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, num_queries)
+            (indices[start:end],
+             squared_dists[start:end]) = self._query_block(xs[start:end], ys[start:end])
+        return indices, squared_dists
+
+    # Finds the k nearest points to each query point
+    # Params:
+        # xs, ys - arrays with the coordinates of the query points
+        # k - the number of points to find
+    # Returns:
+        # indices - a (num_queries x k) array of point indices, nearest first.
+            # Padded with -1 if there are fewer than k points
+        # squared_dists - the matching array of squared distances (padded with inf)
+    def query_knn(self, xs, ys, k):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        num_queries = len(xs)
+        indices = np.empty((num_queries, k), dtype=np.int64)
+        squared_dists = np.empty((num_queries, k), dtype=np.float64)
+
+        for start in xrange(0, num_queries, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, num_queries)
+            (indices[start:end],
+             squared_dists[start:end]) = self._knn_block(xs[start:end], ys[start:end], k)
+        return indices, squared_dists
+
+    # Finds all points within a distance of each query point
+    # Params:
+        # xs, ys - arrays with the coordinates of the query points
+        # radius - the distance
+    # Returns:
+        # a list with an array of point indices for each query point, nearest first
+    def query_radius(self, xs, ys, radius):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        results = []
+        for start in xrange(0, len(xs), BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, len(xs))
+            results.extend(self._radius_block(xs[start:end], ys[start:end], radius))
+        return results
+
+    # Finds the nearest point in the given leaves
+    # Params:
+        # qx, qy - arrays of query coordinates
+        # leaves - an array with one leaf id per query point
+    # Returns:
+        # the index of the nearest point in each leaf, and its squared distance
+    def _nearest_in_leaves(self, qx, qy, leaves):
+        dx = self.leaf_x[leaves] - qx[:, np.newaxis]
+        dy = self.leaf_y[leaves] - qy[:, np.newaxis]
+        dists = dx * dx + dy * dy
+        cols = np.argmin(dists, axis=1)
+        rows = np.arange(len(leaves))
+        return self.leaf_index[leaves, cols], dists[rows, cols]
+
+    # Lists every point of the given leaves, for the matching query points
+    # Params:
+        # qx, qy - arrays of query coordinates
+        # queries - an array of query indices
+        # leaves - an array with one leaf id per query index
+    # Returns:
+        # arrays with the query index, point index and squared distance of each
+        # (query, point) pair
+    def _leaf_entries(self, qx, qy, queries, leaves):
+        dx = self.leaf_x[leaves] - qx[queries, np.newaxis]
+        dy = self.leaf_y[leaves] - qy[queries, np.newaxis]
+        dists = (dx * dx + dy * dy).ravel()
+        indices = self.leaf_index[leaves].ravel()
+        queries = np.repeat(queries, self.leaf_size)
+        real = indices >= 0
+        return queries[real], indices[real], dists[real]
+
+    # Descends to the leaf that contains each query point
+    # Returns:
+        # an array of leaf ids
+    def _descend(self, qx, qy):
+        coords = np.column_stack((qx, qy))
+        nodes = np.zeros(len(qx), dtype=np.int64)
+        internal = np.nonzero(self.low_children[nodes] >= 0)[0]
+        while(len(internal) > 0):
+            n = nodes[internal]
+            go_low = coords[internal, self.split_dims[n]] < self.split_vals[n]
+            nodes[internal] = np.where(go_low, self.low_children[n], self.hi_children[n])
+            internal = internal[self.low_children[nodes[internal]] >= 0]
+        return self.leaf_ids[nodes]
+
+    # Searches the tree level by level on (query, tree node) pairs.  A pair is
+    # dropped if the bounding box of the tree node is farther than the bound of
+    # the query, and visit() is called for the leaves that are reached.
+    # Params:
+        # qx, qy - arrays of query coordinates
+        # get_bounds - a function that returns the current squared distance bounds
+            # for an array of query indices
+        # visit - a function called with (queries, leaves) arrays
+        # home_leaves - the leaf of each query that has already been visited, or
+            # None if no leaves have been visited yet
+        # inclusive - if True, tree nodes exactly at the bound are kept
+    def _walk(self, qx, qy, get_bounds, visit, home_leaves=None, inclusive=False):
+        queries = np.arange(len(qx))
+        nodes = np.zeros(len(qx), dtype=np.int64)
+        while(len(queries) > 0):
+            dx = np.maximum(0, np.maximum(self.min_x[nodes] - qx[queries],
+                                          qx[queries] - self.max_x[nodes]))
+            dy = np.maximum(0, np.maximum(self.min_y[nodes] - qy[queries],
+                                          qy[queries] - self.max_y[nodes]))
+            box_dists = dx * dx + dy * dy
+            if(inclusive):
+                close = box_dists <= get_bounds(queries)
+            else:
+                close = box_dists < get_bounds(queries)
+            queries = queries[close]
+            nodes = nodes[close]
+
+            leaves = self.leaf_ids[nodes]
+            is_leaf = leaves >= 0
+            check = is_leaf
+            if(home_leaves is not None):
+                check = is_leaf & (leaves != home_leaves[queries])
+            if(check.any()):
+                visit(queries[check], leaves[check])
+
+            # Continue to both children of the internal nodes
+            queries = np.repeat(queries[~is_leaf], 2)
+            n = nodes[~is_leaf]
+            nodes = np.column_stack((self.low_children[n], self.hi_children[n])).ravel()
+
+    def _query_block(self, qx, qy):
+        # The nearest point in the home leaf is the first bound
+        home_leaves = self._descend(qx, qy)
+        (best_index, best_dist) = self._nearest_in_leaves(qx, qy, home_leaves)
+
+        def visit(queries, leaves):
+            (index, dist) = self._nearest_in_leaves(qx[queries], qy[queries], leaves)
+            np.minimum.at(best_dist, queries, dist)
+            is_best = (dist == best_dist[queries])
+            best_index[queries[is_best]] = index[is_best]
+
+        self._walk(qx, qy, lambda queries: best_dist[queries], visit, home_leaves)
+        return best_index, best_dist
+
+    def _knn_block(self, qx, qy, k):
+        best_index = np.full((len(qx), k), -1, dtype=np.int64)
+        best_dist = np.full((len(qx), k), np.inf)
+
+        def visit(queries, leaves):
+            merge_k_best(best_index, best_dist,
+                         *self._leaf_entries(qx, qy, queries, leaves))
+
+        home_leaves = self._descend(qx, qy)
+        visit(np.arange(len(qx)), home_leaves)
+        self._walk(qx, qy, lambda queries: best_dist[queries, k - 1], visit, home_leaves)
+        return best_index, best_dist
+
+    def _radius_block(self, qx, qy, radius):
+        found = []
+
+        def visit(queries, leaves):
+            (queries, indices, dists) = self._leaf_entries(qx, qy, queries, leaves)
+            inside = dists <= radius * radius
+            found.append((queries[inside], indices[inside], dists[inside]))
+
+        self._walk(qx, qy, lambda queries: radius * radius, visit, inclusive=True)
+        if(not found):
+            return [np.array([], dtype=np.int64) for _ in xrange(len(qx))]
+        (queries, indices, dists) = [np.concatenate(arrays) for arrays in zip(*found)]
+        return group_by_query(queries, indices, dists, len(qx))
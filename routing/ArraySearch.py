@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Shortest path search on an ArrayGraph.
+
+Unlike BiDirectionalSearch, nothing is written onto shared Node objects.  The
+distances and predecessors of a query live in a SearchWorkspace, which is
+reused from one query to the next.  Instead of resetting the workspace after
+every query, each entry is stamped with the "epoch" (query number) that wrote
+it - entries with an old stamp are treated as unvisited.  Each thread gets its
+own workspace, so several queries can run at the same time on one graph.
+The priority queues are plain lists managed by heapq, which avoids the locking
+done by Queue.PriorityQueue.
+
+@author: brian
+"""
+from heapq import heappush, heappop
+from math import sqrt
+import threading
+
+from BiDirectionalSearch import HEURISTIC_DISCOUNT
+
+
+# Holds the per-query state of a search, for one worker (thread)
+# An entry is only valid if its stamp equals the current epoch
+class SearchWorkspace:
+    def __init__(self, num_nodes):
+        inf = float('inf')
+        self.epoch = 0
+
+        # Time from the origin / to the destination
+        self.forward_time = [inf] * num_nodes
+        self.backward_time = [inf] * num_nodes
+
+        # The link used to reach each node in the forward / backward search
+        self.forward_link = [-1] * num_nodes
+        self.backward_link = [-1] * num_nodes
+
+        # The epoch in which forward_time / backward_time was last written
+        self.forward_stamp = [0] * num_nodes
+        self.backward_stamp = [0] * num_nodes
+
+        # The epoch in which the node was last expanded
+        self.forward_done = [0] * num_nodes
+        self.backward_done = [0] * num_nodes
+
+    # Starts a new query.  All entries from previous queries become invalid.
+    def next_epoch(self):
+        self.epoch += 1
+        return self.epoch
+
+
+# A thread-local holder, so each thread lazily creates its own SearchWorkspace
+class _WorkspaceLocal(threading.local):
+    workspace = None
+
+
+# Runs shortest path queries on an ArrayGraph.  The CSR arrays are copied into
+# Python lists once, since indexing lists is much faster than indexing numpy
+# arrays one element at a time.
+class ArraySearch:
+    def __init__(self, graph):
+        self.graph = graph
+
+        self.forward_offsets = graph.forward_offsets.tolist()
+        self.forward_targets = graph.forward_targets.tolist()
+        self.forward_link_ids = graph.forward_link_ids.tolist()
+        self.backward_offsets = graph.backward_offsets.tolist()
+        self.backward_sources = graph.backward_sources.tolist()
+        self.backward_link_ids = graph.backward_link_ids.tolist()
+        self.link_origins = graph.link_origins.tolist()
+        self.link_destinations = graph.link_destinations.tolist()
+        self.node_x = graph.node_x.tolist()
+        self.node_y = graph.node_y.tolist()
+
+        self.time_version = None
+        self.refresh()
+
+        self._local = _WorkspaceLocal()
+
+    # Picks up new link times from the ArrayGraph, if they have changed
+    def refresh(self):
+        if(self.time_version != self.graph.time_version):
+            # Read the version first - if the times change while copying, the
+            # next refresh() will copy them again
+            version = self.graph.time_version
+            self.link_times = self.graph.link_times.tolist()
+            self.time_version = version
+
+    # Returns the SearchWorkspace of the calling thread
+    def get_workspace(self):
+        workspace = self._local.workspace
+        if(workspace is None):
+            workspace = SearchWorkspace(self.graph.num_nodes)
+            self._local.workspace = workspace
+        return workspace
+
+    # The ArraySearch can be pickled, but workspaces are not sent along
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_local']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = _WorkspaceLocal()
+
+    # Follows the predecessor links of a finished search to build the path
+    # Params:
+        # workspace - the SearchWorkspace used by the search
+        # center - the node index where the forward and backward searches met
+    # Returns:
+        # a list of link ids from the origin to the destination
+    def reconstruct_path(self, workspace, center):
+        epoch = workspace.epoch
+
+        # Links leading from the origin to the center (built backwards)
+        first_part = []
+        node = center
+        while(workspace.forward_stamp[node] == epoch and
+              workspace.forward_link[node] >= 0):
+            link_id = workspace.forward_link[node]
+            first_part.append(link_id)
+            node = self.link_origins[link_id]
+        first_part.reverse()
+
+        # Links leading from the center to the destination
+        node = center
+        while(workspace.backward_stamp[node] == epoch and
+              workspace.backward_link[node] >= 0):
+            link_id = workspace.backward_link[node]
+            first_part.append(link_id)
+            node = self.link_destinations[link_id]
+
+        return first_part
+
+    # Builds the forward potential of the Euclidean A* heuristic: half of
+    # (straight-line time to the destination - straight-line time from the origin)
+    # Params:
+        # origin, destination - node indices of the query
+        # max_speed - maximum speed on any link in the graph
+    # Returns:
+        # a function that maps a node index to its forward potential
+    def make_euclidean_potential(self, origin, destination, max_speed):
+        node_x = self.node_x
+        node_y = self.node_y
+        scale = HEURISTIC_DISCOUNT / (2.0 * max_speed)
+        ox = node_x[origin]
+        oy = node_y[origin]
+        dx = node_x[destination]
+        dy = node_y[destination]
+
+        def potential(v):
+            x = node_x[v]
+            y = node_y[v]
+            return scale * (sqrt((x - dx) ** 2 + (y - dy) ** 2) -
+                            sqrt((x - ox) ** 2 + (y - oy) ** 2))
+
+        return potential
+
+    # Bidirectional Dijkstra / A* search between two node indices.
+    # With use_astar, both searches use an averaged potential as in
+    # "A Fast Algorithm for Finding Better Routes by AI Search Techniques", Ikeda et al., 1994
+    # built from either Euclidean or landmark bounds.  Both are consistent, so the
+    # search can stop as soon as the sum of the two smallest queue keys reaches
+    # the best path found so far.
+    # Params:
+        # origin - node index of the start of the path
+        # destination - node index of the end of the path
+        # use_astar - use euclidean distance heuristic to guide the search using A*
+        # max_speed - maximum speed on any link in the graph, used for the A* heuristic
+        # landmarks - optional Landmarks.  If given, A* uses their bounds instead
+            # of the Euclidean distance (and max_speed is not needed)
+        # workspace - optional SearchWorkspace.  Defaults to the calling thread's one
+        # use_arcflags - skip links whose arc flag for the other end's region is
+            # off.  Requires ArrayGraph.set_arcflags().  If the flags were computed
+            # with other link times, they are ignored (with a warning)
+    # Returns:
+        # a list of link ids on the shortest path, in order, or None if no such path exists
+    def bidirectional_search(self, origin, destination, use_astar=False,
+                             max_speed=1.0, workspace=None, use_arcflags=False,
+                             landmarks=None):
+        if(workspace is None):
+            workspace = self.get_workspace()
+        self.refresh()
+        epoch = workspace.next_epoch()
+
+        if(origin == destination):
+            return []
+
+        # Local references make the inner loop much faster
+        forward_offsets = self.forward_offsets
+        forward_targets = self.forward_targets
+        forward_link_ids = self.forward_link_ids
+        backward_offsets = self.backward_offsets
+        backward_sources = self.backward_sources
+        backward_link_ids = self.backward_link_ids
+        link_times = self.link_times
+
+        # The forward search only needs links flagged for the destination's region,
+        # and the backward search only links flagged for the origin's region
+        if(use_arcflags and not self.graph.arcflags_match_times()):
+            use_arcflags = False
+        if(use_arcflags):
+            forward_arcflags = self.graph.forward_arcflags
+            backward_arcflags = self.graph.backward_arcflags
+            destination_bit = 1 << self.graph.node_regions[destination]
+            origin_bit = 1 << self.graph.node_regions[origin]
+
+        forward_time = workspace.forward_time
+        forward_link = workspace.forward_link
+        forward_stamp = workspace.forward_stamp
+        forward_done = workspace.forward_done
+        backward_time = workspace.backward_time
+        backward_link = workspace.backward_link
+        backward_stamp = workspace.backward_stamp
+        backward_done = workspace.backward_done
+
+        # The backward potential of a node is the negative of its forward potential
+        if(not use_astar):
+            potential = None
+        elif(landmarks is not None):
+            # The bounds must come from the current link times to be admissible
+            landmarks.refresh()
+            potential = landmarks.make_potential(origin, destination)
+        else:
+            potential = self.make_euclidean_potential(origin, destination, max_speed)
+
+        forward_time[origin] = 0.0
+        forward_link[origin] = -1
+        forward_stamp[origin] = epoch
+        backward_time[destination] = 0.0
+        backward_link[destination] = -1
+        backward_stamp[destination] = epoch
+
+        if(potential is None):
+            forward_pq = [(0.0, origin)]
+            backward_pq = [(0.0, destination)]
+        else:
+            forward_pq = [(potential(origin), origin)]
+            backward_pq = [(-potential(destination), destination)]
+
+        best_full_time = float('inf')
+        center = -1
+
+        # The main loop alternates between forward and backward expansions
+        while(forward_pq and backward_pq):
+            # Stopping criterion for consistent potentials
+            if(forward_pq[0][0] + backward_pq[0][0] >= best_full_time):
+                break
+
+            #### FORWARD EXPANSION ####
+            (_, node) = heappop(forward_pq)
+            if(forward_done[node] != epoch):
+                forward_done[node] = epoch
+                node_time = forward_time[node]
+                for k in xrange(forward_offsets[node], forward_offsets[node + 1]):
+                    neighbor = forward_targets[k]
+                    link_id = forward_link_ids[k]
+                    if(use_arcflags and not forward_arcflags[link_id] & destination_bit):
+                        continue
+                    proposed_time = node_time + link_times[link_id]
+                    if(forward_stamp[neighbor] != epoch or
+                       proposed_time < forward_time[neighbor]):
+                        forward_stamp[neighbor] = epoch
+                        forward_time[neighbor] = proposed_time
+                        forward_link[neighbor] = link_id
+
+                        priority = proposed_time
+                        if(potential is not None):
+                            priority += potential(neighbor)
+                        heappush(forward_pq, (priority, neighbor))
+
+                        # Touched by both searches - a candidate center node
+                        if(backward_stamp[neighbor] == epoch and
+                           proposed_time + backward_time[neighbor] < best_full_time):
+                            best_full_time = proposed_time + backward_time[neighbor]
+                            center = neighbor
+
+            if(not forward_pq):
+                break
+
+            #### BACKWARD EXPANSION ####
+            (_, node) = heappop(backward_pq)
+            if(backward_done[node] != epoch):
+                backward_done[node] = epoch
+                node_time = backward_time[node]
+                for k in xrange(backward_offsets[node], backward_offsets[node + 1]):
+                    neighbor = backward_sources[k]
+                    link_id = backward_link_ids[k]
+                    if(use_arcflags and not backward_arcflags[link_id] & origin_bit):
+                        continue
+                    proposed_time = node_time + link_times[link_id]
+                    if(backward_stamp[neighbor] != epoch or
+                       proposed_time < backward_time[neighbor]):
+                        backward_stamp[neighbor] = epoch
+                        backward_time[neighbor] = proposed_time
+                        backward_link[neighbor] = link_id
+
+                        priority = proposed_time
+                        if(potential is not None):
+                            priority -= potential(neighbor)
+                        heappush(backward_pq, (priority, neighbor))
+
+                        if(forward_stamp[neighbor] == epoch and
+                           proposed_time + forward_time[neighbor] < best_full_time):
+                            best_full_time = proposed_time + forward_time[neighbor]
+                            center = neighbor
+
+        if(center < 0):
+            print("Bidirectional search has failed.")
+            return None
+
+        return self.reconstruct_path(workspace, center)
+
+    # Runs one Dijkstra search from (or towards) a root node, which stops as soon as
+    # all of the targets have been settled.  This replaces one search per target
+    # when many paths share an origin (or a destination).
+    # Params:
+        # root - the node index shared by all of the paths
+        # targets - the node indices at the other end of the paths
+        # backward - if False, finds paths from root to each target.  If True,
+            # finds paths from each target to root (on the backward graph)
+        # workspace - optional SearchWorkspace.  Defaults to the calling thread's one
+    # Returns:
+        # a dictionary that maps each target to a list of link ids on the shortest
+        # path (in travel order), or to None if the target can't be reached
+    def tree_search(self, root, targets, backward=False, workspace=None):
+        if(workspace is None):
+            workspace = self.get_workspace()
+        self.refresh()
+        epoch = workspace.next_epoch()
+
+        if(backward):
+            offsets = self.backward_offsets
+            neighbors = self.backward_sources
+            link_ids = self.backward_link_ids
+            node_time = workspace.backward_time
+            node_link = workspace.backward_link
+            stamp = workspace.backward_stamp
+            done = workspace.backward_done
+        else:
+            offsets = self.forward_offsets
+            neighbors = self.forward_targets
+            link_ids = self.forward_link_ids
+            node_time = workspace.forward_time
+            node_link = workspace.forward_link
+            stamp = workspace.forward_stamp
+            done = workspace.forward_done
+        link_times = self.link_times
+
+        remaining = set(targets)
+        node_time[root] = 0.0
+        node_link[root] = -1
+        stamp[root] = epoch
+        pq = [(0.0, root)]
+
+        while(pq and remaining):
+            (_, node) = heappop(pq)
+            if(done[node] == epoch):
+                continue
+            done[node] = epoch
+            remaining.discard(node)
+
+            time = node_time[node]
+            for k in xrange(offsets[node], offsets[node + 1]):
+                neighbor = neighbors[k]
+                link_id = link_ids[k]
+                proposed_time = time + link_times[link_id]
+                if(stamp[neighbor] != epoch or proposed_time < node_time[neighbor]):
+                    stamp[neighbor] = epoch
+                    node_time[neighbor] = proposed_time
+                    node_link[neighbor] = link_id
+                    heappush(pq, (proposed_time, neighbor))
+
+        # Follow the predecessor links from each target back to the root
+        if(backward):
+            next_node = self.link_destinations
+        else:
+            next_node = self.link_origins
+        paths = {}
+        for target in targets:
+            if(done[target] != epoch):
+                paths[target] = None
+                continue
+            path = []
+            node = target
+            while(node_link[node] >= 0):
+                path.append(node_link[node])
+                node = next_node[node_link[node]]
+            if(not backward):
+                path.reverse()
+            paths[target] = path
+        return paths
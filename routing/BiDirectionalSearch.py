@@ -7,6 +7,20 @@ from datetime import datetime
 HEURISTIC_DISCOUNT = .8
 
 
+# Checks that arc flags have been computed or loaded (see Map.compute_arcflags() and
+# Map.load_arcflags()) before a search prunes with them.  Without them, the flags
+# of the Links are None and the regions of the Nodes aren't assigned
+# Params:
+    # start_node - the node at the beginning of the path
+    # end_node - the node at the end of the path
+def check_arcflags(start_node, end_node):
+    links = start_node.forward_links + end_node.backward_links
+    if(not isinstance(start_node.region_id, int) or not isinstance(end_node.region_id, int) or
+       any(link.forward_arcflags is None or link.backward_arcflags is None for link in links)):
+        raise ValueError("use_arcflags needs arc flags - call Map.compute_arcflags() or "
+                         "Map.load_arcflags() first")
+
+
 # Uses bidirectional search to find the shortest path between start_node and end_node
 # Params:
 # start_node - the node at the beginning of the path
@@ -65,6 +79,9 @@ def bidirectional_dijkstra(
         use_astar=False,
         use_arcflags=False,
         max_speed=1.0):
+    if(use_arcflags):
+        check_arcflags(start_node, end_node)
+
     # Initialize the priority queue for the forward search from the origin
     forward_pq = PriorityQueue()
     start_node.forward_time = 0
@@ -102,6 +119,11 @@ def bidirectional_dijkstra(
 
         # propagate to neighboring nodes
         for link in node.forward_links:
+            # With arc flags, only follow links on shortest paths into the
+            # destination's region
+            if(use_arcflags and not (link.forward_arcflags >> end_node.region_id) & 1):
+                continue
+
             # Proposed time of reaching this neighbor via this node
             proposed_cost = node.forward_time + link.time
 
@@ -142,6 +164,11 @@ def bidirectional_dijkstra(
 
         # propagate to neighboring nodes
         for link in node.backward_links:
+            # With arc flags, only follow links on shortest paths out of the
+            # origin's region
+            if(use_arcflags and not (link.backward_arcflags >> start_node.region_id) & 1):
+                continue
+
             # Proposed time of reaching this neighbor via this node
             proposed_cost = node.backward_time + link.time
 
@@ -235,6 +262,9 @@ def simple_dijkstra(
         use_astar=False,
         use_arcflags=False,
         max_speed=1.0):
+    if(use_arcflags):
+        check_arcflags(start_node, end_node)
+
     # Initialize the priority queue for the forward search from the origin
     forward_pq = PriorityQueue()
     start_node.forward_time = 0
@@ -254,6 +284,11 @@ def simple_dijkstra(
 
         # propagate to neighboring nodes
         for link in node.forward_links:
+            # With arc flags, only follow links on shortest paths into the
+            # destination's region
+            if(use_arcflags and not (link.forward_arcflags >> end_node.region_id) & 1):
+                continue
+
             # Proposed time of reaching this neighbor via this node
             proposed_cost = node.forward_time + link.time
 
@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+"""
+Customizable Contraction Hierarchies (CCH) on an ArrayGraph.
+
+The work is split into three phases, as described in
+"Customizable Contraction Hierarchies", Dibbelt, Strasser and Wagner, 2014
+1) Ordering and contraction depend only on the topology of the graph, so they
+   are done once.  Nodes are ordered by geometric nested dissection, and the
+   graph is contracted in that order, which adds "shortcut" edges.
+2) Customization computes the travel time of every (shortcut) edge from the
+   current link times.  It is cheap, so it is redone whenever the times change.
+3) Queries walk up the elimination tree from the origin and the destination.
+   No priority queue is needed, and the edges of each node are relaxed with numpy.
+
+The queries are interpreted Python, so they gain far less than in compiled
+implementations.  On a synthetic 10k node grid a query takes about 2 ms instead of
+about 15 ms for Dijkstra, but contraction takes about 15 s and each customization
+takes about 0.7 s.  So the hierarchy only pays off when many trips are routed with
+the same link times - it is not built unless Map.build_contraction_hierarchy() is called.
+
+Every edge of the contracted graph connects a lower ranked node to a higher
+ranked one, and has an "up" weight (low -> high) and a "down" weight
+(high -> low).  Each weight remembers how it was obtained - either from an
+original link, or from a lower triangle (low -> middle -> high) - so that paths
+can be unpacked back into link ids.
+
+@author: brian
+"""
+import numpy as np
+
+
+# Orders the nodes of a graph by recursive geometric bisection.  Each set of
+# nodes is split at the median of its wider coordinate, and the nodes of the lower
+# half which touch the upper half form a separator, which is ordered after both
+# halves.
+# Params:
+    # graph - an ArrayGraph
+    # neighbors - undirected adjacency lists of the graph
+    # leaf_size - sets with at most this many nodes are not split further
+# Returns:
+    # a list of node indices, from lowest to highest rank
+def nested_dissection_order(graph, neighbors, leaf_size=8):
+    marks = [0] * graph.num_nodes
+    order = []
+
+    # Each call of dissect() gets its own mark, to identify nodes in the upper half
+    next_mark = [0]
+
+    def dissect(nodes):
+        if(len(nodes) <= leaf_size):
+            order.extend(nodes.tolist())
+            return
+
+        xs = graph.node_x[nodes]
+        ys = graph.node_y[nodes]
+        if(np.ptp(xs) >= np.ptp(ys)):
+            coordinates = xs
+        else:
+            coordinates = ys
+
+        mid = len(nodes) // 2
+        partition = np.argpartition(coordinates, mid)
+        low = nodes[partition[:mid]]
+        high = nodes[partition[mid:]]
+
+        next_mark[0] += 1
+        mark = next_mark[0]
+        for node in high.tolist():
+            marks[node] = mark
+
+        separator = []
+        low_rest = []
+        for node in low.tolist():
+            for neighbor in neighbors[node]:
+                if(marks[neighbor] == mark):
+                    separator.append(node)
+                    break
+            else:
+                low_rest.append(node)
+
+        dissect(np.array(low_rest, dtype=np.int64))
+        dissect(high)
+        order.extend(separator)
+
+    dissect(np.arange(graph.num_nodes))
+    return order
+
+
+class ContractionHierarchy:
+    # Orders and contracts the graph.  The result is customized with the current
+    # link times of the graph.
+    # Params:
+        # graph - an ArrayGraph
+        # order - optional list of node indices from lowest to highest rank.
+            # Computed by nested_dissection_order() if not given
+    def __init__(self, graph, order=None):
+        self.graph = graph
+        num_nodes = graph.num_nodes
+
+        # Undirected adjacency lists, without self loops or duplicates
+        neighbors = [set() for _ in xrange(num_nodes)]
+        for (a, b) in zip(graph.link_origins.tolist(), graph.link_destinations.tolist()):
+            if(a >= 0 and b >= 0 and a != b):
+                neighbors[a].add(b)
+                neighbors[b].add(a)
+
+        if(order is None):
+            order = nested_dissection_order(graph, neighbors)
+        rank = [0] * num_nodes
+        for i, node in enumerate(order):
+            rank[node] = i
+        self.rank = rank
+
+        # Contraction - eliminate the nodes from lowest to highest rank.  The
+        # higher neighbors of each node must become a clique.  It is enough to
+        # pass them on to the lowest of them (the node's parent in the elimination tree)
+        upward = [set(n for n in neighbors[node] if rank[n] > rank[node])
+                  for node in xrange(num_nodes)]
+        del neighbors
+        parent = [-1] * num_nodes
+        for node in order:
+            up = upward[node]
+            if(up):
+                p = min(up, key=rank.__getitem__)
+                parent[node] = p
+                upward[p].update(up)
+                upward[p].discard(p)
+        self.parent = parent
+
+        # Depth of each node in the elimination tree (the roots are at depth 0)
+        depth = [0] * num_nodes
+        for node in reversed(order):
+            if(parent[node] >= 0):
+                depth[node] = depth[parent[node]] + 1
+        self.depth = depth
+
+        # Store the upward edges in CSR form.  The position of an edge in this
+        # array is its edge id
+        up_offsets = [0] * (num_nodes + 1)
+        up_targets = []
+        for node in xrange(num_nodes):
+            up_targets.extend(sorted(upward[node], key=rank.__getitem__))
+            up_offsets[node + 1] = len(up_targets)
+        del upward
+        self.up_offsets = up_offsets
+        self.up_targets = up_targets
+        self.num_edges = len(up_targets)
+
+        edge_low = [0] * self.num_edges
+        for node in xrange(num_nodes):
+            for k in xrange(up_offsets[node], up_offsets[node + 1]):
+                edge_low[k] = node
+        self.edge_low = edge_low
+        self.edge_ids = dict(((edge_low[k], up_targets[k]), k)
+                             for k in xrange(self.num_edges))
+
+        # Arrays for the vectorized relaxations of queries, and the incoming edges
+        # of each node (in CSR form), which are used to trace the paths back
+        self.up_target_array = np.array(up_targets, dtype=np.int64)
+        self.edge_low_array = np.array(edge_low, dtype=np.int64)
+        self.in_edges = np.argsort(self.up_target_array, kind='mergesort')
+        self.in_offsets = np.searchsorted(self.up_target_array[self.in_edges],
+                                          np.arange(num_nodes + 1)).tolist()
+
+        self._prepare_links()
+        self._prepare_triangles()
+
+        self.time_version = None
+        self.customize()
+
+    # Determines which edge (and direction) each original link belongs to
+    def _prepare_links(self):
+        rank = self.rank
+        link_ids = []
+        link_edges = []
+        link_upward = []
+        for (link_id, (a, b)) in enumerate(zip(self.graph.link_origins.tolist(),
+                                               self.graph.link_destinations.tolist())):
+            if(a >= 0 and b >= 0 and a != b):
+                link_ids.append(link_id)
+                if(rank[a] < rank[b]):
+                    link_edges.append(self.edge_ids[a, b])
+                    link_upward.append(True)
+                else:
+                    link_edges.append(self.edge_ids[b, a])
+                    link_upward.append(False)
+        self.link_ids = np.array(link_ids, dtype=np.int64)
+        self.link_edges = np.array(link_edges, dtype=np.int64)
+        self.link_upward = np.array(link_upward, dtype=bool)
+
+    # Enumerates the lower triangles of every edge.  The triangle (x, u, v), where x
+    # is the lowest node, allows the path u -> x -> v to improve the edge (u, v).
+    # Triangles are grouped by the level of x in the elimination tree, since
+    # triangles at one level never read an edge that is written at the same level.
+    def _prepare_triangles(self):
+        num_nodes = self.graph.num_nodes
+        rank = self.rank
+        up_offsets = self.up_offsets
+        up_targets = self.up_targets
+        edge_ids = self.edge_ids
+
+        # level = height above the leaves of the elimination tree
+        level = [0] * num_nodes
+        for node in sorted(xrange(num_nodes), key=rank.__getitem__):
+            p = self.parent[node]
+            if(p >= 0 and level[p] < level[node] + 1):
+                level[p] = level[node] + 1
+
+        tri_level = []
+        tri_middle = []
+        tri_low_edge = []   # edge (x, u)
+        tri_high_edge = []  # edge (x, v)
+        tri_edge = []       # edge (u, v)
+        for x in xrange(num_nodes):
+            start = up_offsets[x]
+            end = up_offsets[x + 1]
+            for i in xrange(start, end):
+                u = up_targets[i]
+                for j in xrange(i + 1, end):
+                    tri_level.append(level[x])
+                    tri_middle.append(x)
+                    tri_low_edge.append(i)
+                    tri_high_edge.append(j)
+                    tri_edge.append(edge_ids[u, up_targets[j]])
+
+        # Sort by level, then by the updated edge so np.minimum.reduceat can be used
+        tri_level = np.array(tri_level, dtype=np.int64)
+        tri_edge = np.array(tri_edge, dtype=np.int64)
+        order = np.lexsort((tri_edge, tri_level))
+        tri_level = tri_level[order]
+        self.tri_middle = np.array(tri_middle, dtype=np.int64)[order]
+        self.tri_low_edge = np.array(tri_low_edge, dtype=np.int64)[order]
+        self.tri_high_edge = np.array(tri_high_edge, dtype=np.int64)[order]
+        self.tri_edge = tri_edge[order]
+        self.num_triangles = len(self.tri_edge)
+
+        # Start of each level in the triangle arrays
+        num_levels = (tri_level[-1] + 1) if self.num_triangles > 0 else 0
+        self.level_bounds = np.searchsorted(tri_level, np.arange(num_levels + 1))
+
+    # Computes the weights of all edges from the current link times of the graph
+    # Params:
+        # link_times - optional array of link times.  Defaults to graph.link_times
+    def customize(self, link_times=None):
+        version = self.graph.time_version
+        if(link_times is None):
+            link_times = self.graph.link_times
+
+        inf = float('inf')
+        up = np.repeat(inf, self.num_edges)
+        down = np.repeat(inf, self.num_edges)
+        # An unpacking hint for each weight:  >= 0 is an original link id,
+        # < 0 encodes the middle node x of a triangle as -(x + 1)
+        up_via = np.repeat(-1, self.num_edges)
+        down_via = np.repeat(-1, self.num_edges)
+
+        # Original links (keep the fastest of any parallel links)
+        times = np.asarray(link_times, dtype=np.float64)[self.link_ids]
+        for (weights, via, mask) in [(up, up_via, self.link_upward),
+                                     (down, down_via, ~self.link_upward)]:
+            edges = self.link_edges[mask]
+            np.minimum.at(weights, edges, times[mask])
+            best = times[mask] == weights[edges]
+            via[edges[best]] = self.link_ids[mask][best]
+
+        # Lower triangles, level by level
+        bounds = self.level_bounds
+        for level in xrange(len(bounds) - 1):
+            start = bounds[level]
+            end = bounds[level + 1]
+            if(start == end):
+                continue
+            low_edge = self.tri_low_edge[start:end]
+            high_edge = self.tri_high_edge[start:end]
+            edge = self.tri_edge[start:end]
+            middle_code = -(self.tri_middle[start:end] + 1)
+
+            groups = np.flatnonzero(np.r_[True, edge[1:] != edge[:-1]])
+            group_edges = edge[groups]
+
+            # u -> x -> v  is  down(x, u) + up(x, v)
+            proposed = down[low_edge] + up[high_edge]
+            up[group_edges] = np.minimum(up[group_edges],
+                                         np.minimum.reduceat(proposed, groups))
+            best = proposed == up[edge]
+            up_via[edge[best]] = middle_code[best]
+
+            # v -> x -> u  is  down(x, v) + up(x, u)
+            proposed = down[high_edge] + up[low_edge]
+            down[group_edges] = np.minimum(down[group_edges],
+                                           np.minimum.reduceat(proposed, groups))
+            best = proposed == down[edge]
+            down_via[edge[best]] = middle_code[best]
+
+        self.up_weights = up
+        self.down_weights = down
+        self.up_via = up_via
+        self.down_via = down_via
+
+        # Python lists are much faster for the scalar lookups done by unpacking
+        self._up_via_list = up_via.tolist()
+        self._down_via_list = down_via.tolist()
+        self.time_version = version
+
+    # Re-customizes if the link times of the graph have changed
+    def refresh(self):
+        if(self.time_version != self.graph.time_version):
+            self.customize()
+
+    # The Python lists are large - they are rebuilt after unpickling instead of sent
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['_up_via_list', '_down_via_list']:
+            del state[key]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._up_via_list = self.up_via.tolist()
+        self._down_via_list = self.down_via.tolist()
+
+    # Relaxes the upward edges of a node, which all lead to its ancestors
+    # Params:
+        # node - the node index
+        # node_time - the time of the best up-path to the node
+        # weights - self.up_weights (paths away from the start) or
+            # self.down_weights (paths towards it)
+        # times - array of the best up-path times from the start, which is updated
+    def _relax(self, node, node_time, weights, times):
+        start = self.up_offsets[node]
+        end = self.up_offsets[node + 1]
+        if(start < end and node_time < float('inf')):
+            targets = self.up_target_array[start:end]
+            times[targets] = np.minimum(times[targets], weights[start:end] + node_time)
+
+    # Traces the best up-path to a node back to the start of the search.  Queries only
+    # store times, so the last edge is the incoming edge whose time adds up exactly
+    # Params:
+        # node - the end of the up-path
+        # start - the start of the search
+        # weights - the weights that the search used
+        # times - the times that the search computed
+    # Returns:
+        # the edge ids on the path, from the node back to the start
+    def _trace(self, node, start, weights, times):
+        edges = []
+        while(node != start):
+            incoming = self.in_edges[self.in_offsets[node]:self.in_offsets[node + 1]]
+            lows = self.edge_low_array[incoming]
+            edge = incoming[times[lows] + weights[incoming] == times[node]][0]
+            edges.append(edge)
+            node = self.edge_low[edge]
+        return edges
+
+    # Expands an edge of the hierarchy into the original link ids it represents
+    # Params:
+        # edge - the edge id
+        # upward - True for the low -> high direction, False for high -> low
+        # out - a list, which the link ids are appended to
+    def _unpack(self, edge, upward, out):
+        stack = [(edge, upward)]
+        while(stack):
+            (edge, upward) = stack.pop()
+            if(upward):
+                via = self._up_via_list[edge]
+            else:
+                via = self._down_via_list[edge]
+
+            if(via >= 0):
+                out.append(via)
+            else:
+                middle = -via - 1
+                low = self.edge_low[edge]
+                high = self.up_targets[edge]
+                # The stack is LIFO, so the second half of the path is pushed first
+                if(upward):
+                    # low -> middle -> high
+                    stack.append((self.edge_ids[middle, high], True))
+                    stack.append((self.edge_ids[middle, low], False))
+                else:
+                    # high -> middle -> low
+                    stack.append((self.edge_ids[middle, low], True))
+                    stack.append((self.edge_ids[middle, high], False))
+
+    # Finds the shortest path between two node indices
+    # Params:
+        # origin - node index of the start of the path
+        # destination - node index of the end of the path
+    # Returns:
+        # a list of link ids on the shortest path, in order, or None if no such path exists
+    def find_path(self, origin, destination):
+        self.refresh()
+        if(origin == destination):
+            return []
+
+        # Both searches walk up the elimination tree, and only reach ancestors of
+        # their start.  Below the lowest common ancestor, the two walks are disjoint
+        inf = float('inf')
+        forward_times = np.repeat(inf, self.graph.num_nodes)
+        backward_times = np.repeat(inf, self.graph.num_nodes)
+        forward_times[origin] = 0.0
+        backward_times[destination] = 0.0
+        parent = self.parent
+        depth = self.depth
+
+        node = origin
+        while(depth[node] > depth[destination]):
+            self._relax(node, forward_times[node], self.up_weights, forward_times)
+            node = parent[node]
+        other = destination
+        while(depth[other] > depth[node]):
+            self._relax(other, backward_times[other], self.down_weights, backward_times)
+            other = parent[other]
+        while(node != other):
+            self._relax(node, forward_times[node], self.up_weights, forward_times)
+            self._relax(other, backward_times[other], self.down_weights, backward_times)
+            node = parent[node]
+            other = parent[other]
+
+        # The paths meet at a common ancestor.  An ancestor whose time is already no
+        # better than the best path so far can't improve it, so its (many) edges in
+        # the top separators are skipped
+        best_time = inf
+        center = -1
+        while(node >= 0):
+            forward_time = forward_times[node]
+            backward_time = backward_times[node]
+            if(forward_time + backward_time < best_time):
+                best_time = forward_time + backward_time
+                center = node
+            if(forward_time < best_time):
+                self._relax(node, forward_time, self.up_weights, forward_times)
+            if(backward_time < best_time):
+                self._relax(node, backward_time, self.down_weights, backward_times)
+            node = parent[node]
+
+        if(center < 0):
+            return None
+
+        path = []
+        first_part = self._trace(center, origin, self.up_weights, forward_times)
+        for edge in reversed(first_part):
+            self._unpack(edge, True, path)
+        for edge in self._trace(center, destination, self.down_weights, backward_times):
+            self._unpack(edge, False, path)
+
+        return path
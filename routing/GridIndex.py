@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+A uniform grid (spatial hash) for batch nearest neighbor queries on 2D points.
+
+The bounding box of the points is cut into square cells, sized so that each
+cell holds about points_per_cell points on average.  The points are sorted by
+cell, so the points of cell c are
+    point_index[cell_starts[c]:cell_starts[c+1]]
+This works well for dense, nearly uniform point clouds (like the intersections
+of Manhattan), where a query only has to look at a handful of cells.
+
+Nearest and k-nearest queries use a ring search.  Ring r is the set of cells
+whose row and column are at most r away from the query's cell (and exactly r
+away in one of them).  After the rings up to r have been searched, any point
+that has not been seen is at least as far away as the nearest edge of that
+(2r+1 x 2r+1) block of cells - so the search stops once the k-th best distance
+is within that bound.  All queries of a block are searched together, ring by
+ring.  See SpatialIndex for the interface.
+
+@author: brian
+"""
+import numpy as np
+
+from SpatialIndex import expand_ranges, merge_k_best, group_by_query
+
+# The number of query points handled at once
+BLOCK_SIZE = 8192
+
+
+class GridIndex:
+    # Params:
+        # points - an (N x 2) array-like of point coordinates
+        # points_per_cell - the average number of points per cell
+    def __init__(self, points, points_per_cell=1.0):
+        points = np.asarray(points, dtype=np.float64)
+        num_points = len(points)
+        (self.min_x, self.min_y) = points.min(axis=0)
+        (max_x, max_y) = points.max(axis=0)
+        width = max_x - self.min_x
+        height = max_y - self.min_y
+
+        area = max(width, 1.0) * max(height, 1.0)
+        self.cell_size = np.sqrt(area * points_per_cell / num_points)
+        self.num_x = int(width // self.cell_size) + 1
+        self.num_y = int(height // self.cell_size) + 1
+
+        (cell_x, cell_y) = self._cells_of(points[:, 0], points[:, 1])
+        cells = cell_x * self.num_y + cell_y
+        order = np.argsort(cells, kind='mergesort')
+        self.point_index = order
+        self.point_x = points[order, 0]
+        self.point_y = points[order, 1]
+        self.cell_starts = np.searchsorted(cells[order],
+                                           np.arange(self.num_x * self.num_y + 1))
+
+    # Finds the cell of each coordinate.  Coordinates outside of the grid are put
+    # in the nearest cell on its edge
+    # Returns:
+        # arrays with the column and row of each cell
+    def _cells_of(self, xs, ys):
+        cell_x = np.floor((xs - self.min_x) / self.cell_size).astype(np.int64)
+        cell_y = np.floor((ys - self.min_y) / self.cell_size).astype(np.int64)
+        return (np.clip(cell_x, 0, self.num_x - 1),
+                np.clip(cell_y, 0, self.num_y - 1))
+
+    # Lists every point in the given cells, for the matching query points
+    # Params:
+        # qx, qy - arrays of query coordinates
+        # queries - an array of query indices
+        # cell_x, cell_y - arrays with one cell per query index.  Cells outside of
+            # the grid are skipped
+    # Returns:
+        # arrays with the query index, point index and squared distance of each
+        # (query, point) pair
+    def _cell_entries(self, qx, qy, queries, cell_x, cell_y):
+        valid = ((cell_x >= 0) & (cell_x < self.num_x) &
+                 (cell_y >= 0) & (cell_y < self.num_y))
+        cells = cell_x[valid] * self.num_y + cell_y[valid]
+        starts = self.cell_starts[cells]
+        counts = self.cell_starts[cells + 1] - starts
+        entries = expand_ranges(starts, counts)
+        queries = np.repeat(queries[valid], counts)
+        dx = self.point_x[entries] - qx[queries]
+        dy = self.point_y[entries] - qy[queries]
+        return queries, self.point_index[entries], dx * dx + dy * dy
+
+    # Finds the nearest point for each query point
+    # Params:
+        # xs, ys - arrays with the coordinates of the query points
+    # Returns:
+        # indices - an array with the index (in the points given to the constructor)
+            # of the nearest point to each query point
+        # squared_dists - an array of the squared distances to those points
+    def query(self, xs, ys):
+        (indices, squared_dists) = self.query_knn(xs, ys, 1)
+        return indices[:, 0], squared_dists[:, 0]
+
+    # Finds the k nearest points to each query point
+    # Params:
+        # xs, ys - arrays with the coordinates of the query points
+        # k - the number of points to find
+    # Returns:
+        # indices - a (num_queries x k) array of point indices, nearest first.
+            # Padded with -1 if there are fewer than k points
+        # squared_dists - the matching array of squared distances (padded with inf)
+    def query_knn(self, xs, ys, k):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        num_queries = len(xs)
+        indices = np.empty((num_queries, k), dtype=np.int64)
+        squared_dists = np.empty((num_queries, k), dtype=np.float64)
+
+        for start in xrange(0, num_queries, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, num_queries)
+            (indices[start:end],
+             squared_dists[start:end]) = self._knn_block(xs[start:end], ys[start:end], k)
+        return indices, squared_dists
+
+    # Finds all points within a distance of each query point
+    # Params:
+        # xs, ys - arrays with the coordinates of the query points
+        # radius - the distance
+    # Returns:
+        # a list with an array of point indices for each query point, nearest first
+    def query_radius(self, xs, ys, radius):
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        results = []
+        for start in xrange(0, len(xs), BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, len(xs))
+            results.extend(self._radius_block(xs[start:end], ys[start:end], radius))
+        return results
+
+    def _knn_block(self, qx, qy, k):
+        num_queries = len(qx)
+        best_index = np.full((num_queries, k), -1, dtype=np.int64)
+        best_dist = np.full((num_queries, k), np.inf)
+        (cell_x, cell_y) = self._cells_of(qx, qy)
+
+        active = np.arange(num_queries)
+        r = 0
+        while(len(active) > 0):
+            # The offsets of the cells in ring r
+            if(r == 0):
+                offsets = np.zeros((1, 2), dtype=np.int64)
+            else:
+                steps = np.arange(-r, r + 1)
+                sides = np.concatenate((np.full(2 * r + 1, -r), np.full(2 * r + 1, r)))
+                offsets = np.concatenate((
+                    np.column_stack((sides, np.tile(steps, 2))),
+                    np.column_stack((np.tile(steps[1:-1], 2),
+                                     np.repeat([-r, r], 2 * r - 1)))))
+
+            queries = np.repeat(active, len(offsets))
+            (queries, indices, dists) = self._cell_entries(
+                qx, qy, queries,
+                cell_x[queries] + np.tile(offsets[:, 0], len(active)),
+                cell_y[queries] + np.tile(offsets[:, 1], len(active)))
+            if(len(queries) > 0):
+                merge_k_best(best_index, best_dist, queries, indices, dists)
+
+            # The distance to the nearest edge of the searched block of cells.
+            # Edges with no cells beyond them don't count
+            x = qx[active]
+            y = qy[active]
+            low_x = cell_x[active] - r
+            hi_x = cell_x[active] + r + 1
+            low_y = cell_y[active] - r
+            hi_y = cell_y[active] + r + 1
+            bound = np.minimum(
+                np.minimum(np.where(low_x > 0, x - (self.min_x + low_x * self.cell_size), np.inf),
+                           np.where(hi_x < self.num_x, self.min_x + hi_x * self.cell_size - x, np.inf)),
+                np.minimum(np.where(low_y > 0, y - (self.min_y + low_y * self.cell_size), np.inf),
+                           np.where(hi_y < self.num_y, self.min_y + hi_y * self.cell_size - y, np.inf)))
+            done = (best_dist[active, k - 1] <= bound * bound) | np.isinf(bound)
+            active = active[~done]
+            r += 1
+
+        return best_index, best_dist
+
+    def _radius_block(self, qx, qy, radius):
+        num_queries = len(qx)
+        # Every cell that overlaps the square around a query point
+        (low_x, low_y) = (np.floor((qx - radius - self.min_x) / self.cell_size).astype(np.int64),
+                          np.floor((qy - radius - self.min_y) / self.cell_size).astype(np.int64))
+        span = int(np.ceil(2 * radius / self.cell_size)) + 1
+        offsets = np.arange(span)
+        queries = np.repeat(np.arange(num_queries), span * span)
+        cell_x = low_x[queries] + np.tile(np.repeat(offsets, span), num_queries)
+        cell_y = low_y[queries] + np.tile(np.tile(offsets, span), num_queries)
+
+        (queries, indices, dists) = self._cell_entries(qx, qy, queries, cell_x, cell_y)
+        inside = dists <= radius * radius
+        return group_by_query(queries[inside], indices[inside], dists[inside], num_queries)
@@ -10,6 +10,7 @@ Created on Fri Dec  5 16:30:53 2014
 @author: brian
 """
 from itertools import imap
+import numpy as np
 
 
 # A KD-Tree which supports nearest-neighbor lookup.  It also has a get_leaf()
@@ -146,6 +147,82 @@ class KDTree:
                 self.low_child.get_height(),
                 self.hi_child.get_height()) + 1
 
+# Converts a KDTree into flat arrays, so that it can be saved to disk.  The tree
+# nodes are stored in preorder, so the low child of tree node i is i+1
+# Params:
+    # tree - the KDTree
+    # index_of - a dictionary which maps each data point to an integer
+# Returns:
+    # a dictionary of numpy arrays, which can be given to kdtree_from_arrays()
+def kdtree_to_arrays(tree, index_of):
+    split_dims = []
+    split_vals = []
+    hi_children = []
+    leaf_starts = []
+    leaf_ends = []
+    point_indices = []
+
+    # Iterative preorder traversal.  The hi child's index is only known once the
+    # whole low subtree has been visited, so it is filled in when it is reached
+    stack = [(tree, -1)]
+    while(stack):
+        (node, parent) = stack.pop()
+        i = len(split_dims)
+        if(parent >= 0):
+            hi_children[parent] = i
+        split_dims.append(node.split_dim)
+        split_vals.append(node.split_val)
+        hi_children.append(-1)
+        if(node.data is not None):
+            leaf_starts.append(len(point_indices))
+            point_indices.extend(index_of[point] for point in node.data)
+            leaf_ends.append(len(point_indices))
+        else:
+            leaf_starts.append(-1)
+            leaf_ends.append(-1)
+            # The hi child is pushed first, so the low child is visited next
+            stack.append((node.hi_child, i))
+            stack.append((node.low_child, -1))
+
+    return {'split_dims': np.array(split_dims, dtype=np.int8),
+            'split_vals': np.array(split_vals, dtype=np.float64),
+            'hi_children': np.array(hi_children, dtype=np.int32),
+            'leaf_starts': np.array(leaf_starts, dtype=np.int32),
+            'leaf_ends': np.array(leaf_ends, dtype=np.int32),
+            'point_indices': np.array(point_indices, dtype=np.int32)}
+
+
+# Rebuilds a KDTree from the arrays made by kdtree_to_arrays(), without having to
+# sort the data again
+# Params:
+    # arrays - a dictionary of arrays, as returned by kdtree_to_arrays()
+    # points - a list of the data points, indexed like in kdtree_to_arrays()
+# Returns:
+    # the root of the KDTree
+def kdtree_from_arrays(arrays, points):
+    split_dims = arrays['split_dims'].tolist()
+    split_vals = arrays['split_vals'].tolist()
+    hi_children = arrays['hi_children'].tolist()
+    leaf_starts = arrays['leaf_starts'].tolist()
+    leaf_ends = arrays['leaf_ends'].tolist()
+    point_indices = arrays['point_indices'].tolist()
+
+    # An empty list of data makes a leaf without any work - the real attributes
+    # are filled in below
+    trees = [KDTree([], split_dims[i]) for i in xrange(len(split_dims))]
+    for i in xrange(len(trees)):
+        tree = trees[i]
+        if(leaf_starts[i] >= 0):
+            tree.data = [points[j] for j in
+                         point_indices[leaf_starts[i]:leaf_ends[i]]]
+        else:
+            tree.split_val = split_vals[i]
+            tree.low_child = trees[i + 1]
+            tree.hi_child = trees[hi_children[i]]
+            tree.data = None
+    return trees[0]
+
+
 # For testing purposes - finds the nearest neighbor to a query point brute
 # force style
 # It should return the same value as KDTree.nearest_neighbor_query() but slower
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Landmark (ALT) lower bounds for A* search on an ArrayGraph.
+
+A few landmark nodes are picked by farthest-point selection, and the travel times
+from every landmark to every node (and from every node to every landmark) are
+precomputed.  By the triangle inequality, for any landmark L
+    time(v, t) >= time(v, L) - time(t, L)
+    time(v, t) >= time(L, t) - time(L, v)
+which is usually a much tighter bound than the straight-line distance divided by
+the maximum speed.  See "Computing the Shortest Path: A* Search Meets Graph
+Theory", Goldberg and Harrelson, 2005.
+
+The bounds are only valid for the link times they were computed with, so the
+tables are recomputed whenever the ArrayGraph's link times change.
+
+@author: brian
+"""
+from multiprocessing import Pool
+import numpy as np
+
+from ArcFlagsBuilder import dijkstra_times
+
+
+# Holds the graph of a worker process
+_worker_state = {}
+
+
+# Pool initializer - stores the list form of the graph in the worker process
+def _init_worker(graph):
+    _worker_state['forward'] = (graph.forward_offsets.tolist(),
+                                graph.forward_targets.tolist(),
+                                graph.forward_link_ids.tolist())
+    _worker_state['backward'] = (graph.backward_offsets.tolist(),
+                                 graph.backward_sources.tolist(),
+                                 graph.backward_link_ids.tolist())
+    _worker_state['link_times'] = graph.link_times.tolist()
+
+
+# Pool task - one Dijkstra search from (or, on the backward graph, to) a landmark
+def _landmark_task(args):
+    (landmark, direction) = args
+    (offsets, neighbors, link_ids) = _worker_state[direction]
+    return dijkstra_times(landmark, offsets, neighbors, link_ids,
+                          _worker_state['link_times'])
+
+
+# Picks landmarks that are spread out over the graph.  Each new landmark is the
+# node that is farthest (by link length) from all landmarks picked so far.
+# Lengths are used instead of times, so that the landmarks stay the same when the
+# times change
+# Params:
+    # graph - the ArrayGraph
+    # num_landmarks - the number of landmarks to pick
+    # start_node - the node index used to find the first landmark
+# Returns:
+    # a list of node indices
+def select_landmarks(graph, num_landmarks, start_node=0):
+    offsets = graph.forward_offsets.tolist()
+    targets = graph.forward_targets.tolist()
+    link_ids = graph.forward_link_ids.tolist()
+    lengths = graph.link_lengths.tolist()
+
+    def farthest(dist):
+        # Nodes that can't be reached at all are not useful as landmarks
+        dist = np.where(np.isfinite(dist), dist, -1)
+        return int(np.argmax(dist))
+
+    # The first landmark is the node farthest from start_node
+    min_dist = dijkstra_times(start_node, offsets, targets, link_ids, lengths)
+    landmarks = []
+    next_landmark = farthest(min_dist)
+    min_dist[:] = np.inf
+    while(len(landmarks) < min(num_landmarks, graph.num_nodes)):
+        landmarks.append(next_landmark)
+        dist = dijkstra_times(next_landmark, offsets, targets, link_ids, lengths)
+        np.minimum(min_dist, dist, out=min_dist)
+        next_landmark = farthest(min_dist)
+        if(min_dist[next_landmark] <= 0):
+            break
+    return landmarks
+
+
+# Travel time tables for a set of landmarks, and the A* potentials built from them
+class Landmarks:
+    # Params:
+        # graph - the ArrayGraph
+        # num_landmarks - the number of landmarks
+        # num_processes - the number of processes used to recompute the tables.
+            # 1 means no parallelism
+        # num_active - the number of landmarks used by each query.  The ones that
+            # give the best bound between the origin and destination are chosen
+    def __init__(self, graph, num_landmarks=16, num_processes=1, num_active=4):
+        self.graph = graph
+        self.num_processes = num_processes
+        self.num_active = num_active
+        self.landmarks = select_landmarks(graph, num_landmarks)
+
+        self.time_version = None
+        self.refresh()
+
+    # Recomputes the tables, if the link times of the graph have changed
+    def refresh(self):
+        if(self.time_version != self.graph.time_version):
+            self.compute_tables()
+
+    # Runs one forward and one backward Dijkstra search per landmark
+    def compute_tables(self):
+        version = self.graph.time_version
+        tasks = ([(landmark, 'forward') for landmark in self.landmarks] +
+                 [(landmark, 'backward') for landmark in self.landmarks])
+
+        if(self.num_processes <= 1):
+            _init_worker(self.graph)
+            results = map(_landmark_task, tasks)
+        else:
+            pool = Pool(self.num_processes, initializer=_init_worker,
+                        initargs=(self.graph,))
+            try:
+                results = pool.map(_landmark_task, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+        num_landmarks = len(self.landmarks)
+        # from_landmark[i, v] = time(landmark i, v), to_landmark[i, v] = time(v, landmark i)
+        self.from_landmark = np.array(results[:num_landmarks])
+        self.to_landmark = np.array(results[num_landmarks:])
+        self._make_lists()
+        self.time_version = version
+
+    # List copies of the tables, which are much faster to index one at a time
+    def _make_lists(self):
+        self._from_lists = [row.tolist() for row in self.from_landmark]
+        self._to_lists = [row.tolist() for row in self.to_landmark]
+
+    # The lists are rebuilt after unpickling, instead of being sent along
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_from_lists']
+        del state['_to_lists']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._make_lists()
+
+    # Returns the best lower bound on the travel time from node u to node v
+    def lower_bound(self, u, v):
+        bound = np.maximum(self.to_landmark[:, u] - self.to_landmark[:, v],
+                           self.from_landmark[:, v] - self.from_landmark[:, u])
+        return max(0.0, bound.max())
+
+    # Builds the forward potential for a bidirectional search, which is half of
+    # (bound to the destination - bound from the origin), as in Ikeda et al.
+    # The backward potential is its negative.
+    # Params:
+        # origin, destination - node indices of the query
+    # Returns:
+        # a function that maps a node index to its forward potential
+    def make_potential(self, origin, destination):
+        # Pick the landmarks with the best bounds for this query
+        bounds = np.maximum(
+            self.to_landmark[:, origin] - self.to_landmark[:, destination],
+            self.from_landmark[:, destination] - self.from_landmark[:, origin])
+        active = np.argsort(-bounds)[:self.num_active].tolist()
+
+        tables = []
+        for i in active:
+            to_l = self._to_lists[i]
+            from_l = self._from_lists[i]
+            tables.append((to_l, from_l,
+                           to_l[origin], from_l[origin],
+                           to_l[destination], from_l[destination]))
+
+        def potential(v):
+            to_dest = 0.0
+            from_origin = 0.0
+            for (to_l, from_l, to_o, from_o, to_d, from_d) in tables:
+                to_v = to_l[v]
+                from_v = from_l[v]
+                # Lower bound of time(v, destination)
+                bound = to_v - to_d
+                if(bound > to_dest):
+                    to_dest = bound
+                bound = from_d - from_v
+                if(bound > to_dest):
+                    to_dest = bound
+                # Lower bound of time(origin, v)
+                bound = to_o - to_v
+                if(bound > from_origin):
+                    from_origin = bound
+                bound = from_v - from_o
+                if(bound > from_origin):
+                    from_origin = bound
+            return 0.5 * (to_dest - from_origin)
+
+        return potential
@@ -1,5 +1,12 @@
+from SlotObject import SlotObject
+
+
 # A class that represents the links in the map that connect two nodes together
-class Link:
+class Link(SlotObject):
+    __slots__ = ('origin_node_id', 'connecting_node_id', 'length', 'time', 'speed',
+                 'origin_node', 'connecting_node', 'link_id', 'num_trips', 'offset',
+                 'proposed_time', 'forward_arcflags', 'backward_arcflags')
+
     def __init__(self, begin_node_id, end_node_id, length, speed=10):
         self.origin_node_id = int(begin_node_id)
         self.connecting_node_id = int(end_node_id)
@@ -10,15 +17,22 @@ class Link:
         
         self.link_id = 0
         self.num_trips = 0
+
+        # Packed arc flags (bit r = flag for region r), None until computed
+        self.forward_arcflags = None
+        self.backward_arcflags = None
     
 
     
-    # dummy method - should be fixed later
+    # Returns the forward and backward arc flags as hexadecimal strings, so
+    # that they can be stored in text.  Bit r is the flag for region r, e.g.
+    # RegionNumber           = 7, 6, 5, 4, 3, 2, 1, 0
+    # forward_arcflags       = 0, 1, 1, 0, 1, 1, 0, 1
+    # HexString              = 6d
     def get_arcflags_hex(self):
-        forward_hex =  hex(self.origin_node_id)[2:] + hex(self.connecting_node_id)[2:]
-        backward_hex =  hex(self.connecting_node_id)[2:] + hex(self.origin_node_id)[2:]
-        return (forward_hex, backward_hex)
-        
-    # dummy method - should be fixed later
+        return ('%x' % self.forward_arcflags, '%x' % self.backward_arcflags)
+
+    # Sets the arc flags from hexadecimal strings made by get_arcflags_hex()
     def set_arcflags(self, forward_arcflags_hex, backward_arcflags_hex):
-        pass
\ No newline at end of file
+        self.forward_arcflags = int(forward_arcflags_hex, 16)
+        self.backward_arcflags = int(backward_arcflags_hex, 16)
@@ -1,14 +1,33 @@
 from KDTree import KDTree
+from ArrayKDTree import ArrayKDTree
+from GridIndex import GridIndex
 import csv
 from Node import Node
 from Link import Link
 from traffic_estimation.Trip import Trip
-from BiDirectionalSearch import bidirectional_search
-from SCC import kosaraju
+from SCC import scc_labels, node_adjacency
+from ArrayGraph import build_array_graph
+from ArraySearch import ArraySearch
+from ArcFlagsBuilder import compute_arcflags
+from Landmarks import Landmarks
+from MapSnapshot import snapshot_key, save_snapshot, load_snapshot
+from ContractionHierarchy import ContractionHierarchy
+from SharedRouter import SharedRouter
 from datetime import datetime
 from random import shuffle
+from itertools import islice
+import copy
+import time
+import numpy as np
 
 
+# The spatial indexes which can be used for batch node lookups (see SpatialIndex)
+SPATIAL_INDEX_TYPES = {'kdtree': ArrayKDTree, 'grid': GridIndex}
+
+# Starts the last header column of an arc flags file, followed by the checksum of
+# the link times the flags were computed with (see save_arcflags())
+ARCFLAGS_CHECKSUM_PREFIX = 'link_times:'
+
 # Represents a roadmap, has a set of Nodes and Links
 
 
@@ -43,6 +62,134 @@ class Map:
         node, dist = self.lookup_kd_tree.nearest_neighbor_query(coordinates)
         return node
 
+    # Returns the spatial index of the node locations used for batch lookups,
+    # building it if necessary.  Point i of the index is self.nodes[i]
+    def get_spatial_index(self):
+        if(self.spatial_index is None):
+            graph = self.get_array_graph()
+            index_class = SPATIAL_INDEX_TYPES[self.spatial_index_type]
+            self.spatial_index = index_class(np.column_stack((graph.node_x, graph.node_y)))
+        return self.spatial_index
+
+    # Chooses the kind of spatial index used for batch lookups
+    # Params:
+        # index_type - one of the keys of SPATIAL_INDEX_TYPES
+    def set_spatial_index_type(self, index_type):
+        if(index_type not in SPATIAL_INDEX_TYPES):
+            raise ValueError("Unknown spatial index type: " + str(index_type))
+        if(index_type != self.spatial_index_type):
+            self.spatial_index_type = index_type
+            self.spatial_index = None
+
+    # Benchmarks every kind of spatial index on a sample of coordinates, and keeps
+    # the one that answers the queries fastest.  All of them give the same results,
+    # but which one is faster depends on how the nodes are spread out
+    # Params:
+        # lats - an array-like of sample latitudes
+        # lons - an array-like of sample longitudes
+        # repeats - the number of times the queries are timed (the best time counts)
+    # Returns:
+        # A dictionary that maps each index type to (build time, query time) in seconds
+    def select_spatial_index(self, lats, lons, repeats=3):
+        timings = {}
+        for index_type in sorted(SPATIAL_INDEX_TYPES):
+            self.set_spatial_index_type(index_type)
+            t1 = time.time()
+            self.get_spatial_index()
+            build_time = time.time() - t1
+
+            query_time = float('inf')
+            for _ in xrange(repeats):
+                t1 = time.time()
+                self.get_nearest_node_indices(lats, lons)
+                query_time = min(query_time, time.time() - t1)
+            timings[index_type] = (build_time, query_time)
+
+        best_type = min(timings, key=lambda index_type: timings[index_type][1])
+        self.set_spatial_index_type(best_type)
+        return timings
+
+    # Converts coordinates to the meters used by the spatial index
+    # Returns:
+        # inside - a boolean array, which is False for coordinates outside of the Map
+            # (or NaN)
+        # xs, ys - the coordinates of the points which are inside, in meters
+    def _spatial_query_points(self, lats, lons, LAT_METERS, LON_METERS):
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        # Written this way, NaN coordinates are also treated as outside
+        with np.errstate(invalid='ignore'):
+            inside = ((lats >= self.min_lat) & (lats <= self.max_lat) &
+                      (lons >= self.min_lon) & (lons <= self.max_lon))
+        return inside, lats[inside] * LAT_METERS, lons[inside] * LON_METERS
+
+    # Batch version of get_nearest_node(), which snaps many coordinates at once
+    # Params:
+        # lats - an array-like of query latitudes
+        # lons - an array-like of query longitudes
+        # LAT_METERS, LON_METERS - see get_nearest_node()
+    # Returns:
+        # An array with the index (in self.nodes) of the nearest Node to each
+        # coordinate, or -1 for coordinates outside of the Map
+    def get_nearest_node_indices(
+            self,
+            lats,
+            lons,
+            LAT_METERS=111194.86461,
+            LON_METERS=84253.1418965):
+        (inside, xs, ys) = self._spatial_query_points(lats, lons, LAT_METERS, LON_METERS)
+        indices = np.full(len(inside), -1, dtype=np.int64)
+        indices[inside], _ = self.get_spatial_index().query(xs, ys)
+        return indices
+
+    # Same as get_nearest_node_indices(), but returns the node_ids of the Nodes
+    # (or -1 for coordinates outside of the Map)
+    def get_nearest_node_ids(self, lats, lons):
+        indices = self.get_nearest_node_indices(lats, lons)
+        return np.where(indices >= 0, self.get_array_graph().node_ids[indices], -1)
+
+    # Finds the k nearest Nodes to many coordinates at once
+    # Params:
+        # lats - an array-like of query latitudes
+        # lons - an array-like of query longitudes
+        # k - the number of Nodes to find for each coordinate
+        # LAT_METERS, LON_METERS - see get_nearest_node()
+    # Returns:
+        # A (num_coordinates x k) array of indices in self.nodes, nearest first.
+        # Rows of coordinates outside of the Map are all -1
+    def get_k_nearest_node_indices(
+            self,
+            lats,
+            lons,
+            k,
+            LAT_METERS=111194.86461,
+            LON_METERS=84253.1418965):
+        (inside, xs, ys) = self._spatial_query_points(lats, lons, LAT_METERS, LON_METERS)
+        indices = np.full((len(inside), k), -1, dtype=np.int64)
+        indices[inside], _ = self.get_spatial_index().query_knn(xs, ys, k)
+        return indices
+
+    # Finds all Nodes within a distance of many coordinates at once
+    # Params:
+        # lats - an array-like of query latitudes
+        # lons - an array-like of query longitudes
+        # radius - the distance in meters
+        # LAT_METERS, LON_METERS - see get_nearest_node()
+    # Returns:
+        # A list with an array of indices in self.nodes for each coordinate, nearest
+        # first.  The arrays of coordinates outside of the Map are empty
+    def get_node_indices_within_radius(
+            self,
+            lats,
+            lons,
+            radius,
+            LAT_METERS=111194.86461,
+            LON_METERS=84253.1418965):
+        (inside, xs, ys) = self._spatial_query_points(lats, lons, LAT_METERS, LON_METERS)
+        found = iter(self.get_spatial_index().query_radius(xs, ys, radius))
+        empty = np.array([], dtype=np.int64)
+        return [next(found) if is_inside else empty for is_inside in inside.tolist()]
+
     # Gets the region that a point is in geometrically
     # Params:
         # point - an array-like that contains coordinates(like a Node or tuple)
@@ -113,6 +260,22 @@ class Map:
         for link in self.links:
             link.time = link.length / speed
 
+    # Makes a copy of the Map with copies of its Links, which keep the current travel
+    # times and trip counts.  The other attributes (Nodes, indexes, ...) are shared,
+    # so it should only be used to read the link times (e.g. to save them while
+    # this Map is already being used to estimate the next hour)
+    def copy_link_times(self):
+        road_map = copy.copy(self)
+        road_map.links = []
+        for link in self.links:
+            new_link = Link(link.origin_node_id, link.connecting_node_id, link.length)
+            new_link.time = link.time
+            new_link.num_trips = link.num_trips
+            new_link.link_id = link.link_id
+            road_map.links.append(new_link)
+        road_map.idle_link = road_map.links[self.idle_link.link_id]
+        return road_map
+
 
 
     # An iterator function that returns the speeds of all links in list of lists format
@@ -206,13 +369,18 @@ class Map:
         # limit_bbox - An optional bounding box for limiting the size of the graph.
             # Nodes/Links outside of this box will be ignored.
             # Should be a tuple (left_lon, top_lat, right_lon, bottom_lat)
+        # snapshot_dir - An optional directory for a binary snapshot of the Map (see
+            # MapSnapshot).  If it holds a snapshot for the same files and arguments,
+            # the Map is loaded from it instead of the CSV files.  Otherwise, the Map
+            # is built from the CSV files and a new snapshot is saved there
     def __init__(
             self,
             nodes_fn,
             links_fn,
             lookup_kd_size=1,
             region_kd_size=1000,
-            limit_bbox = None):
+            limit_bbox = None,
+            snapshot_dir = None):
         
         if(limit_bbox!=None):
             (left_lon, top_lat, right_lon, bottom_lat) = limit_bbox
@@ -230,11 +398,33 @@ class Map:
         self.links_by_node_id = {}
 
         self.total_region_count = 0
+
+        # Array-backed copy of the graph, built on demand by get_array_graph()
+        self.array_graph = None
+        self.array_search = None
+        # Optional ContractionHierarchy, see build_contraction_hierarchy()
+        self.contraction_hierarchy = None
+        # Optional Landmarks for the A* heuristic, see build_landmarks()
+        self.landmarks = None
+        # The ArrayGraph.get_times_checksum() of the link times the arc flags of the
+        # Links were computed with, see compute_arcflags()
+        self.arcflags_checksum = None
+        # Pool of routing worker processes, see get_shared_router()
+        self.shared_router = None
+        # Spatial index for batch lookups, see get_spatial_index()
+        self.spatial_index_type = 'kdtree'
+        self.spatial_index = None
         
         self.isFlat = False
         self.region_kd_size = region_kd_size
         self.lookup_kd_size = lookup_kd_size
 
+        if(snapshot_dir is not None):
+            key = snapshot_key(nodes_fn, links_fn, lookup_kd_size, region_kd_size,
+                               limit_bbox)
+            if(load_snapshot(self, snapshot_dir, key)):
+                return
+
         # Read nodes file and create node objects
         with open(nodes_fn, "r") as f:
             csv_reader = csv.reader(f)
@@ -337,36 +527,200 @@ class Map:
         # Build the KD trees
         self.build_kd_trees()
 
+        if(snapshot_dir is not None):
+            save_snapshot(self, snapshot_dir, key)
+
 
     # Cleans the graph by forcing it to be one large strongly connected component
     # The largest strongly connected component is extracted from the raw graph,
-    # and nodes/links in the remaining SCCs are deleted.
+    # and nodes/links in the remaining SCCs are deleted.  The remaining Links are
+    # renumbered, so link_ids are still positions in self.links
     def remove_extra_sccs(self):
         # find strongly connected components
-        sccs = kosaraju(self.nodes)
-        
-        # determine which scc is largest
-        largest_scc = []
-        for scc in sccs:
-            if(len(scc) > len(largest_scc)):
-                largest_scc = scc
-                
-        # find nodes in other small sccs
-        bad_nodes = set()
-        for scc in sccs:
-            if(scc!=largest_scc):
-                bad_nodes.update(scc)
-        
+        labels = scc_labels(*node_adjacency(self.nodes))
+        if(len(labels) == 0):
+            return
+
+        # determine which scc is largest, and find nodes in the other small sccs
+        largest_label = np.argmax(np.bincount(labels))
+        keep = (labels == largest_label).tolist()
+        bad_nodes = set(node for node, is_kept in zip(self.nodes, keep) if not is_kept)
+        if(len(bad_nodes) == 0):
+            return
+
         # remove these nodes from the graph
-        self.nodes = [node for node in self.nodes if node not in bad_nodes]
+        self.nodes = [node for node, is_kept in zip(self.nodes, keep) if is_kept]
+        for node in bad_nodes:
+            del self.nodes_by_id[node.node_id]
 
         # remove links connected to these nodes
-        for node in bad_nodes:
-            for link in node.forward_links:
-                link.connecting_node.backward_links.remove(link)
-            for link in node.backward_links:
-                link.origin_node.forward_links.remove(link)
+        for node in self.nodes:
+            node.forward_links = [link for link in node.forward_links
+                                  if link.connecting_node not in bad_nodes]
+            node.backward_links = [link for link in node.backward_links
+                                   if link.origin_node not in bad_nodes]
+
+        # compact the list of links.  The idle link is always last
+        self.links = [link for link in self.links[:-1]
+                      if link.origin_node not in bad_nodes and
+                      link.connecting_node not in bad_nodes]
+        self.links_by_node_id = {}
+        for i, link in enumerate(self.links):
+            link.link_id = i
+            self.links_by_node_id[link.origin_node_id, link.connecting_node_id] = link
+        self.idle_link.link_id = len(self.links)
+        self.links.append(self.idle_link)
+
+        # The array forms of the graph are out of date
+        self.array_graph = None
+        self.array_search = None
+        self.spatial_index = None
+        self.close_shared_router()
+
 
+    # Returns an ArrayGraph (compact CSR form of this Map), building it if necessary.
+    # Node indices in the ArrayGraph are positions in self.nodes, and link ids are
+    # positions in self.links.  Note that the travel times are copied, so
+    # ArrayGraph.update_link_times() must be called after Link.time changes
+    def get_array_graph(self):
+        if(self.array_graph is None):
+            self.array_graph = build_array_graph(self.nodes, self.links)
+        return self.array_graph
+
+    # Returns the ArraySearch used by find_shortest_path(), building it if necessary
+    def get_array_search(self):
+        if(self.array_search is None):
+            self.array_search = ArraySearch(self.get_array_graph())
+        return self.array_search
+
+    # Orders and contracts the graph, so that find_shortest_path() can use
+    # contraction hierarchy queries.  This only depends on the topology of the Map,
+    # so it only has to be done once.  Changes in travel times are picked up by a
+    # (much cheaper) re-customization in update_routing_times().  This is optional -
+    # the contraction and the re-customizations only pay off if many trips are routed
+    # between changes of the travel times (see ContractionHierarchy)
+    def build_contraction_hierarchy(self):
+        self.update_routing_times()
+        self.contraction_hierarchy = ContractionHierarchy(self.get_array_graph())
+
+    # Picks landmarks and computes their travel time tables, so that the A* searches
+    # of find_shortest_path() use landmark bounds instead of Euclidean ones.
+    # The tables are recomputed in update_routing_times()
+    # Params:
+        # num_landmarks - the number of landmarks
+        # num_processes - the number of processes used to compute the tables
+    def build_landmarks(self, num_landmarks=16, num_processes=1):
+        self.update_routing_times()
+        self.landmarks = Landmarks(self.get_array_graph(), num_landmarks=num_landmarks,
+                                   num_processes=num_processes)
+
+    # Copies the current Link.time values into the ArrayGraph.  This must be
+    # called after the travel times change, before the next search
+    def update_routing_times(self):
+        self.get_array_graph().update_link_times(self.links)
+        if(self.contraction_hierarchy is not None):
+            self.contraction_hierarchy.refresh()
+        if(self.landmarks is not None):
+            self.landmarks.refresh()
+
+    # Computes arc flags for every region, using the current Link.time values.
+    # The flags are stored on the Links and the ArrayGraph.  They must be
+    # recomputed (or reloaded) if the travel times change - until then, searches
+    # don't use them
+    # Params:
+        # num_processes - the number of processes used to compute the regions in parallel
+    def compute_arcflags(self, num_processes=1):
+        if(self.total_region_count == 0):
+            self.assign_node_regions()
+        self.update_routing_times()
+        (forward_flags,
+         backward_flags) = compute_arcflags(self.get_array_graph(),
+                                            [node.region_id for node in self.nodes],
+                                            self.total_region_count,
+                                            num_processes)
+        for link in self.links:
+            link.forward_arcflags = forward_flags[link.link_id]
+            link.backward_arcflags = backward_flags[link.link_id]
+        self.arcflags_checksum = self.get_array_graph().get_times_checksum()
+        self.attach_arcflags()
+
+    # Copies the arc flags of the Links into the ArrayGraph, with the checksum of
+    # the link times they were computed with
+    def attach_arcflags(self):
+        self.get_array_graph().set_arcflags(
+            [node.region_id for node in self.nodes],
+            [link.forward_arcflags or 0 for link in self.links],
+            [link.backward_arcflags or 0 for link in self.links],
+            self.arcflags_checksum)
+
+    # Saves the arc flags to a CSV file, as hexadecimal strings.  The checksum of
+    # the link times they were computed with is stored in the header
+    # Params:
+        # filename - the CSV file to write
+    def save_arcflags(self, filename):
+        with open(filename, 'wb') as f:
+            writer = csv.writer(f)
+            writer.writerow(['start_node_id', 'end_node_id',
+                             'forward_arc_flags', 'backward_arc_flags',
+                             ARCFLAGS_CHECKSUM_PREFIX + str(self.arcflags_checksum)])
+            for link in self.links:
+                if(link != self.idle_link and link.forward_arcflags is not None):
+                    (forward_hex, backward_hex) = link.get_arcflags_hex()
+                    writer.writerow([link.origin_node_id, link.connecting_node_id,
+                                     forward_hex, backward_hex])
+
+    # Loads arc flags from a CSV file written by save_arcflags().  The regions are
+    # assigned the same way as when the flags were computed, so the Map must be
+    # built from the same files, with the same region_kd_size.  Searches only use
+    # the flags while the routing times (see update_routing_times()) are the ones
+    # they were computed with.  Files without a checksum are never used
+    # Params:
+        # filename - the CSV file to read
+    def load_arcflags(self, filename):
+        if(self.total_region_count == 0):
+            self.assign_node_regions()
+        with open(filename, 'rb') as f:
+            csv_reader = csv.reader(f)
+            header = csv_reader.next()
+            self.arcflags_checksum = ''
+            if(len(header) > 4 and header[4].startswith(ARCFLAGS_CHECKSUM_PREFIX)):
+                self.arcflags_checksum = header[4][len(ARCFLAGS_CHECKSUM_PREFIX):]
+            for [start_node_id, end_node_id, forward_hex, backward_hex] in csv_reader:
+                key = (int(start_node_id), int(end_node_id))
+                if(key in self.links_by_node_id):
+                    self.links_by_node_id[key].set_arcflags(forward_hex, backward_hex)
+        self.attach_arcflags()
+
+    # Finds the shortest path between two Nodes, using the ArrayGraph.  If a
+    # contraction hierarchy has been built, it is used instead of the A* search.
+    # If landmarks have been built, A* uses them instead of the Euclidean heuristic
+    # Params:
+        # origin_node - the Node at the beginning of the path
+        # dest_node - the Node at the end of the path
+        # use_astar - use euclidean distance heuristic to guide the search using A*
+        # max_speed - maximum speed on any link in the graph. used for the A* heuristic
+        # use_arcflags - prune the search with arc flags (see compute_arcflags())
+    # Returns:
+        # a list of Links on the shortest path, in order, or None if no such path exists
+    def find_shortest_path(self, origin_node, dest_node, use_astar=True, max_speed=1.0,
+                           use_arcflags=False):
+        graph = self.get_array_graph()
+        origin = graph.get_node_index(origin_node)
+        destination = graph.get_node_index(dest_node)
+        if(self.contraction_hierarchy is not None):
+            link_ids = self.contraction_hierarchy.find_path(origin, destination)
+        else:
+            link_ids = self.get_array_search().bidirectional_search(
+                origin, destination, use_astar=use_astar, max_speed=max_speed,
+                use_arcflags=use_arcflags, landmarks=self.landmarks)
+        if(link_ids is None):
+            return None
+        return self.get_links_from_ids(link_ids)
+
+    # Converts a list of link ids (e.g. the output of a search on the ArrayGraph)
+    # back into Link objects
+    def get_links_from_ids(self, link_ids):
+        return [self.links[_id] for _id in link_ids]
 
     # Builds KD trees to spatially index the nodes of the graph.  This makes
     # geographic queries much faster
@@ -382,18 +736,32 @@ class Map:
     # are edited "in place", this function still returns a subset of them.  The trip.dup_times
     # attribute is set, which
     # Params:
-        # trips - a list of Trip objects to be map-matched
-    def match_trips_to_nodes(self, trips):
+        # trips - a list (or any iterable, such as db_trip.iter_pickup_dt()) of Trip
+            # objects to be map-matched.  They are read batch_size at a time, and only
+            # the unique valid trips are kept, so a generator is never held in memory
+        # batch_size - the number of trips snapped to Nodes at once
+    def match_trips_to_nodes(self, trips, batch_size=10000):
         trip_lookup = {} # lookup a trip by origin, destination nodes
 
-        #First find the nearest origin/destination nodes for each trip
-        #We will also find duplicate trips (same origin,destination nodes)
-        for trip in trips:
-            if(trip.isValid() == Trip.VALID):
+        trips = iter(trips)
+        while(True):
+            batch = list(islice(trips, batch_size))
+            if(len(batch) == 0):
+                break
+            
+            #First find the nearest origin/destination nodes for the whole batch at once
+            valid_trips = [trip for trip in batch if trip.isValid() == Trip.VALID]
+            origins = self.get_nearest_node_indices([trip.fromLat for trip in valid_trips],
+                                                    [trip.fromLon for trip in valid_trips])
+            dests = self.get_nearest_node_indices([trip.toLat for trip in valid_trips],
+                                                  [trip.toLon for trip in valid_trips])
+    
+            #We will also find duplicate trips (same origin,destination nodes)
+            for trip, origin, dest in zip(valid_trips, origins.tolist(), dests.tolist()):
                 trip.num_occurrences = 1
-                trip.origin_node = self.get_nearest_node(trip.fromLat, trip.fromLon)
-                trip.dest_node = self.get_nearest_node(trip.toLat, trip.toLon)
-
+                trip.origin_node = self.nodes[origin] if origin >= 0 else None
+                trip.dest_node = self.nodes[dest] if dest >= 0 else None
+    
                 if((trip.origin_node, trip.dest_node) in trip_lookup):
                     #Already seen this trip at least once
                     trip_lookup[trip.origin_node, trip.dest_node].num_occurrences += 1
@@ -409,6 +777,73 @@ class Map:
         new_trips = [trip_lookup[key] for key in trip_lookup]
         return new_trips
     
+    # Columnar version of match_trips_to_nodes(), for TripBatches.  The trips are
+    # validated and snapped to Nodes with array operations, and Trip objects are
+    # only created for the unique (origin, destination) pairs
+    # Params:
+        # batches - an iterable of TripBatches (e.g. one per columnar batch of
+            # db_trip.iter_pickup_dt(), or from TripCache.iter_batches()).  If the
+            # origin_node_ids of a batch are set, they are used instead of snapping
+    # Returns:
+        # a list of unique Trips, with origin_node, dest_node, num_occurrences and
+        # dup_times set, as returned by match_trips_to_nodes()
+    def match_trip_batches(self, batches):
+        trip_lookup = {} # lookup a trip by origin, destination node indices
+        unique_trips = []
+        num_nodes = len(self.nodes)
+
+        for batch in batches:
+            if(batch.origin_node_ids is not None):
+                # The trips have already been validated and snapped
+                graph = self.get_array_graph()
+                valid = np.nonzero((batch.origin_node_ids >= 0) & (batch.dest_node_ids >= 0))[0]
+                origins = graph.get_node_indices(batch.origin_node_ids[valid])
+                dests = graph.get_node_indices(batch.dest_node_ids[valid])
+            else:
+                valid = np.nonzero(batch.validate() == Trip.VALID)[0]
+                origins = self.get_nearest_node_indices(batch.fromLat[valid], batch.fromLon[valid])
+                dests = self.get_nearest_node_indices(batch.toLat[valid], batch.toLon[valid])
+            found = (origins >= 0) & (dests >= 0)
+            (valid, origins, dests) = (valid[found], origins[found], dests[found])
+
+            # Group the trips by (origin, destination).  The times of each group are
+            # kept in the order of the trips
+            keys = origins * num_nodes + dests
+            (unique_keys, first, inverse) = np.unique(keys, return_index=True,
+                                                      return_inverse=True)
+            order = np.argsort(inverse, kind='mergesort')
+            bounds = np.searchsorted(inverse[order], np.arange(len(unique_keys) + 1)).tolist()
+            times = batch.time[valid][order].tolist()
+            unique_keys = unique_keys.tolist()
+
+            # Create Trips for the pairs which haven't been seen before
+            groups = np.argsort(first, kind='mergesort').tolist()
+            new_groups = [g for g in groups if unique_keys[g] not in trip_lookup]
+            new_trips = batch.to_trips(valid[first[new_groups]])
+            for g, trip in zip(new_groups, new_trips):
+                key = unique_keys[g]
+                trip.origin_node = self.nodes[key // num_nodes]
+                trip.dest_node = self.nodes[key % num_nodes]
+                trip.num_occurrences = 0
+                trip.dup_times = []
+                trip_lookup[key] = trip
+                unique_trips.append(trip)
+
+            for g in groups:
+                trip = trip_lookup[unique_keys[g]]
+                group_times = times[bounds[g]:bounds[g + 1]]
+                trip.num_occurrences += len(group_times)
+                trip.dup_times.extend(group_times)
+
+        return unique_trips
+
+    # The worker processes of the SharedRouter can't be sent to another process,
+    # so the Map is pickled without it
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shared_router'] = None
+        return state
+
     # Replaces references on Node and Link objects with id numbers.  This way the graph can be pickled
     # and, for example, sent to a worker process
     def flatten(self):
@@ -418,13 +853,15 @@ class Map:
         self.isFlat = True
         self.region_kd_tree = None
         self.lookup_kd_tree = None
+        # The search's list copies of the graph are rebuilt on demand
+        self.array_search = None
         
         for node in self.nodes:
             if(node.forward_links!= None):
                 node.forward_link_ids = [link.link_id for link in node.forward_links]
                 node.backward_link_ids = [link.link_id for link in node.backward_links]
                 node.forward_links = None
-                link.backward_links = None
+                node.backward_links = None
         
         for link in self.links:
             if(link.origin_node != None):
@@ -457,17 +894,142 @@ class Map:
     
         self.build_kd_trees()
     
-    def routeTrips(self, trips, num_cpus = 1, max_speed=None):
+    # Splits trips into groups that share an origin Node or a destination Node, so
+    # that each group can be routed with one tree search.  Larger groups are formed
+    # first, and each trip is put in at most one group.
+    # Params:
+        # trips - a list of Trips, with origin_node and dest_node set
+        # min_group_size - groups smaller than this are not formed
+    # Returns:
+        # groups - a list of (node, from_origin, trips) tuples.  If from_origin is True,
+            # all of the trips start at node, otherwise they all end there
+        # single_trips - the Trips which were not put in any group
+    def group_trips_by_endpoint(self, trips, min_group_size=3):
+        by_origin = {}
+        by_dest = {}
+        for trip in trips:
+            by_origin.setdefault(trip.origin_node, []).append(trip)
+            by_dest.setdefault(trip.dest_node, []).append(trip)
+
+        candidates = ([(len(group), True, node, group) for node, group in by_origin.iteritems()] +
+                      [(len(group), False, node, group) for node, group in by_dest.iteritems()])
+        candidates.sort(key=lambda candidate: -candidate[0])
+
+        grouped = set()
+        groups = []
+        for (size, from_origin, node, group) in candidates:
+            if(size < min_group_size):
+                break
+            remaining = [trip for trip in group if id(trip) not in grouped]
+            if(len(remaining) >= min_group_size):
+                groups.append((node, from_origin, remaining))
+                grouped.update(id(trip) for trip in remaining)
+
+        single_trips = [trip for trip in trips if id(trip) not in grouped]
+        return groups, single_trips
+
+    # Routes many trips, using one shortest path tree for each group of trips that
+    # share an origin or destination (see group_trips_by_endpoint()), and a
+    # bidirectional search for each remaining trip.  Sets trip.path_links.
+    # If a contraction hierarchy has been built, its queries are faster than the
+    # tree searches, so each trip is routed on its own instead
+    # Params:
+        # trips - a list of Trips, with origin_node and dest_node set
+        # max_speed - maximum speed on any link in the graph. used for the A* heuristic
+        # min_group_size - the smallest group that is routed with a tree search
+    def route_trips_batched(self, trips, max_speed=1.0, min_group_size=3):
+        if(self.contraction_hierarchy is not None):
+            groups, single_trips = [], trips
+        else:
+            groups, single_trips = self.group_trips_by_endpoint(trips, min_group_size)
+
+        graph = self.get_array_graph()
+        search = self.get_array_search()
+        for (node, from_origin, group) in groups:
+            if(from_origin):
+                targets = [graph.get_node_index(trip.dest_node) for trip in group]
+            else:
+                targets = [graph.get_node_index(trip.origin_node) for trip in group]
+            paths = search.tree_search(graph.get_node_index(node), targets,
+                                       backward=not from_origin)
+            for trip, target in zip(group, targets):
+                link_ids = paths[target]
+                if(link_ids is None):
+                    trip.path_links = None
+                else:
+                    trip.path_links = self.get_links_from_ids(link_ids)
+
+        for trip in single_trips:
+            trip.path_links = self.find_shortest_path(trip.origin_node, trip.dest_node,
+                                                      use_astar=True, max_speed=max_speed)
+
+    # Returns the SharedRouter of this Map - a pool of worker processes which route
+    # on a shared copy of the ArrayGraph.  It is started on the first call, and
+    # kept until close_shared_router(), so the workers (and their search
+    # workspaces) are reused by every call of route_trips_shared()
+    # Params:
+        # num_processes - the number of worker processes.  If the running router
+            # has a different number, it is replaced
+    # Returns:
+        # the SharedRouter
+    def get_shared_router(self, num_processes):
+        if(self.shared_router is not None and
+           self.shared_router.num_processes != num_processes):
+            self.close_shared_router()
+        if(self.shared_router is None):
+            self.update_routing_times()
+            self.shared_router = SharedRouter(self.get_array_graph(), num_processes)
+        return self.shared_router
+
+    # Stops the worker processes of the SharedRouter, if there is one
+    def close_shared_router(self):
+        if(self.shared_router is not None):
+            self.shared_router.close()
+            self.shared_router = None
+
+    # Routes many trips in parallel with a SharedRouter.  Each trip.path_links is
+    # set to its shortest path, or None if there is no path.  Only the link times
+    # are passed on to the workers, and only if they have changed
+    # Params:
+        # trips - a list of Trips, with origin_node and dest_node set
+        # router - a SharedRouter made by get_shared_router()
+        # max_speed - the maximum speed of any link, used by the A* heuristic
+    def route_trips_shared(self, trips, router, max_speed=1.0):
+        graph = self.get_array_graph()
+        router.sync(graph)
+        origins = [graph.get_node_index(trip.origin_node) for trip in trips]
+        destinations = [graph.get_node_index(trip.dest_node) for trip in trips]
+        (paths, _) = router.route(origins, destinations, use_astar=True, max_speed=max_speed)
+        for trip, path in zip(trips, paths):
+            if(path is None):
+                trip.path_links = None
+            else:
+                trip.path_links = self.get_links_from_ids(path)
+
+    # Finds the shortest path for a list of Trips, and sets trip.path_links
+    # Params:
+        # trips - a list of Trips, with origin_node and dest_node set
+        # num_cpus - the number of processes to use (see route_trips_shared())
+        # max_speed - maximum speed on any link in the graph. Will be computed if None
+        # batched - route trips that share an origin or destination together,
+            # see route_trips_batched()
+    def routeTrips(self, trips, num_cpus = 1, max_speed=None, batched=False):
         if(max_speed==None):
             max_speed = self.get_max_speed()
         
         if(num_cpus <= 1):
             #Don't use parallel processing - just route all of the trips
+            self.update_routing_times()
+            if(batched):
+                self.route_trips_batched(trips, max_speed=max_speed)
+                return
             for trip in trips:
-                trip.path_links = bidirectional_search(trip.origin_node, trip.dest_node, use_astar=True, max_speed=max_speed)
+                trip.path_links = self.find_shortest_path(trip.origin_node, trip.dest_node, use_astar=True, max_speed=max_speed)
         else:
-            #Use parallel processing - split the trips into chunks
-            pass
+            #Use parallel processing - the workers route on a shared copy of the graph
+            self.update_routing_times()
+            self.route_trips_shared(trips, self.get_shared_router(num_cpus),
+                                    max_speed=max_speed)
 
 # A simple test that tries various leaf_sizes for the lookup_kd_tree
 # Turns out smaller is always better
@@ -534,6 +1096,25 @@ def benchmark_node_lookup():
         print("leaf_size=" + str(leaf_size) + "   build time: " + str(d2 - d1)
               + "   query time: " + str(d3 - d2))
 
+# Compares the spatial indexes on the pickup locations of a sample of trips
+def benchmark_spatial_indexes():
+    print("Loading")
+    nyc_map = Map("nyc_map4/nodes.csv", "nyc_map4/links.csv")
+    lats = []
+    lons = []
+    with open('sample.csv', 'r') as f:
+        r = csv.reader(f)
+        r.next()  # throw out header
+        for line in r:
+            lons.append(float(line[10]))
+            lats.append(float(line[11]))
+
+    timings = nyc_map.select_spatial_index(lats, lons)
+    for index_type in sorted(timings):
+        (build_time, query_time) = timings[index_type]
+        print("%s   build time: %f   query time: %f" % (index_type, build_time, query_time))
+    print("Using " + nyc_map.spatial_index_type)
+
 # Tests the Map.assign_node_regions() method by looking at a few nodes and
 # their linked neighbors
 # Most of them should have the same region_id
@@ -576,6 +1157,35 @@ def getmem():
     import resource
     return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1000.0
 
+# Approximate size of some objects in MB: the objects themselves (with their
+# __dict__, if they have one) and the values of their attributes.  Values shared
+# by several of the objects are only counted once
+def get_footprint(objects):
+    import sys
+    counted = set(id(obj) for obj in objects)
+    total = 0
+    for obj in objects:
+        total += sys.getsizeof(obj)
+        if(hasattr(obj, '__dict__')):
+            total += sys.getsizeof(obj.__dict__)
+            values = obj.__dict__.values()
+        else:
+            values = obj.__getstate__().values()
+        for value in values:
+            if(id(value) not in counted):
+                counted.add(id(value))
+                total += sys.getsizeof(value)
+    return total / 1000000.0
+
+# Prints how much memory the Nodes, Links and Trips take up
+def print_memory_report(road_map, trips):
+    for name, objects in [("Nodes", road_map.nodes), ("Links", road_map.links),
+                          ("Trips", trips)]:
+        size = get_footprint(objects)
+        per_object = size * 1000000.0 / max(len(objects), 1)
+        print("%s: %d objects, %f MB (%d bytes each)" % (name, len(objects), size, per_object))
+    print("Process: %f" % getmem())
+
 def test_memory_usage():
     from db_functions import db_main, db_trip
     from datetime import datetime
@@ -592,9 +1202,68 @@ def test_memory_usage():
     
 
     print("After : %f" % getmem())
+    print_memory_report(nyc_map, trips)
     del(nyc_map)
 
-    
+# Compares the size of the Node/Link object graph against its ArrayGraph form
+def test_array_graph_memory():
+    print("Before: %f" % getmem())
+    nyc_map = Map("nyc_map4/nodes.csv", "nyc_map4/links.csv", limit_bbox=Map.reasonable_nyc_bbox)
+    print("With object graph: %f" % getmem())
+    graph = nyc_map.get_array_graph()
+    print("ArrayGraph size: %f" % (graph.nbytes() / 1000000.0))
+
+
+# Checks that searches with arc flags stay exact after the link times change (the
+# flags are ignored until they are recomputed), and that flags loaded from a file
+# are only used with the link times they were computed with
+def test_arcflags_after_time_change(nodes_fn="nyc_map4/nodes.csv", links_fn="nyc_map4/links.csv",
+                                    region_kd_size=250, arcflags_fn="arcflags_test.csv",
+                                    num_queries=300):
+    from random import randint, uniform, seed
+    seed(1)
+    road_map = Map(nodes_fn, links_fn, region_kd_size=region_kd_size)
+    road_map.compute_arcflags()
+    road_map.save_arcflags(arcflags_fn)
+    original_times = [link.time for link in road_map.links]
+    queries = [(road_map.nodes[randint(0, len(road_map.nodes) - 1)],
+                road_map.nodes[randint(0, len(road_map.nodes) - 1)]) for _ in xrange(num_queries)]
+
+    def path_time(links):
+        if(links is None):
+            return None
+        return sum([link.time for link in links])
+
+    def check(expect_flags):
+        graph = road_map.get_array_graph()
+        assert graph.arcflags_match_times() == expect_flags
+        for (origin, dest) in queries:
+            exact = path_time(road_map.find_shortest_path(origin, dest, use_astar=False))
+            pruned = path_time(road_map.find_shortest_path(origin, dest, use_astar=False,
+                                                           use_arcflags=True))
+            assert (exact is None and pruned is None) or abs(exact - pruned) < 1e-6, \
+                (origin.node_id, dest.node_id, exact, pruned)
+
+    print("Flags for the current times")
+    check(True)
+
+    print("After one update of the times")
+    for link in road_map.links:
+        link.time *= uniform(0.2, 5)
+    road_map.update_routing_times()
+    check(False)
+
+    print("Loading flags which were computed with other times")
+    road_map.load_arcflags(arcflags_fn)
+    check(False)
+
+    print("Back to the times the loaded flags were computed with")
+    for link, time in zip(road_map.links, original_times):
+        link.time = time
+    road_map.update_routing_times()
+    check(True)
+    print("OK")
+
 
 if(__name__ == "__main__"):
     # benchmark_node_lookup()
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Saves a cleaned Map to a binary snapshot, and loads it back.
+
+Building a Map from CSV files means parsing every row, removing the extra SCCs
+and sorting the nodes into two KD trees.  A snapshot stores the result of all of
+that as a directory of .npy arrays:
+    - the nodes (in the order of Map.nodes) and links (in link_id order)
+    - the region ids, if they have been assigned
+    - the ArrayGraph
+    - both KD trees, flattened by kdtree_to_arrays()
+plus a meta.json file which records the snapshot version, the size and
+modification time of the source CSV files, and the Map constructor arguments.
+A snapshot is only used if all of these match, otherwise the Map is built from the
+CSV files again (and the snapshot is replaced).
+
+The arrays are loaded with mmap_mode='r', so processes on the same host share the
+pages through the OS page cache instead of each holding a copy.
+
+@author: brian
+"""
+import os
+import json
+import shutil
+import numpy as np
+
+from Node import Node
+from Link import Link
+from KDTree import kdtree_to_arrays, kdtree_from_arrays
+from ArrayGraph import ArrayGraph
+
+# Must be incremented whenever the contents of a snapshot change
+SNAPSHOT_VERSION = 2
+
+# The ArrayGraph arrays stored in a snapshot
+GRAPH_ARRAYS = ['node_ids', 'node_x', 'node_y',
+                'forward_offsets', 'forward_targets', 'forward_link_ids',
+                'backward_offsets', 'backward_sources', 'backward_link_ids',
+                'link_origins', 'link_destinations', 'link_lengths', 'link_times']
+
+KDTREE_ARRAYS = ['split_dims', 'split_vals', 'hi_children',
+                 'leaf_starts', 'leaf_ends', 'point_indices']
+
+
+# Describes the inputs of a Map, so that outdated snapshots can be detected
+# Params:
+    # the same as the Map constructor
+# Returns:
+    # a dictionary, which is stored as meta.json
+def snapshot_key(nodes_fn, links_fn, lookup_kd_size, region_kd_size, limit_bbox):
+    sources = {}
+    for name, filename in [('nodes', nodes_fn), ('links', links_fn)]:
+        stat = os.stat(filename)
+        sources[name] = [os.path.abspath(filename), stat.st_size, stat.st_mtime]
+    key = {'version': SNAPSHOT_VERSION,
+           'sources': sources,
+           'lookup_kd_size': lookup_kd_size,
+           'region_kd_size': region_kd_size,
+           'limit_bbox': limit_bbox}
+    # Round trip through JSON, so tuples compare equal to the lists read from disk
+    return json.loads(json.dumps(key))
+
+
+# Saves a Map to a snapshot directory.  The snapshot is written to a temporary
+# directory first and then renamed, so other processes never see half of one.
+# Params:
+    # road_map - the Map, which must not be flat
+    # dirname - the snapshot directory
+    # key - the output of snapshot_key() for this Map
+def save_snapshot(road_map, dirname, key):
+    tmp_dirname = dirname.rstrip('/') + '.tmp.' + str(os.getpid())
+    if(os.path.exists(tmp_dirname)):
+        shutil.rmtree(tmp_dirname)
+    os.makedirs(tmp_dirname)
+
+    def save(name, array):
+        np.save(os.path.join(tmp_dirname, name + '.npy'), array)
+
+    nodes = road_map.nodes
+    save('node_ids', np.array([node.node_id for node in nodes], dtype=np.int64))
+    save('node_lat', np.array([node.lat for node in nodes], dtype=np.float64))
+    save('node_lon', np.array([node.long for node in nodes], dtype=np.float64))
+    save('node_region', np.array([node.region for node in nodes], dtype=np.int64))
+    if(road_map.total_region_count > 0):
+        save('node_region_id', np.array([node.region_id for node in nodes],
+                                        dtype=np.int32))
+        save('node_is_boundary', np.array([node.is_boundary_node for node in nodes],
+                                          dtype=np.bool_))
+
+    # The idle link is always last, and is recreated when loading
+    links = road_map.links[:-1]
+    save('link_origin_ids', np.array([link.origin_node_id for link in links], dtype=np.int64))
+    save('link_dest_ids', np.array([link.connecting_node_id for link in links], dtype=np.int64))
+    save('link_lengths', np.array([link.length for link in links], dtype=np.float64))
+
+    graph = road_map.get_array_graph()
+    for name in GRAPH_ARRAYS:
+        save('graph_' + name, getattr(graph, name))
+
+    index_of = dict((node, i) for i, node in enumerate(nodes))
+    for tree_name, tree in [('lookup_tree', road_map.lookup_kd_tree),
+                            ('region_tree', road_map.region_kd_tree)]:
+        arrays = kdtree_to_arrays(tree, index_of)
+        for name in KDTREE_ARRAYS:
+            save(tree_name + '_' + name, arrays[name])
+
+    meta = dict(key)
+    meta['total_region_count'] = road_map.total_region_count
+    meta['bounds'] = [road_map.min_lat, road_map.max_lat,
+                      road_map.min_lon, road_map.max_lon]
+    with open(os.path.join(tmp_dirname, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    # Replace any old snapshot.  If another process got there first, keep theirs
+    if(os.path.exists(dirname)):
+        shutil.rmtree(dirname, ignore_errors=True)
+    try:
+        os.rename(tmp_dirname, dirname)
+    except OSError:
+        shutil.rmtree(tmp_dirname, ignore_errors=True)
+
+
+# Reads the meta.json of a snapshot
+# Returns:
+    # the metadata dictionary, or None if there is no (complete) snapshot
+def read_snapshot_meta(dirname):
+    try:
+        with open(os.path.join(dirname, 'meta.json'), 'r') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+# Fills in a Map from a snapshot, if the snapshot matches the Map's inputs
+# Params:
+    # road_map - a Map, whose constructor has set the basic attributes
+    # dirname - the snapshot directory
+    # key - the output of snapshot_key() for this Map
+# Returns:
+    # True if the snapshot was loaded, False if it is missing or outdated
+def load_snapshot(road_map, dirname, key):
+    meta = read_snapshot_meta(dirname)
+    if(meta is None or
+       any(meta.get(name) != key[name] for name in key)):
+        return False
+
+    def load(name):
+        return np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r')
+
+    [road_map.min_lat, road_map.max_lat,
+     road_map.min_lon, road_map.max_lon] = meta['bounds']
+
+    # Recreate the Nodes
+    road_map.nodes = [Node(node_id, lat, lon, region) for node_id, lat, lon, region
+                      in zip(load('node_ids').tolist(), load('node_lat').tolist(),
+                             load('node_lon').tolist(), load('node_region').tolist())]
+    road_map.nodes_by_id = dict((node.node_id, node) for node in road_map.nodes)
+
+    road_map.total_region_count = meta['total_region_count']
+    if(road_map.total_region_count > 0):
+        for node, region_id, is_boundary in zip(road_map.nodes,
+                                                load('node_region_id').tolist(),
+                                                load('node_is_boundary').tolist()):
+            node.region_id = region_id
+            node.is_boundary_node = is_boundary
+
+    # Recreate the Links
+    nodes_by_id = road_map.nodes_by_id
+    road_map.links = []
+    road_map.links_by_node_id = {}
+    for link_id, (begin_node_id, end_node_id, length) in enumerate(zip(
+            load('link_origin_ids').tolist(), load('link_dest_ids').tolist(),
+            load('link_lengths').tolist())):
+        link = Link(begin_node_id, end_node_id, length)
+        link.link_id = link_id
+        link.origin_node = nodes_by_id[begin_node_id]
+        link.connecting_node = nodes_by_id[end_node_id]
+        link.origin_node.forward_links.append(link)
+        link.connecting_node.backward_links.append(link)
+        road_map.links.append(link)
+        road_map.links_by_node_id[begin_node_id, end_node_id] = link
+
+    road_map.idle_link = Link(0, 0, 0)
+    road_map.idle_link.time = 300 # Default waiting time of 5 minutes
+    road_map.idle_link.link_id = len(road_map.links)
+    road_map.links.append(road_map.idle_link)
+
+    # The graph arrays stay memory-mapped, except for the travel times which change
+    graph_arrays = [load('graph_' + name) for name in GRAPH_ARRAYS]
+    graph_arrays[-1] = np.array(graph_arrays[-1])
+    road_map.array_graph = ArrayGraph(*graph_arrays)
+
+    for tree_name in ['lookup_tree', 'region_tree']:
+        arrays = dict((name, load(tree_name + '_' + name)) for name in KDTREE_ARRAYS)
+        setattr(road_map, tree_name.replace('_tree', '_kd_tree'),
+                kdtree_from_arrays(arrays, road_map.nodes))
+
+    return True
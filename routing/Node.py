@@ -1,5 +1,6 @@
 import csv
 from Link import Link
+from SlotObject import SlotObject
 # from Grid import set_up_grid
 import numpy as np
 from math import sqrt
@@ -19,9 +20,27 @@ def approx_distance(lat1, long1, lat2, long2):
     return sqrt(lat_miles * lat_miles + long_miles * long_miles)
 
 
+# Placeholder for the arc flag preprocessing arrays of a Node, until the
+# preprocessing gives the Node its own arrays.  It is shared by every Node, so it
+# is read-only
+EMPTY_ARRAY = np.array([])
+EMPTY_ARRAY.flags.writeable = False
+
+
 # A vertex in our map
 # (edge class not used -> simply used lists within the node)
-class Node:
+class Node(SlotObject):
+    __slots__ = ('node_id', 'lat', 'long', 'location', 'region', 'region_id',
+                 'discovered', 'update_count', 'color_id',
+                 'forward_links', 'backward_links', 'forward_link_ids', 'backward_link_ids',
+                 '_is_forward_arc_flags', '_is_backward_arc_flags',
+                 'is_boundary_node', 'boundary_node_id',
+                 'forward_boundary_time', 'backward_boundary_time', 'time_snapshot',
+                 'forward_predecessors', 'backward_predecessors',
+                 'forward_predecessor_link', 'backward_predecessor_link',
+                 'forward_time', 'backward_time',
+                 'was_forward_expanded', 'was_backward_expanded',
+                 'came_from', 'best_time')
 
     def __init__(self, begin_node_id, latitude, longitude, region):
         self.node_id = int(begin_node_id)
@@ -41,9 +60,9 @@ class Node:
         self.forward_links = []
         self.backward_links = []
 
-
-        self.is_forward_arc_flags = {}
-        self.is_backward_arc_flags = {}
+        # Created on first use, see is_forward_arc_flags
+        self._is_forward_arc_flags = None
+        self._is_backward_arc_flags = None
 
         ######################################################
         #  Used in multiple dijkstra arcflag precomputation  #
@@ -60,17 +79,19 @@ class Node:
         # updated
         # self.was_updated = set()
 
-        # For multi-origin dijkstra, storing the time from each boundary node
-        self.forward_boundary_time = np.array([])
-        self.backward_boundary_time = np.array([])
+        # For multi-origin dijkstra, storing the time from each boundary node.
+        # These arrays are only allocated by the preprocessing (see
+        # DijkstrasAlgorithm.initialize_nodes())
+        self.forward_boundary_time = EMPTY_ARRAY
+        self.backward_boundary_time = EMPTY_ARRAY
 
         # A snapshot of the time_from_boundary_node from the last expansion
-        self.time_snapshot = np.array([])
+        self.time_snapshot = EMPTY_ARRAY
 
         # For each boundary node path, shows where this particular node came
         # from - used in ArcFlags Preprocessing
-        self.forward_predecessors = np.array([])
-        self.backward_predecessors = np.array([])
+        self.forward_predecessors = EMPTY_ARRAY
+        self.backward_predecessors = EMPTY_ARRAY
 
         ######################################################
         #  Used at query time                                #
@@ -88,6 +109,28 @@ class Node:
         # Identifies which region this node belongs to
         self.region_id = (None, None)
 
+    # The arc flags of the preprocessing, which map a neighboring Node to its flag.
+    # Most Nodes never need them, so the dictionaries are created on first use
+    @property
+    def is_forward_arc_flags(self):
+        if(self._is_forward_arc_flags is None):
+            self._is_forward_arc_flags = {}
+        return self._is_forward_arc_flags
+
+    @is_forward_arc_flags.setter
+    def is_forward_arc_flags(self, flags):
+        self._is_forward_arc_flags = flags
+
+    @property
+    def is_backward_arc_flags(self):
+        if(self._is_backward_arc_flags is None):
+            self._is_backward_arc_flags = {}
+        return self._is_backward_arc_flags
+
+    @is_backward_arc_flags.setter
+    def is_backward_arc_flags(self, flags):
+        self._is_backward_arc_flags = flags
+
     # Used for the KD-tree - the node can be used as an array-like object
     def __getitem__(self, x):
         return self.location[x]
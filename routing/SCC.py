@@ -8,101 +8,107 @@ Created on Wed Jan 28 16:00:30 2015
 import Map
 from datetime import datetime
 import csv
+import numpy as np
 
-# Helper method which performs depth-first search and returns nodes in their expanded order
+# Finds the strongly connected components of a graph in O(V+E) time, with an
+# iterative version of Tarjan's Algorithm.  Each adjacency list is scanned only
+# once, and no sets of nodes are copied.
 # Params:
-    # start_node - The node to start searching from
-    # forward - If True, will search on the forward graph, if False, will search
-        # on the backward garph
-    # visited_set - A set of nodes which have already been visited.  Nodes in this
-    # set will be ignored.  Nodes will be added to this set as they are discovered
-# Returns: A list of nodes in the order that they FINISH.  A node is only finished
-    # once all of its children in the search tree are finished.  So the start_node
-    # will be the last to finish
-def dfs(start_node, forward=True, visited_set = set()):
-
-    # The stack of nodes to expand, used for DFS
-    stack = [start_node]
-    # The start_node has now been visited
-    visited_set.add(start_node)
-    
-    # List of nodes
-    finished_nodes = []
-
-    # Iterate until the stack runs out    
-    while(len(stack) > 0):
-
-        # Peek at the top node of the stack
-        node = stack[-1]
-        
-        # Decide whether we are going forward or backward
-        if(forward):
-            links = node.forward_links
-        else:
-            links = node.backward_links
-        
-        # This node is only finished if all of its neighbors are finished
-        finished = True
-        for link in links:
-            # Variable 'forward' determines which end of the Link to look at
-            if(forward):
-                neighbor = link.connecting_node
-            else:
-                neighbor = link.origin_node
-            
-            # Neighbor has not been explored yet
-            if(neighbor not in visited_set):
-                # Mark as visited and add to the stack so it will be explored later
-                stack.append(neighbor)
-                visited_set.add(neighbor)
-                # This node is not done yet because its neighbor still needs to be explored
-                finished = False
-        
-        # Remove the node from the stack if it is finished
-        if(finished):
-            _ = stack.pop()
-            # Add to the output list
-            finished_nodes.append(node)
-    
-    return finished_nodes
+    # offsets - a list of length num_nodes+1.  The neighbors of node v are
+        # targets[offsets[v]:offsets[v+1]]
+    # targets - a list of node indices
+# Returns:
+    # An array with the component label of each node.  Components are numbered in
+    # the order they are completed (reverse topological order)
+def scc_labels(offsets, targets):
+    num_nodes = len(offsets) - 1
+    index = [-1] * num_nodes    # The order in which each node was discovered
+    low = [0] * num_nodes       # The lowest index reachable from its subtree
+    on_stack = [False] * num_nodes
+    labels = [-1] * num_nodes
+    stack = []
+    counter = 0
+    num_components = 0
+
+    for root in xrange(num_nodes):
+        if(index[root] >= 0):
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        # The DFS call stack, with the position in each node's adjacency list
+        call_stack = [(root, offsets[root])]
+
+        while(len(call_stack) > 0):
+            (v, pos) = call_stack[-1]
+            end = offsets[v + 1]
+            descended = False
+            while(pos < end):
+                w = targets[pos]
+                pos += 1
+                if(index[w] < 0):
+                    # Continue the search from w, and come back to v afterwards
+                    call_stack[-1] = (v, pos)
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    call_stack.append((w, offsets[w]))
+                    descended = True
+                    break
+                elif(on_stack[w] and index[w] < low[v]):
+                    low[v] = index[w]
+            if(descended):
+                continue
+
+            # All of v's neighbors are done
+            call_stack.pop()
+            if(low[v] == index[v]):
+                # v is the root of a component, which is on top of the stack
+                while(True):
+                    w = stack.pop()
+                    on_stack[w] = False
+                    labels[w] = num_components
+                    if(w == v):
+                        break
+                num_components += 1
+            if(len(call_stack) > 0):
+                parent = call_stack[-1][0]
+                if(low[v] < low[parent]):
+                    low[parent] = low[v]
+
+    return np.array(labels, dtype=np.int64)
 
 
+# Builds the adjacency lists used by scc_labels() from a list of Nodes
+# Params:
+    # nodes - A list of Node objects.  Links to Nodes outside of this list are ignored
+# Returns:
+    # offsets, targets - see scc_labels().  Node i is nodes[i]
+def node_adjacency(nodes):
+    index_of = dict((node, i) for i, node in enumerate(nodes))
+    offsets = [0]
+    targets = []
+    for node in nodes:
+        for link in node.forward_links:
+            if(link.connecting_node in index_of):
+                targets.append(index_of[link.connecting_node])
+        offsets.append(len(targets))
+    return offsets, targets
 
-# Finds the strongly connected components (SCCs) of a graph, using Kosaraju's Algorithm.
+
+# Finds the strongly connected components (SCCs) of a graph.  This used to be
+# Kosaraju's Algorithm, but now uses scc_labels()
 # Parameters:
     # nodes - A list of Node objects, which presumably have Links to each other
 # Returns:
     # A list of SCCs, each of which is a list of Nodes
 def kosaraju(nodes):
-    
-    scc_list = []
-    
-    # Step 1 - determine Node search order.  The first node to search should be in
-    # the top of a topological sort of the graph
-    discovered_nodes = set()
-    ordered_nodes = []
-    # Run through all of the Nodes and DFS from them if they haven't been searched yet
-    for starting_node in nodes:
-        if(starting_node not in discovered_nodes):
-            nodes = dfs(starting_node, visited_set=discovered_nodes)
-            ordered_nodes += nodes
-    # Reverse the list so the top nodes will come first
-    ordered_nodes.reverse()
-    
-    # Step 2 - Find SCCs using the backwards graph.  We will check which Nodes can
-    # get back to these top nodes, ignoring the SCCs that have been found so far
-    discovered_nodes = set()
-    for node in ordered_nodes:
-        if node not in discovered_nodes:
-            # The DFS returns a strongly connected component
-            scc = dfs(node, forward=False, visited_set = set(discovered_nodes))
-            
-            # But this SCC will be ignored in subsequent calls
-            discovered_nodes.update(scc)
-            
-            # Add the SCC to the output list
-            scc_list.append(scc)
-    
+    labels = scc_labels(*node_adjacency(nodes))
+    scc_list = [[] for _ in xrange(labels.max() + 1 if len(labels) > 0 else 0)]
+    for node, label in zip(nodes, labels.tolist()):
+        scc_list[label].append(node)
     return scc_list
 
     
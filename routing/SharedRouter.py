@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel shortest path routing, with the graph in shared memory.
+
+Routing with a Pool used to flatten the whole Map, pickle it into every chunk of
+trips, and unflatten it (rebuilding the KD trees) in every worker.  Instead, a
+SharedRouter copies the arrays of an ArrayGraph into shared memory once, when
+its worker processes start.  The workers inherit the shared arrays, wrap them in
+an ArrayGraph without copying, and keep their ArraySearch (and its workspace)
+from one task to the next.
+
+The travel times and the origins/destinations of the trips are also shared
+arrays, which are written by the parent process.  So a task is only a range of
+trip indices, and only the paths (as link ids) and their travel times are sent
+back.  A SharedRouter is meant to be kept for a long time (e.g. all iterations of
+the traffic estimation) - when the link times change, sync() writes the new time
+vector, and nothing else is sent to the workers.
+
+@author: brian
+"""
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray, RawValue
+import ctypes
+import numpy as np
+
+from ArrayGraph import ArrayGraph
+from ArraySearch import ArraySearch
+from MapSnapshot import GRAPH_ARRAYS
+
+# The ctypes type used to share each kind of array
+CTYPES = {np.dtype(np.int32): ctypes.c_int32,
+          np.dtype(np.int64): ctypes.c_int64,
+          np.dtype(np.float64): ctypes.c_double}
+
+
+# Copies a numpy array into a new block of shared memory
+def to_shared(array):
+    array = np.ascontiguousarray(array)
+    shared = RawArray(CTYPES[array.dtype], len(array))
+    from_shared(shared, array.dtype)[:] = array
+    return shared
+
+
+# Wraps a block of shared memory in a numpy array, without copying it
+def from_shared(shared, dtype):
+    return np.frombuffer(shared, dtype=dtype)
+
+
+# Holds the state of a worker process
+_worker_state = {}
+
+
+# Pool initializer - wraps the shared arrays in an ArrayGraph and an ArraySearch
+def _init_worker(shared_arrays, time_version, origins, destinations):
+    arrays = [from_shared(shared, dtype) for (shared, dtype) in shared_arrays]
+    graph = ArrayGraph(*arrays)
+    _worker_state['graph'] = graph
+    _worker_state['search'] = ArraySearch(graph)
+    _worker_state['time_version'] = time_version
+    _worker_state['origins'] = from_shared(origins, np.int64)
+    _worker_state['destinations'] = from_shared(destinations, np.int64)
+
+
+# Pool task - routes the trips in a range of indices
+# Params:
+    # args - a tuple of (start, end, use_astar, max_speed)
+# Returns:
+    # path_lengths - an array with the number of links on each path (-1 if there is no path)
+    # link_ids - an array with the link ids of all of the paths, one after the other
+    # times - an array with the travel time of each path
+def _route_range(args):
+    (start, end, use_astar, max_speed) = args
+    graph = _worker_state['graph']
+    search = _worker_state['search']
+    # Pick up new link times, if the parent has changed them
+    graph.time_version = _worker_state['time_version'].value
+    search.refresh()
+    link_times = search.link_times
+
+    origins = _worker_state['origins'][start:end].tolist()
+    destinations = _worker_state['destinations'][start:end].tolist()
+    path_lengths = []
+    link_ids = []
+    times = []
+    for origin, destination in zip(origins, destinations):
+        path = search.bidirectional_search(origin, destination, use_astar=use_astar,
+                                           max_speed=max_speed)
+        if(path is None):
+            path_lengths.append(-1)
+            times.append(float('inf'))
+        else:
+            path_lengths.append(len(path))
+            link_ids.extend(path)
+            times.append(sum([link_times[link_id] for link_id in path]))
+
+    return (np.array(path_lengths, dtype=np.int64), np.array(link_ids, dtype=np.int64),
+            np.array(times, dtype=np.float64))
+
+
+# A pool of worker processes which route on a shared copy of an ArrayGraph
+class SharedRouter:
+    # Params:
+        # graph - the ArrayGraph.  Its structure is copied once - later changes to
+            # its link times must be passed on with set_link_times()
+        # num_processes - the number of worker processes
+        # capacity - the number of trips that can be routed by one call of route().
+            # If a call has more trips, the workers are restarted with more space
+    def __init__(self, graph, num_processes, capacity=100000):
+        self.num_processes = num_processes
+        self.shared_arrays = [(to_shared(getattr(graph, name)), getattr(graph, name).dtype)
+                              for name in GRAPH_ARRAYS]
+        # link_times is the last graph array
+        self.link_times = from_shared(self.shared_arrays[-1][0], np.float64)
+        self.time_version = RawValue(ctypes.c_int64, 0)
+        # The time_version of the ArrayGraph whose times were last written by sync()
+        self.synced_version = graph.time_version
+
+        self.pool = None
+        self._start_pool(capacity)
+
+    # Starts the worker processes, with room for the endpoints of capacity trips
+    def _start_pool(self, capacity):
+        self.close()
+        self.capacity = capacity
+        self._origins = RawArray(ctypes.c_int64, capacity)
+        self._destinations = RawArray(ctypes.c_int64, capacity)
+        self.origins = from_shared(self._origins, np.int64)
+        self.destinations = from_shared(self._destinations, np.int64)
+        self.pool = Pool(self.num_processes, initializer=_init_worker,
+                         initargs=(self.shared_arrays, self.time_version,
+                                   self._origins, self._destinations))
+
+    # Replaces the travel times used by the workers.  Only the link time vector
+    # is written - the workers see it the next time they are given a task
+    # Params:
+        # times - an array-like of travel times, in link_id order
+    def set_link_times(self, times):
+        self.link_times[:] = times
+        self.time_version.value += 1
+        self.synced_version = None
+
+    # Passes the link times of an ArrayGraph on to the workers, if they have
+    # changed since the last call
+    # Params:
+        # graph - the ArrayGraph this router was made from
+    def sync(self, graph):
+        if(self.synced_version != graph.time_version):
+            version = graph.time_version
+            self.set_link_times(graph.link_times)
+            self.synced_version = version
+
+    # Finds the shortest path of many trips, in parallel
+    # Params:
+        # origins, destinations - array-likes of node indices in the ArrayGraph
+        # use_astar - use the euclidean A* heuristic
+        # max_speed - the maximum speed of any link, used by the A* heuristic
+        # tasks_per_process - the trips are split into this many ranges per process,
+            # so that the work is balanced if some ranges take longer
+    # Returns:
+        # paths - a list with the link ids of each path, or None if there is no path
+        # times - an array with the travel time of each path
+    def route(self, origins, destinations, use_astar=True, max_speed=1.0,
+              tasks_per_process=4):
+        num_trips = len(origins)
+        if(num_trips > self.capacity):
+            self._start_pool(2 * num_trips)
+        self.origins[:num_trips] = origins
+        self.destinations[:num_trips] = destinations
+
+        num_tasks = max(1, min(num_trips, self.num_processes * tasks_per_process))
+        bounds = np.linspace(0, num_trips, num_tasks + 1).astype(np.int64).tolist()
+        tasks = [(bounds[i], bounds[i + 1], use_astar, max_speed)
+                 for i in xrange(num_tasks)]
+
+        paths = []
+        times = []
+        for (path_lengths, link_ids, task_times) in self.pool.map(_route_range, tasks):
+            link_ids = link_ids.tolist()
+            position = 0
+            for path_length in path_lengths.tolist():
+                if(path_length < 0):
+                    paths.append(None)
+                else:
+                    paths.append(link_ids[position:position + path_length])
+                    position += path_length
+            times.append(task_times)
+        return paths, np.concatenate(times)
+
+    # Stops the worker processes
+    def close(self):
+        if(self.pool is not None):
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+"""
+A base class for the small objects that are created by the million (Nodes, Links
+and Trips).  Subclasses list all of their attributes in __slots__, so instances
+don't carry their own __dict__.
+
+Objects with __slots__ can't be pickled with the old pickle protocols (which are
+the default of cPickle, used by mpi_parallel), so SlotObject pickles the
+attributes that have been set as a dictionary.
+
+@author: brian
+"""
+
+
+class SlotObject(object):
+    __slots__ = ()
+
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if(hasattr(self, name)):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.iteritems():
+            setattr(self, name, value)
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+The interface shared by the spatial indexes that snap coordinates to Nodes, and
+some helpers used by all of them.
+
+A spatial index is built from an (N x 2) array of point coordinates (in meters),
+and answers queries for whole arrays of query points at once:
+    query(xs, ys) - finds the nearest point to each query point.  Returns an array
+        of point indices and an array of squared distances
+    query_knn(xs, ys, k) - finds the k nearest points to each query point, nearest
+        first.  Returns two (num_queries x k) arrays of point indices and squared
+        distances, which are padded with -1 and inf if there are fewer than k points
+    query_radius(xs, ys, radius) - finds all points within radius of each query
+        point.  Returns a list with one array of point indices (nearest first) for
+        each query point
+The coordinates of the query points must be finite.
+
+The implementations are ArrayKDTree and GridIndex.  See Map.select_spatial_index(),
+which benchmarks them against each other and keeps the faster one.
+
+@author: brian
+"""
+import numpy as np
+
+
+# Positions of the entries of several ranges of an array, one range after the other
+# Params:
+    # starts - an array with the first position of each range
+    # counts - an array with the length of each range
+# Returns:
+    # an array with all of the positions
+def expand_ranges(starts, counts):
+    first_entries = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) + np.repeat(starts - first_entries, counts)
+
+
+# Merges candidate points into the k best points found so far for each query
+# Params:
+    # best_index - a (num_queries x k) array of point indices, sorted by distance.
+        # It is updated in place
+    # best_dist - the matching (num_queries x k) array of squared distances
+    # queries - an array with the query index of each candidate
+    # indices - an array with the point index of each candidate
+    # dists - an array with the squared distance of each candidate
+def merge_k_best(best_index, best_dist, queries, indices, dists):
+    k = best_dist.shape[1]
+    if(k == 1):
+        # Only the minimum is needed, which doesn't require sorting.  nearest is a view
+        nearest = best_dist[:, 0]
+        np.minimum.at(nearest, queries, dists)
+        is_best = (dists == nearest[queries])
+        best_index[queries[is_best], 0] = indices[is_best]
+        return
+
+    touched = np.unique(queries)
+    all_queries = np.concatenate((np.repeat(touched, k), queries))
+    all_indices = np.concatenate((best_index[touched].ravel(), indices))
+    all_dists = np.concatenate((best_dist[touched].ravel(), dists))
+
+    order = np.lexsort((all_dists, all_queries))
+    sorted_queries = all_queries[order]
+    # Every touched query has at least k entries - its old k best
+    starts = np.searchsorted(sorted_queries, touched)
+    counts = np.diff(np.append(starts, len(order)))
+    ranks = np.arange(len(order)) - np.repeat(starts, counts)
+    keep = ranks < k
+    best_index[sorted_queries[keep], ranks[keep]] = all_indices[order[keep]]
+    best_dist[sorted_queries[keep], ranks[keep]] = all_dists[order[keep]]
+
+
+# Splits (query, point) pairs into one array of points per query
+# Params:
+    # queries - an array with the query index of each pair
+    # indices - an array with the point index of each pair
+    # dists - an array with the squared distance of each pair
+    # num_queries - the total number of queries
+# Returns:
+    # a list with an array of point indices for each query, nearest first
+def group_by_query(queries, indices, dists, num_queries):
+    order = np.lexsort((dists, queries))
+    bounds = np.searchsorted(queries[order], np.arange(num_queries + 1))
+    sorted_indices = indices[order]
+    return [sorted_indices[bounds[i]:bounds[i + 1]] for i in xrange(num_queries)]
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Stores the routes of many Trips as a sparse trip-by-link incidence matrix.
+
+Row i of the matrix has a 1 in column j if Link j is on the path of trip i.  It
+is kept in CSR form: the link ids of trip i are
+    link_ids[indptr[i]:indptr[i+1]]
+With the routes in this form, the travel times of all trips are one sparse
+matrix-vector product with a vector of link times, and per-trip values can be
+scattered back onto the links with the transposed product.  Both are done with
+np.bincount, which adds the values up in order - so the sums are exactly the
+same as the ones computed by looping over trip.path_links.
+
+The duplicate times of each trip (see Map.match_trips_to_nodes()) are stored the
+same way, so errors can be computed for all of them at once.
+
+@author: brian
+"""
+import numpy as np
+
+
+class RouteMatrix:
+    # Params:
+        # trips - a list of Trips, which have already been routed (trip.path_links)
+            # and map-matched (trip.dup_times)
+    def __init__(self, trips):
+        self.num_trips = len(trips)
+
+        path_lengths = np.array([len(trip.path_links) for trip in trips], dtype=np.int64)
+        self.indptr = np.zeros(self.num_trips + 1, dtype=np.int64)
+        np.cumsum(path_lengths, out=self.indptr[1:])
+        self.link_ids = np.fromiter((link.link_id for trip in trips
+                                     for link in trip.path_links),
+                                    dtype=np.int64, count=self.indptr[-1])
+        # The row (trip index) of each entry
+        self.rows = np.repeat(np.arange(self.num_trips), path_lengths)
+
+        dup_counts = np.array([len(trip.dup_times) for trip in trips], dtype=np.int64)
+        self.dup_counts = dup_counts
+        self.dup_times = np.fromiter((true_time for trip in trips
+                                      for true_time in trip.dup_times),
+                                     dtype=np.float64, count=dup_counts.sum())
+        # The row (trip index) of each duplicate time
+        self.dup_rows = np.repeat(np.arange(self.num_trips), dup_counts)
+
+        self.true_dists = np.array([trip.dist for trip in trips], dtype=np.float64)
+
+    # Sums a per-link value over the path of every trip (sparse matrix times vector)
+    # Params:
+        # link_values - an array of values, indexed by link_id (e.g. times or lengths)
+    # Returns:
+        # an array with the sum for each trip
+    def trip_sums(self, link_values):
+        return np.bincount(self.rows, weights=link_values[self.link_ids],
+                           minlength=self.num_trips)
+
+    # Adds up per-trip values on every link of each trip's path (transposed product)
+    # Params:
+        # trip_values - an array with one value per trip
+        # num_links - the total number of links
+    # Returns:
+        # an array with the sum for each link
+    def link_sums(self, trip_values, num_links):
+        return np.bincount(self.link_ids, weights=trip_values[self.rows],
+                           minlength=num_links)
+
+    # Adds up a value on every link of the paths of the given rows.  Rows may
+    # repeat, and the values are added in the order the rows are given
+    # Params:
+        # rows - an array of trip indices
+        # row_values - an array with one value for each entry of rows
+        # num_links - the total number of links
+    # Returns:
+        # an array with the sum for each link
+    def row_link_sums(self, rows, row_values, num_links):
+        starts = self.indptr[rows]
+        counts = self.indptr[rows + 1] - starts
+        # Positions of the entries of each row, one row after the other
+        first_entries = np.cumsum(counts) - counts
+        entries = np.arange(counts.sum()) + np.repeat(starts - first_entries, counts)
+        return np.bincount(self.link_ids[entries], weights=np.repeat(row_values, counts),
+                           minlength=num_links)
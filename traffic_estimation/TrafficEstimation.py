@@ -4,14 +4,15 @@ Created on Mon Dec  8 14:15:54 2014
 
 @author: Brian Donovan (briandonovan100@gmail.com)
 """
-from routing.BiDirectionalSearch import bidirectional_search
 from routing.Map import Map
 
 from Trip import Trip
+from RouteMatrix import RouteMatrix
 
 from datetime import datetime
 import csv
 import math
+import numpy as np
 from multiprocessing import Pool
 from functools import partial
 
@@ -47,6 +48,20 @@ def compute_avg_velocity(trips):
 
 
 
+# Passes trips through, while adding up their times and distances
+# Params:
+    # trips - an iterable of Trips
+    # totals - a list [total time, total distance], which is updated in place
+# Returns:
+    # a generator of the same Trips
+def iter_with_totals(trips, totals):
+    for trip in trips:
+        totals[0] += trip.time
+        totals[1] += trip.dist
+        yield trip
+
+
+
 # Computes a trips weight based on how closely the estimated distance and true distance match
 # There are several different ways to compute the weight
 # Params:
@@ -77,6 +92,37 @@ def compute_weight(distance_weighting, true_dist, est_dist):
         return 1 - min(1,abs(dist_err / bandwidth))
     elif(kern_type==DW_THRESH):
         return 1 * (dist_err < bandwidth)
+
+
+# Vectorized version of compute_weight(), which computes the weights of many trips at once
+# Params:
+    # distance_weighting - see compute_weight()
+    # true_dists - an array of the true reported distances of the trips
+    # est_dists - an array of the computed distances of the trips
+# Returns:
+    # an array of weights, equal to the ones given by compute_weight()
+def compute_weights(distance_weighting, true_dists, est_dists):
+    if(distance_weighting==None):
+        return np.ones(len(true_dists))
+    
+    (val_type, kern_type, bandwidth) = distance_weighting
+    
+    if(val_type==DW_ABS):
+        dist_err = est_dists - true_dists
+    elif(val_type==DW_REL):
+        is_zero = (true_dists==0)
+        dist_err = np.where(is_zero, 1.0,
+                            (est_dists - true_dists) / np.where(is_zero, 1.0, true_dists))
+    
+    if(kern_type==DW_GAUSS):
+        # numpy computes x**2 as x*x, but Python floats call pow(), which may round
+        # differently.  An array of exponents makes numpy call pow() as well
+        squares = np.power(dist_err/bandwidth, np.full(len(dist_err), 2.0))
+        return np.power(math.e, -squares)
+    elif(kern_type==DW_LASSO):
+        return 1 - np.minimum(1, np.abs(dist_err / bandwidth))
+    elif(kern_type==DW_THRESH):
+        return 1.0 * (dist_err < bandwidth)
     
 
 
@@ -113,7 +159,7 @@ def predict_trip_time(trip, road_map, route=True, proposed=False, max_speed = No
         sum_perc_error = 0
         num_trips = 0
         if(route):
-            trip.path_links = bidirectional_search(trip.origin_node, trip.dest_node, use_astar=True, max_speed=max_speed)
+            trip.path_links = road_map.find_shortest_path(trip.origin_node, trip.dest_node, use_astar=True, max_speed=max_speed)
             if(model_idle_time):
                 trip.path_links.append(road_map.idle_link)
         
@@ -147,11 +193,31 @@ def predict_trip_time(trip, road_map, route=True, proposed=False, max_speed = No
 
 
 # Predicts the travel times for many trips, can make use of parallel processing
+# If batched is True, trips that share an origin or destination are routed together
+# with one tree search (see Map.route_trips_batched()), before the predictions are made
+# If a router (see Map.get_shared_router()) is given, the trips are routed in
+# parallel on its shared copy of the graph, instead of sending the Map to a pool
 def predict_trip_times(road_map, trips, route=True, proposed=False, max_speed = None,
-                       distance_weighting=None, model_idle_time=True, pool=None):
+                       distance_weighting=None, model_idle_time=True, pool=None,
+                       batched=False, router=None):
     if(max_speed==None):
         max_speed = road_map.get_max_speed()
     
+    if(route):
+        # The searches run on the ArrayGraph, which needs the latest travel times
+        road_map.update_routing_times()
+        
+        if(batched or router is not None):
+            if(router is not None):
+                road_map.route_trips_shared(trips, router, max_speed=max_speed)
+            else:
+                road_map.route_trips_batched(trips, max_speed=max_speed)
+            if(model_idle_time):
+                for trip in trips:
+                    trip.path_links.append(road_map.idle_link)
+            # The trips already have their routes
+            route = False
+    
     if(pool==None):
         # Create a partial function, which only takes a Trip as input (all of the others are given constants)
         # This makes it easy to use with the map() function
@@ -185,7 +251,7 @@ def predict_trip_times(road_map, trips, route=True, proposed=False, max_speed =
         # Perform the routing with one chunk per CPU
         ideal_chunksize = (len(trips) / pool._processes) + 1
         output_list = pool.map(trip_func, trips, chunksize=ideal_chunksize)
-        pool.terminate()
+        # The pool belongs to the caller, and may be used again
         
         print("Unflattening trips")
         routed_trips = [trip for trip, error, l1_error, sum_perc_error, num_trips in output_list]
@@ -216,37 +282,81 @@ def predict_trip_times(road_map, trips, route=True, proposed=False, max_speed =
     
             
         
+# Same as predict_trip_times(route=False), but computed from a RouteMatrix and an
+# array of link times, instead of the Trip and Link objects.  This is much faster,
+# so it is used when the same routes are evaluated for many different link times
+# Params:
+    # route_matrix - a RouteMatrix built from the routed trips
+    # link_times - an array of travel times, indexed by link_id
+    # link_lengths - an array of link lengths, indexed by link_id
+    # distance_weighting - the method for computing the weight.  see compute_weight()
+# Returns:
+    # the same error metrics as predict_trip_times()
+def predict_trip_times_from_matrix(route_matrix, link_times, link_lengths,
+                                   distance_weighting=None):
+    estimated_times = route_matrix.trip_sums(link_times)
+    estimated_dists = route_matrix.trip_sums(link_lengths)
+    weights = compute_weights(distance_weighting, route_matrix.true_dists, estimated_dists)
+    
+    # Errors of each duplicate time, added up per trip and then over all trips in
+    # the same order as predict_trip_times() does
+    abs_errors = np.abs(estimated_times[route_matrix.dup_rows] - route_matrix.dup_times)
+    rows = route_matrix.dup_rows
+    num_trips = route_matrix.num_trips
+    total_error = sum(np.bincount(rows, weights=abs_errors * weights[rows],
+                                  minlength=num_trips).tolist())
+    total_l1 = sum(np.bincount(rows, weights=abs_errors, minlength=num_trips).tolist())
+    total_perc_error = sum(np.bincount(rows, weights=abs_errors / route_matrix.dup_times,
+                                       minlength=num_trips).tolist())
+    total_num_trips = len(route_matrix.dup_times)
+    
+    avg_error = total_l1 / total_num_trips
+    avg_perc_error = total_perc_error / total_num_trips
+    
+    return total_error, avg_error, avg_perc_error
+
+
 # Compute link offsets based on trip time errors.  Link offsets indicate whether
 # this link's travel time should increase or decrease, in order to decrease the 
 # error metric.  The sign of link offset should be the same as the sign of the
 # derivative of the error function with respect to this link's cost.
+# Sets link.offset and link.num_trips on every Link.
 # Params:
     # road_map - a Map object
     # unique_trips - a list of Trip objects
     # distance_weighting - the method for computing the weight.  see compute_weight()
-def compute_link_offsets(road_map, unique_trips, distance_weighting=None):
-    #Start offsets at 0
-    for link in road_map.links:
-        link.offset = 0
-        link.num_trips = 0
+    # route_matrix - an optional RouteMatrix of unique_trips.  Built if not given
+# Returns:
+    # offsets - an array with the offset of each link, indexed by link_id
+    # num_trips - an array with the (weighted) number of trips on each link
+def compute_link_offsets(road_map, unique_trips, distance_weighting=None, route_matrix=None):
+    if(route_matrix is None):
+        route_matrix = RouteMatrix(unique_trips)
+    num_links = len(road_map.links)
+    
+    estimated_times = np.array([trip.estimated_time for trip in unique_trips], dtype=np.float64)
+    estimated_dists = np.array([trip.estimated_dist for trip in unique_trips], dtype=np.float64)
+    weights = compute_weights(distance_weighting, route_matrix.true_dists, estimated_dists)
+    
+    # Every trip counts once for each of its duplicates
+    num_trips = route_matrix.link_sums(weights * route_matrix.dup_counts, num_links)
     
     # If we overestimate, increase link offsets
     # If we underestimate, decrease link offsets
-    for trip in unique_trips:
-        weight = compute_weight(distance_weighting, trip.dist, trip.estimated_dist)       
-
-        for link in trip.path_links:
-            link.num_trips += weight * len(trip.dup_times)
-        
-        #print str(use_distance_weighting) + ": " + str(trip.estimated_dist) + " - " + str(trip.dist) + " --> " + str(weight)
-        for true_time in trip.dup_times:
-            if(trip.estimated_time > true_time):
-                for link in trip.path_links:
-                    link.offset += weight
-            elif(trip.estimated_time < true_time):
-                for link in trip.path_links:
-                    link.offset -= weight
+    # Each duplicate time adds its own +weight or -weight to the links on the path,
+    # in the same order as looping over the trips would
+    dup_rows = route_matrix.dup_rows
+    signs = np.sign(estimated_times[dup_rows] - route_matrix.dup_times)
+    is_off = (signs != 0)
+    offsets = route_matrix.row_link_sums(dup_rows[is_off],
+                                         signs[is_off] * weights[dup_rows[is_off]],
+                                         num_links)
+    
+    for link, offset, count in zip(road_map.links, offsets.tolist(), num_trips.tolist()):
+        link.offset = offset
+        link.num_trips = count
     
+    return offsets, num_trips
 
 
 
@@ -259,21 +369,28 @@ def compute_link_offsets(road_map, unique_trips, distance_weighting=None):
 # Some diagonstics are also computed in order to assess the model's quality over iterations
 # Params:
     # road_map - a Map object, which contains the road geometry
-    # trips - a list of Trip objects.
+    # trips - a list of Trip objects, or a generator of them (e.g. db_trip.iter_pickup_dt())
     # max_iter - maximum number of iterations before the experiment ends
     # test_set - an optional hold-out test set to assess how well the model generalizes.
     # distance_weighting - the method for computing the weight.  see compute_weight()
     # model_idle_time - Assumes that each trip includes a fixed amount of idle time (which will be estimated)
+    # batched_routing - route trips with a shared origin or destination together.  see predict_trip_times()
+    # num_processes - if more than 1, the trips are routed in parallel by the Map's
+        # SharedRouter (see Map.get_shared_router()).  It is kept running after this
+        # function returns, so later calls with the same Map reuse the workers
 # Returns:
     # iter_avg_errors - A list of the average absolute errors at each iteration
     # iter_perc_errors - A list of average percent errors at each iteration
     # test_avg_errors - A list of average absolute errors on the test set at each iteration
     # test_perc_errors - A list of average percent errors on the test set at each iteration
-def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_weighting=None, model_idle_time=False, initial_idle_time=0):
+def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_weighting=None, model_idle_time=False, initial_idle_time=0,
+                          batched_routing=False, num_processes=1):
     #print("Estimating traffic.  use_distance_weighting=" + str(use_distance_weighting))
     DEBUG = False
-    #Collapse identical trips
-    unique_trips = road_map.match_trips_to_nodes(trips)
+    #Collapse identical trips.  The trips may come from a generator, which can only be
+    #read once - so the totals for the average velocity are added up at the same time
+    totals = [0.0, 0.0]
+    unique_trips = road_map.match_trips_to_nodes(iter_with_totals(trips, totals))
     if(len(unique_trips) == 0):
         raise Exception("No trips to estimate traffic.")
     
@@ -282,12 +399,19 @@ def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_
         unique_test_trips = road_map.match_trips_to_nodes(test_set)
 
     # Set initial travel times to average velocity across trips
-    avg_velocity = compute_avg_velocity(trips)
+    # (the same as compute_avg_velocity(trips))
+    avg_velocity = totals[1] / totals[0]
     road_map.set_all_link_speeds(avg_velocity)
     
     # Set the initial idle time
     road_map.idle_link.time = initial_idle_time
     
+    # The same worker processes are used in every iteration - only the link times
+    # are sent to them when they change
+    router = None
+    if(num_processes > 1):
+        router = road_map.get_shared_router(num_processes)
+    
     
     iter_avg_errors = []
     iter_perc_errors = []
@@ -316,20 +440,26 @@ def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_
         # l1_error stores the sum of all absolute errors
         error_metric, avg_trip_error, avg_perc_error = predict_trip_times(road_map,
                 unique_trips, route=True, distance_weighting=distance_weighting,
-                model_idle_time=model_idle_time)
+                model_idle_time=model_idle_time, batched=batched_routing, router=router)
         iter_avg_errors.append(avg_trip_error)
         iter_perc_errors.append(avg_perc_error)
         
         # If we have a test set, also evaluate the map on it
         if(test_set != None):
             test_l1_error, test_avg_trip_error, test_perc_error = predict_trip_times(
-                road_map, unique_test_trips, route=True, model_idle_time=model_idle_time)
+                road_map, unique_test_trips, route=True, model_idle_time=model_idle_time,
+                batched=batched_routing, router=router)
             test_avg_errors.append(test_avg_trip_error)
             test_perc_errors.append(test_perc_error)
         
         
+        # The routes stay the same until the next outer iteration, so they are
+        # stored as a RouteMatrix for computing offsets and evaluating steps
+        route_matrix = RouteMatrix(unique_trips)
+        
         #Determine which links need to increase or decrease their travel time
-        compute_link_offsets(road_map, unique_trips, distance_weighting=distance_weighting)
+        link_offsets, _ = compute_link_offsets(road_map, unique_trips, distance_weighting=distance_weighting,
+                                               route_matrix=route_matrix)
         
         
         
@@ -341,6 +471,14 @@ def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_
         outer_loop_again = False # Start optimistic - this might be the last iteration
         # The results of the inner loop may tell us that we need to loop again
         
+        # During the inner loop, the trips are only evaluated through the
+        # RouteMatrix and arrays of link times
+        link_times = np.array([link.time for link in road_map.links])
+        link_lengths = np.array([link.length for link in road_map.links])
+        # Constrain the travel times to physically realistic values (except the idle link)
+        min_link_times = link_lengths / MAX_SPEED
+        min_link_times[road_map.idle_link.link_id] = -np.inf
+        
         # Inner loop - use errors on Trips to refine the Links' travel times
         # We will try making a small step, but will make it even smaller if we overshoot
         # The inner loop stops if we find a step that makes an improvement, or the step size gets too small
@@ -348,30 +486,21 @@ def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_
         while(eps > .0001):
             if(DEBUG):
                 print("Taking a step at eps=" + str(eps))
+                print("***** " + str(road_map.idle_link.offset))
             #Inner Loop Step 1 - propose new travel times on the links
             #Links with a positive offset are systematically overestimated - travel times should be decreased
             #Links with a negative offset are systematically underestiamted - travel times should be increased
-            for link in road_map.links:
-                if(DEBUG and link==road_map.idle_link):
-                    print("***** " + str(link.offset))
-                if(link.offset > 0):
-                    link.proposed_time = link.time / (1 + eps)
-                elif(link.offset < 0):
-                    link.proposed_time = link.time * (1 + eps)
-                else:
-                    link.proposed_time = link.time
-                
-                #Constrain the travel time to a physically realistic value
-                if(link != road_map.idle_link):
-                    link.proposed_time = max(link.proposed_time, link.length/MAX_SPEED)
-
+            proposed_times = np.where(link_offsets > 0, link_times / (1 + eps),
+                                      np.where(link_offsets < 0, link_times * (1 + eps),
+                                               link_times))
+            proposed_times = np.maximum(proposed_times, min_link_times)
     
             # Inner Loop Step 2 - Evaluate proposed travel times in terms of L1 error
             # Use routes to predict travel times for trips
-            # We do not compute new routes yet (route=False), we use the existing ones
-            new_error_metric, new_avg_trip_error, new_avg_perc_error = predict_trip_times(
-                            road_map, unique_trips, route=False, proposed=True, max_speed=0,
-                            distance_weighting=distance_weighting, model_idle_time=model_idle_time)            
+            # We do not compute new routes yet, we use the existing ones
+            new_error_metric, new_avg_trip_error, new_avg_perc_error = predict_trip_times_from_matrix(
+                            route_matrix, proposed_times, link_lengths,
+                            distance_weighting=distance_weighting)
             if(DEBUG):
                 print("Old L1 = " + str(error_metric))
                 print("New L1 = " + str(new_error_metric))
@@ -381,13 +510,14 @@ def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_
             if(new_error_metric < error_metric):
                 if(DEBUG):
                     print("Accepting")
+                    print (">>>" + str(proposed_times[road_map.idle_link.link_id]))
                 # The step decreased the error - accept it!
-                for link in road_map.links:
-                    if(DEBUG and link==road_map.idle_link):
-                        print (">>>" + str(link.proposed_time))
-                    link.time = link.proposed_time
+                for link, proposed_time in zip(road_map.links, proposed_times.tolist()):
+                    link.time = proposed_time
                 
                 # Now that the travel times have changed, we need to route the trips again
+                # (predict_trip_times() also brings the ArrayGraph and any landmark
+                # tables up to date with the new times)
                 outer_loop_again = True
                 break
             else:
@@ -401,7 +531,8 @@ def estimate_travel_times(road_map, trips, max_iter=20, test_set=None, distance_
     iter_perc_errors.append(avg_perc_error)
     # If we have a test set, also evaluate the map on it
     if(test_set != None):
-        test_l1_error, test_avg_trip_error, test_perc_error = predict_trip_times(road_map, unique_test_trips, route=True)
+        test_l1_error, test_avg_trip_error, test_perc_error = predict_trip_times(road_map, unique_test_trips, route=True,
+                                                                             batched=batched_routing, router=router)
         test_avg_errors.append(test_avg_trip_error)
         test_perc_errors.append(test_perc_error)
                 
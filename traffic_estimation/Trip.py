@@ -8,13 +8,21 @@ Created on Wed Aug  6 14:17:57 2014
 """
 #from tools import *
 from routing.Node import approx_distance
+from routing.SlotObject import SlotObject
 
 
 
 #A single taxi trip - contains information such as coordinates, times, etc...
 #Can be parsed from a line of a CSV file via the constructor
 #Some trips contain obvious errors - the isValid() method reveals this
-class Trip:
+#Millions of Trips can be in memory at once, so their attributes are listed in __slots__
+class Trip(SlotObject):
+    __slots__ = ('fromLon', 'fromLat', 'toLon', 'toLat', 'dist', 'pickup_time', 'dropoff_time',
+                 'time', 'pace', 'straight_line_dist', 'winding_factor', 'has_other_error',
+                 'origin_node', 'dest_node', 'origin_node_id', 'dest_node_id',
+                 'num_occurrences', 'dup_times', 'path_links', 'path_link_ids',
+                 'estimated_time', 'estimated_dist', 'estimate_distance')
+
     header_line = []
 
     #A static method which enables the __init__() method to work properly
@@ -52,6 +60,10 @@ class Trip:
         self.time = int(duration.total_seconds()) #Time stores the duration as seconds
         
         #For traffic estimation algorithm
+        self.origin_node = None
+        self.dest_node = None
+        self.origin_node_id = None
+        self.dest_node_id = None
         self.path_links = None
         self.path_link_ids = None
         self.dup_times = None
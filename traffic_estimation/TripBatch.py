@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Stores many taxi trips as numpy columns, instead of one Trip object per trip.
+
+A TripBatch has one array per feature: coordinates, metered distance, pickup and
+dropoff times, duration, pace, straight-line distance and winding factor.  They
+are computed with the same formulas as Trip.__init__(), and validate() applies
+the thresholds of Trip.isValid() to all trips at once.  So the trips of a whole
+day can be filtered without creating any Trip objects - they are only created
+(with to_trips()) for the trips that are actually used.
+
+A TripBatch can be built from database records (the same ones Trip() takes), or
+from the columnar batches of db_trip.iter_trips(columnar=True).
+
+@author: brian
+"""
+from datetime import datetime, timedelta
+import numpy as np
+
+from Trip import Trip
+
+# Meters per mile, and per degree of latitude / longitude (see approx_distance())
+METERS_PER_MILE = 1609.34
+LAT_METERS = 111194.86461
+LON_METERS = 84253.1418965
+
+# Epoch seconds are converted to datetimes relative to this
+EPOCH = datetime(1970, 1, 1)
+
+# The position of each column in a trip record (see Trip.__init__())
+PICKUP_DATETIME = 5
+DROPOFF_DATETIME = 6
+TRIP_DISTANCE = 9
+PICKUP_LONGITUDE = 10
+PICKUP_LATITUDE = 11
+DROPOFF_LONGITUDE = 12
+DROPOFF_LATITUDE = 13
+RECORD_LENGTH = 24
+
+
+class TripBatch:
+    # Params:
+        # pickup_time, dropoff_time - arrays of times, in seconds since the epoch
+        # trip_distance - an array of metered distances, in miles
+        # fromLon, fromLat, toLon, toLat - arrays of pickup and dropoff coordinates
+        # records - the database record of each trip, if there are any.  Otherwise,
+            # to_trips() makes new records from the columns
+    def __init__(self, pickup_time, dropoff_time, trip_distance,
+                 fromLon, fromLat, toLon, toLat, records=None):
+        self.records = records
+        # The node_ids of the Nodes the trips are snapped to, if they are already
+        # known (see db_trip_cache).  -1 for trips which aren't used
+        self.origin_node_ids = None
+        self.dest_node_ids = None
+        self.num_trips = len(pickup_time)
+        self.pickup_time = np.asarray(pickup_time, dtype=np.float64)
+        self.dropoff_time = np.asarray(dropoff_time, dtype=np.float64)
+        trip_distance = np.asarray(trip_distance, dtype=np.float64)
+        coords = [np.asarray(column, dtype=np.float64)
+                  for column in [fromLon, fromLat, toLon, toLat]]
+
+        # A Trip sets all of these to 0 if any of them can't be parsed (e.g. NULL)
+        missing = np.isnan(trip_distance)
+        for column in coords:
+            missing |= np.isnan(column)
+        (self.fromLon, self.fromLat,
+         self.toLon, self.toLat) = [np.where(missing, 0.0, column) for column in coords]
+        self.trip_distance = np.where(missing, 0.0, trip_distance)
+        self.dist = self.trip_distance * METERS_PER_MILE
+
+        # Duration in whole seconds, truncated like int(duration.total_seconds())
+        self.time = np.trunc(self.dropoff_time - self.pickup_time).astype(np.int64)
+
+        # Pace, or 0 if the distance is 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.pace = np.where(self.dist == 0, 0.0, self.time / self.dist)
+
+        # Straight-line distance and winding factor (1 if the coordinates are the same)
+        lat_meters = (self.fromLat - self.toLat) * LAT_METERS
+        lon_meters = (self.fromLon - self.toLon) * LON_METERS
+        self.straight_line_dist = np.sqrt(lat_meters * lat_meters + lon_meters * lon_meters)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.winding_factor = np.where(self.straight_line_dist <= 0, 1.0,
+                                           self.dist / self.straight_line_dist)
+
+    # Builds a TripBatch from database records, like the ones read by db_trip
+    # Params:
+        # records - a list of 24-column trip records
+    # Returns:
+        # a TripBatch, which keeps the records for to_trips()
+    @staticmethod
+    def from_records(records):
+        def column(i):
+            values = np.empty(len(records), dtype=np.float64)
+            for j, record in enumerate(records):
+                try:
+                    values[j] = float(record[i])
+                except (TypeError, ValueError):
+                    values[j] = np.nan
+            return values
+
+        def epoch_seconds(i):
+            times = np.array([record[i] for record in records], dtype='datetime64[us]')
+            return (times - np.datetime64(EPOCH, 'us')) / np.timedelta64(1, 's')
+
+        return TripBatch(epoch_seconds(PICKUP_DATETIME), epoch_seconds(DROPOFF_DATETIME),
+                         column(TRIP_DISTANCE),
+                         column(PICKUP_LONGITUDE), column(PICKUP_LATITUDE),
+                         column(DROPOFF_LONGITUDE), column(DROPOFF_LATITUDE),
+                         records=records)
+
+    # Builds a TripBatch from a columnar batch of db_trip.iter_trips()
+    # Params:
+        # columns - a dictionary of float arrays, with the names in db_trip.COLUMNAR_FIELDS
+    @staticmethod
+    def from_columns(columns):
+        return TripBatch(columns['pickup_time'], columns['dropoff_time'], columns['dist'],
+                         columns['fromLon'], columns['fromLat'],
+                         columns['toLon'], columns['toLat'])
+
+    # Applies the thresholds of Trip.isValid() to every trip at once
+    # Returns:
+        # an array with the error code of each trip (Trip.VALID, or one of the
+        # Trip.ERR_* / Trip.BAD_* codes).  Like isValid(), the first failing check
+        # decides the code
+    def validate(self):
+        fromLat, fromLon, toLat, toLon = self.fromLat, self.fromLon, self.toLat, self.toLon
+        pickup_months = (self.pickup_time.astype('datetime64[s]')
+                         .astype('datetime64[M]'))
+
+        # The checks of isValid(), in order
+        checks = [
+            (pickup_months == np.datetime64('2010-08'), Trip.ERR_DATE),
+            (pickup_months == np.datetime64('2010-09'), Trip.ERR_DATE),
+            ((toLat < 40.4) | (fromLat < 40.4), Trip.ERR_GPS),
+            ((toLat > 41.1) | (fromLat > 41.1), Trip.ERR_GPS),
+            ((toLon < -74.25) | (fromLon < -74.25), Trip.ERR_GPS),
+            ((toLon > -73.5) | (fromLon > -73.5), Trip.ERR_GPS),
+            (self.straight_line_dist < .001*1609.34, Trip.ERR_LO_STRAIGHTLINE),
+            (self.straight_line_dist > 20*1609.34, Trip.ERR_HI_STRAIGHTLINE),
+            (self.dist < .001*1609.34, Trip.ERR_LO_DIST),
+            (self.dist > 20*1609.34, Trip.ERR_HI_DIST),
+            (self.winding_factor < .95, Trip.ERR_LO_WIND),
+            (self.time < 10, Trip.ERR_LO_TIME),
+            (self.time > 7200, Trip.ERR_HI_TIME),
+            (self.pace < 10/1609.34, Trip.ERR_LO_PACE),
+            (self.pace > 7200/1609.34, Trip.ERR_HI_PACE),
+            ((toLat < 40.6) | (fromLat < 40.6), Trip.BAD_GPS),
+            ((toLat > 40.9) | (fromLat > 40.9), Trip.BAD_GPS),
+            ((toLon < -74.05) | (fromLon < -74.05), Trip.BAD_GPS),
+            ((toLon > -73.7) | (fromLon > -73.7), Trip.BAD_GPS),
+            (self.straight_line_dist > 8*1609.34, Trip.BAD_HI_STRAIGHTLINE),
+            (self.dist > 15*1609.34, Trip.BAD_HI_DIST),
+            (self.winding_factor > 5, Trip.BAD_HI_WIND),
+            (self.time < 60, Trip.BAD_LO_TIME),
+            (self.time > 3600, Trip.BAD_HI_TIME),
+            (self.pace < 40/1609.34, Trip.BAD_LO_PACE),
+            (self.pace > 3600/1609.34, Trip.BAD_HI_PACE)]
+
+        # Apply the checks backwards, so that the first one that fails is written last
+        codes = np.full(self.num_trips, Trip.VALID, dtype=np.int64)
+        for (failed, code) in reversed(checks):
+            codes[failed] = code
+        return codes
+
+    # Creates Trip objects for some of the trips
+    # Params:
+        # indices - an array-like of trip indices in this batch
+    # Returns:
+        # a list of Trips
+    def to_trips(self, indices):
+        indices = np.asarray(indices, dtype=np.int64).tolist()
+        if(self.records is not None):
+            return [Trip(self.records[i]) for i in indices]
+
+        trips = []
+        for i in indices:
+            record = [None] * RECORD_LENGTH
+            record[PICKUP_DATETIME] = EPOCH + timedelta(seconds=self.pickup_time[i])
+            record[DROPOFF_DATETIME] = EPOCH + timedelta(seconds=self.dropoff_time[i])
+            record[TRIP_DISTANCE] = self.trip_distance[i]
+            record[PICKUP_LONGITUDE] = self.fromLon[i]
+            record[PICKUP_LATITUDE] = self.fromLat[i]
+            record[DROPOFF_LONGITUDE] = self.toLon[i]
+            record[DROPOFF_LATITUDE] = self.toLat[i]
+            trips.append(Trip(record))
+        return trips
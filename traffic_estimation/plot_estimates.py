@@ -44,10 +44,15 @@ class DefaultPool():
         return map(fun, args)
         
 
-def plot_speed(road_map, dt, filename, pace_dict=None):
+#The number of frames whose travel times are loaded from the database with one query
+FRAMES_PER_LOAD = 24
+
+#If no speed dict is given, the speeds are loaded from the database, unless
+#preloaded is True (the travel times have already been applied to road_map)
+def plot_speed(road_map, dt, filename, pace_dict=None, preloaded=False):
     
     #If no speed dict is given, load the speeds from the database
-    if(pace_dict==None):
+    if(pace_dict==None and not preloaded):
         db_travel_times.load_travel_times(road_map, dt)
 
 
@@ -84,17 +89,25 @@ def plot_speed(road_map, dt, filename, pace_dict=None):
 
 def plot_group_of_speeds((dts, pace_dicts), road_map, tmp_dir):
     road_map.unflatten()
-    db_main.connect("db_functions/database.conf")
+    if(db_travel_times.uses_database()):
+        db_main.connect("db_functions/database.conf")
     for i in range(len(dts)):
         dt = dts[i]
         if(pace_dicts==None):
             pace_dict = None
+            #Load the travel times of the next few frames at once
+            if(i % FRAMES_PER_LOAD == 0):
+                (times, num_trips) = db_travel_times.load_travel_time_matrix(
+                    road_map, dts[i:i + FRAMES_PER_LOAD])
+            db_travel_times.apply_link_times(road_map, times[i % FRAMES_PER_LOAD],
+                                             num_trips[i % FRAMES_PER_LOAD])
         else:
             pace_dict = pace_dicts[i]
         
         out_file = path.join(tmp_dir, str(dt) + ".png")
-        plot_speed(road_map, dt, out_file, pace_dict=pace_dict)
-    db_main.close()
+        plot_speed(road_map, dt, out_file, pace_dict=pace_dict, preloaded=True)
+    if(db_travel_times.uses_database()):
+        db_main.close()
 
 
 def plot_speeds_in_parallel(road_map, dts, speed_dicts=None, tmp_dir="analysis/tmp", pool=DefaultPool()):